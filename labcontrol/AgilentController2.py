@@ -18,18 +18,40 @@
 ''' Controller for Agilent 33250A Function Generator, via VISA. could also control other visa devices'''
 
 import logging
+from labcontrol.VisaSessionPool import pool
+from labcontrol.StateCache import StateCache, ALL_SETTINGS
+from labcontrol.Instrumentation import VisaProxy
+from labcontrol.ArbitraryWaveform import WaveformSlots
+
+# settings the 33250A may change by itself when one of them is set
+COUPLED_SETTINGS = {'FUNC': ALL_SETTINGS, 'APPL': ALL_SETTINGS,
+    'VOLT': ['VOLT:HIGH', 'VOLT:LOW'], 'VOLT:OFFS': ['VOLT:HIGH', 'VOLT:LOW'],
+    'VOLT:HIGH': ['VOLT', 'VOLT:OFFS'], 'VOLT:LOW': ['VOLT', 'VOLT:OFFS'],
+    'FREQ': ['PULS:PER'], 'PULS:PER': ['FREQ', 'PULS:WIDT'],
+    'FUNC:USER': [], # only selects the arbitrary waveform, the generic FUNC coupling doesn't apply
+    'DATA:DAC': ['FUNC:USER']} # new volatile data is only output once it is selected again
 
 class AgilentSimulator:
     '''simulator, if visa is not present'''
     #pylint: disable=C0321,C0111,R0913,C0103,W0613
     def __init__(self):
         self.lastCommand = None
+        self.volatile = None # DAC codes of the last DATA:DAC block
+        self.waveforms = {} # name -> DAC codes
 
     def read(self):
         return None
     def write(self, string):
         '''visa command write function'''
         self.lastCommand = string
+        if string.startswith('DATA:DAC VOLATILE,'):
+            block = string[string.index('#'):]
+            self.volatile = block[2 + int(block[1]):]
+            return
+        for command in string.split(';'):
+            command = command.strip().lstrip(':')
+            if command.startswith('DATA:COPY '):
+                self.waveforms[command[10:].split(',')[0]] = self.volatile
 
 class AgilentController2:
     '''interface to Tektronix oscilloscopes'''
@@ -39,35 +61,48 @@ class AgilentController2:
         elif logID == 'starkalyzer':
             self.logger=logging.getLogger('starkalyzer')
         try:
-            import visa #pylint: disable=F0401
             # try-clause
-            self.__agilent = visa.instrument('TCPIP0::10.0.0.3::gpib0,9::INSTR', timeout = 1)
+            self.__agilent = pool.handle('TCPIP0::10.0.0.3::gpib0,9::INSTR', timeout = 1, lazy = True)
             self.logger.warn("Agilent 2 function generator loaded")
         except:
             self.logger.warn("can't load visa driver for Agilent function generator, using simulator")
             self.__agilent = AgilentSimulator()
+        self.__agilent = StateCache(VisaProxy(self.__agilent, 'agilent2'), COUPLED_SETTINGS)
+        self.__waveforms = WaveformSlots(self.__agilent)
 
 
     def initialize(self):
         '''hardware initialization'''
         self.__agilent.write('OUTPUT ON')
 
+    def resync(self):
+        '''forget which settings and waveforms were sent, after a front panel change or reset'''
+        self.__agilent.resync()
+        self.__waveforms.forget()
+
+    def batch(self, opc=False):
+        '''context in which all commands are collected and sent as compound messages
+        
+        with opc=True, the block only ends when the instrument has processed them'''
+        return self.__agilent.batch(opc)
+
     def startOutput(self,data):
-        if not(data["PulseLength"] == 0):
-            self.__agilent.write('BURS:STAT ON')
-            self.__agilent.write('VOLT:HIGH 5')
-            self.__agilent.write('VOLT:LOW 0')
-            self.__agilent.write('FUNC PULS')
-            self.__agilent.write('PULS:PER 1.00')
-            self.__agilent.write('PULS:WIDT ' + str(data["PulseLength"]) + 'ns')
-            self.__agilent.write('BURS:MODE TRIG')
-            self.__agilent.write('TRIG:SOUR EXT')
-            self.__agilent.write('BURS:NCYC 1')                          
-        else:
-            self.__agilent.write('BURS:STAT OFF')
-            self.__agilent.write('FUNC SIN')
-            self.__agilent.write('FREQ ' + str(data["Freq"]))
-            self.__agilent.write('VOLT ' + str(data["Amp"]))
+        with self.__agilent.batch():
+            if not(data["PulseLength"] == 0):
+                self.__agilent.write('BURS:STAT ON')
+                self.__agilent.write('VOLT:HIGH 5')
+                self.__agilent.write('VOLT:LOW 0')
+                self.__agilent.write('FUNC PULS')
+                self.__agilent.write('PULS:PER 1.00')
+                self.__agilent.write('PULS:WIDT ' + str(data["PulseLength"]) + 'ns')
+                self.__agilent.write('BURS:MODE TRIG')
+                self.__agilent.write('TRIG:SOUR EXT')
+                self.__agilent.write('BURS:NCYC 1')                          
+            else:
+                self.__agilent.write('BURS:STAT OFF')
+                self.__agilent.write('FUNC SIN')
+                self.__agilent.write('FREQ ' + str(data["Freq"]))
+                self.__agilent.write('VOLT ' + str(data["Amp"]))
             
 
     def setFrequency(self, frequency):
@@ -83,25 +118,35 @@ class AgilentController2:
         self.__agilent.write('BURS:STAT OFF')
         self.__agilent.write('APPL:SIN')
 
+    def setArbitrary(self, waveform, persist=None):
+        '''output waveform (floats in -1..1 or DAC codes) as arbitrary function
+        
+        waveforms already in the instrument's memory are only selected, not uploaded
+        again; waveforms used repeatedly are kept in non-volatile slots, see WaveformSlots'''
+        with self.__agilent.batch():
+            return self.__waveforms.select(waveform, persist)
+
     def setDC(self, voltage):
         self.__agilent.write('APPL:DC DEF,DEF,' + str(voltage))
 
     def setPulse(self, pulse_length):
-        self.__agilent.write('VOLT:HIGH 5')
-        self.__agilent.write('VOLT:LOW 0')
-        self.__agilent.write('FUNC PULS') # set the function to pulse
-        self.__agilent.write('PULS:PER 0.01')
-        self.__agilent.write('PULS:WIDT ' + str(pulse_length) + 'ns' )
-        self.logger.debug("Agilent: Pulse period is set to " + str(pulse_length) + " s.")
-        # add commands to set edge time, high lvl and low lvl voltage to get TTL
+        with self.__agilent.batch():
+            self.__agilent.write('VOLT:HIGH 5')
+            self.__agilent.write('VOLT:LOW 0')
+            self.__agilent.write('FUNC PULS') # set the function to pulse
+            self.__agilent.write('PULS:PER 0.01')
+            self.__agilent.write('PULS:WIDT ' + str(pulse_length) + 'ns' )
+            self.logger.debug("Agilent: Pulse period is set to " + str(pulse_length) + " s.")
+            # add commands to set edge time, high lvl and low lvl voltage to get TTL
 
     def setBurstMode(self):
-        self.setFrequency(1000)
-        self.__agilent.write('PULS:PER 0.01')
-        self.__agilent.write('FUNC PULS')
-        self.__agilent.write('BURS:MODE TRIG')
-        self.__agilent.write('BURS:NCYC 1')
-        self.__agilent.write('BURS:STAT ON')
+        with self.__agilent.batch():
+            self.setFrequency(1000)
+            self.__agilent.write('PULS:PER 0.01')
+            self.__agilent.write('FUNC PULS')
+            self.__agilent.write('BURS:MODE TRIG')
+            self.__agilent.write('BURS:NCYC 1')
+            self.__agilent.write('BURS:STAT ON')
 
 
     def updateBurstMode(self, mode):
@@ -27,10 +27,14 @@ import time # only for test images
 #########################
 
 from labalyzer.LabalyzerSettings import settings
+from labcontrol.Instrumentation import LibraryProxy, argValue
 
 import logging
 logger = logging.getLogger('labalyzer')
 
+# bytes moved by the calls that transfer data, for the I/O metrics
+PAYLOAD_BYTES = {'GetOldestImage16': lambda args: 2 * argValue(args[1])}
+
 
 # defines from atmcd32d.h
 DRV_SUCCESS = 20002
@@ -81,6 +85,7 @@ class AndorController:
 			logger.warn("can't load Andor driver, using simulator")
 			self.__andor = AndorSimulator()
 			self.simulate = True
+		self.__andor = LibraryProxy(self.__andor, 'andor', PAYLOAD_BYTES)
 		# for testing only!
 		############################
 		if self.simulate:
@@ -169,7 +174,7 @@ class AndorController:
 				return self.darkImage
 		# TODO: Size is wrong if Binning is != 1
 		img = numpy.zeros((self.size_y, self.size_x), dtype=numpy.uint16)
-		self.__andor.GetOldestImage16(img.ctypes.data, self.size_x*self.size_y)
+		self.__andor.GetOldestImage16(img.ctypes.data_as(ctypes.c_void_p), self.size_x*self.size_y)
 		return img
 	
 	def getTemperature(self):
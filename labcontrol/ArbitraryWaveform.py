@@ -0,0 +1,135 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' arbitrary waveforms for the Agilent 33250A: binary upload and a table of the waveforms already stored in the instrument'''
+
+import hashlib
+import numpy
+
+import logging
+logger = logging.getLogger('labalyzer')
+
+DAC_MAX = 2047 # DAC codes run from -DAC_MAX to DAC_MAX
+MIN_POINTS = 1
+MAX_POINTS = 65536
+STORED_SLOTS = 4 # non-volatile user waveforms of the 33250A
+
+
+def dacCodes(waveform):
+	'''waveform as little endian 16 bit DAC codes; floats are scaled from -1..1, integers are taken as codes'''
+	waveform = numpy.asarray(waveform)
+	if waveform.ndim != 1 or not MIN_POINTS <= len(waveform) <= MAX_POINTS:
+		raise ValueError('arbitrary waveform needs %d to %d points, got shape %s' % (MIN_POINTS, MAX_POINTS, waveform.shape))
+	if waveform.dtype.kind == 'f':
+		waveform = numpy.rint(numpy.clip(waveform, -1., 1.) * DAC_MAX)
+	return numpy.clip(waveform, -DAC_MAX, DAC_MAX).astype('<i2')
+
+
+def waveformHash(codes):
+	'''content address of a waveform given as DAC codes'''
+	return hashlib.sha1(codes.tobytes()).hexdigest()
+
+
+class WaveformSlots:
+	'''remembers which waveforms are in the instrument's memory
+	
+	a waveform is uploaded as a binary DATA:DAC block into volatile memory and
+	output from there; selecting the waveform that is already in volatile memory
+	only sends FUNC:USER. a waveform that has to be uploaded a second time, e.g.
+	when a scan switches between a few shapes, is also copied to one of the
+	non-volatile slots names (ARB1, ARB2, ...), the least recently used one
+	being overwritten when all are taken, and then selected from there without
+	any upload. copying writes flash, which takes seconds, so it is done once
+	per shape; persist=True/False in select copies right away/never.
+	instrument has to be a StateCache.'''
+	def __init__(self, instrument, slots=STORED_SLOTS):
+		self.instrument = instrument
+		self.names = ['ARB' + str(i + 1) for i in range(slots)]
+		self.__volatile = None # hash of the waveform in volatile memory
+		self.__stored = {} # hash -> name, of the persisted waveforms
+		self.__used = [] # hashes of persisted waveforms, least recently used first
+		self.__uploaded = [] # hashes of recent uploads, to spot repeated shapes
+		self.uploads = 0
+		self.copies = 0
+		self.hits = 0
+	
+	def forget(self):
+		'''forget what is stored, e.g. after the memory was changed at the front panel'''
+		self.__volatile = None
+		self.__stored.clear()
+		self.__used = []
+		self.__uploaded = []
+	
+	def __contains__(self, waveform):
+		key = waveformHash(dacCodes(waveform))
+		return key == self.__volatile or key in self.__stored
+	
+	def __upload(self, key, codes):
+		'''load codes into volatile memory'''
+		self.instrument.write('FORM:BORD SWAP')
+		self.instrument.writeBlock('DATA:DAC VOLATILE,', codes.tobytes())
+		self.__volatile = key
+		if key in self.__uploaded:
+			self.__uploaded.remove(key)
+		self.__uploaded = self.__uploaded[-4*len(self.names):] + [key]
+		self.uploads += 1
+		logger.debug('uploaded %d point arbitrary waveform' % len(codes))
+	
+	def __persist(self, key):
+		'''copy volatile memory to a free or the least recently used slot, returns its name'''
+		free = [name for name in self.names if name not in self.__stored.values()]
+		if free:
+			name = free[0]
+		else: # DATA:COPY overwrites it
+			name = self.__stored.pop(self.__used.pop(0))
+		self.instrument.write('DATA:COPY ' + name + ',VOLATILE')
+		self.__stored[key] = name
+		self.copies += 1
+		logger.debug('stored arbitrary waveform as %s' % name)
+		return name
+	
+	def select(self, waveform, persist=None):
+		'''make waveform the arbitrary function, uploading it only if it isn't in memory yet
+		
+		persist=None keeps it in a non-volatile slot once it is selected again after
+		another waveform, True does so right away and False never. returns the name
+		it is output from, VOLATILE or a slot name.'''
+		codes = dacCodes(waveform)
+		key = waveformHash(codes)
+		name = self.__stored.get(key)
+		if name is not None:
+			self.hits += 1
+			self.__used.remove(key)
+			self.__used.append(key)
+		elif key == self.__volatile and not persist:
+			self.hits += 1
+			name = 'VOLATILE'
+		else:
+			if persist is None:
+				persist = key in self.__uploaded
+			if key != self.__volatile:
+				self.__upload(key, codes)
+			else:
+				self.hits += 1
+			if persist:
+				name = self.__persist(key)
+				self.__used.append(key)
+			else:
+				name = 'VOLATILE'
+		self.instrument.write('FUNC:USER ' + name)
+		self.instrument.write('FUNC USER')
+		return name
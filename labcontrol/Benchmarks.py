@@ -0,0 +1,262 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' benchmarks of the labcontrol hot paths, run on the simulators
+
+python -m labcontrol.Benchmarks -o results.json            run and save the results
+python -m labcontrol.Benchmarks -b baseline.json           compare with a saved run
+'''
+
+import json
+import optparse
+import os
+import platform
+import sys
+import time
+
+import numpy
+
+from labcontrol.Instrumentation import timer
+
+import logging
+logger = logging.getLogger('labalyzer')
+
+FORMAT = 'labcontrol-benchmarks'
+VERSION = 1
+
+# (name, setup function, sizes, required packages), in the order they are run
+BENCHMARKS = []
+
+
+def benchmark(name, requires=(), **sizes):
+	'''register the decorated setup function as benchmark name
+	
+	sizes maps a size name to the keyword arguments the setup function gets;
+	the setup function returns the callable that is timed. requires lists the
+	packages outside labcontrol the benchmark needs, it is skipped without them.'''
+	def register(setup):
+		BENCHMARKS.append((name, setup, sizes, requires))
+		return setup
+	return register
+
+
+def missing(packages):
+	'''the packages that can not be imported'''
+	result = []
+	for package in packages:
+		try:
+			__import__(package)
+		except ImportError:
+			result.append(package)
+	return result
+
+
+def _private(cls, name):
+	'''name mangled attribute of a controller'''
+	return '_' + cls.__name__ + '__' + name
+
+
+@benchmark('scope.decodeCurve', realistic={'points': 10000}, scaled={'points': 1000000})
+def decodeCurveBenchmark(points):
+	from labcontrol.ScopeController import ScopeSimulator, decodeCurve
+	simulator = ScopeSimulator(recordLength=points, seed=0)
+	block = simulator.respond('CURVE?')
+	yMult, yOff = simulator.yMult(), simulator.yOff()
+	return lambda: decodeCurve(block, yMult, yOff, 0., 2, numpy.float32)
+
+
+@benchmark('scope.getTrace', realistic={'points': 10000}, scaled={'points': 1000000})
+def getTraceBenchmark(points):
+	from labcontrol.ScopeController import ScopeController, ScopeSimulator
+	from labcontrol.Instrumentation import VisaProxy
+	controller = ScopeController()
+	setattr(controller, _private(ScopeController, 'scope'), VisaProxy(ScopeSimulator(recordLength=points, seed=0), 'scope'))
+	controller.initialize()
+	return lambda: controller.getTrace(1, numpy.float32)
+
+
+@benchmark('nidaq.readData', realistic={'channels': 4, 'samples': 10000}, scaled={'channels': 32, 'samples': 100000})
+def readDataBenchmark(channels, samples):
+	from labcontrol.NIDAQInputController import NIDAQInputController
+	controller = NIDAQInputController()
+	controller.initialize(samples, 10**6, dict([('Dev3/ai%d' % i, (-10., 10.)) for i in range(channels)]))
+	return controller.readData
+
+
+@benchmark('nidaq.programmeChannels', requires=('labalyzer',), realistic={'samples': 10000}, scaled={'samples': 200000})
+def nidaqProgrammeBenchmark(samples):
+	from labcontrol.NIDAQOutputController import NIDAQOutputController
+	controller = NIDAQOutputController()
+	controller.initialize()
+	aodata = [numpy.zeros(8*samples), numpy.zeros(8*samples)]
+	return lambda: controller.programmeChannels(aodata)
+
+
+@benchmark('viewpoint.programmeChannels', requires=('labalyzer',), realistic={'scans': 10000}, scaled={'scans': 1000000})
+def viewpointProgrammeBenchmark(scans):
+	from labcontrol.ViewpointController import ViewpointController
+	controller = ViewpointController()
+	controller.initialize()
+	diodata = numpy.zeros(6*scans, dtype=numpy.uint16)
+	diodata[-6] = scans
+	return lambda: controller.programmeChannels(diodata)
+
+
+@benchmark('andor.getImage', requires=('labalyzer',), realistic={'width': 512, 'height': 512}, scaled={'width': 2048, 'height': 2048})
+def getImageBenchmark(width, height):
+	from labcontrol.AndorController import AndorController
+	controller = AndorController()
+	controller.simulate = False # time the readout path, not the test images
+	controller.size_x, controller.size_y = width, height
+	return controller.getImage
+
+
+@benchmark('rohsch.calibration', realistic={'points': 1}, scaled={'points': 100000})
+def calibrationBenchmark(points):
+	from labcontrol.RohSchController import PowerCalibration
+	fileName = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'ressources', 'rsCalibrationCurve1.2mW.csv')
+	calibration = PowerCalibration.fromFile(fileName)
+	if points == 1:
+		return lambda: calibration.getPower(300e6)
+	frequencies = numpy.linspace(calibration.frequencies[0], calibration.frequencies[-1], points)
+	return lambda: calibration.getPowers(frequencies)
+
+
+def measure(function, repeat=5, minTime=0.05):
+	'''time function; each of repeat runs calls it often enough to take minTime. returns seconds per call'''
+	number = 1
+	while True:
+		start = timer()
+		for _ in range(number):
+			function()
+		elapsed = timer() - start
+		if elapsed >= minTime or number >= 10**6:
+			break
+		number *= 10
+	times = [elapsed/number]
+	for _ in range(repeat - 1):
+		start = timer()
+		for _ in range(number):
+			function()
+		times.append((timer() - start)/number)
+	times.sort()
+	return {'best': times[0], 'median': times[len(times)//2], 'mean': sum(times)/len(times), 'number': number, 'repeat': repeat}
+
+
+def run(names=None, sizes=None, repeat=5, minTime=0.05):
+	'''run the benchmarks (all, or those whose name starts with one of names) at sizes (default all)'''
+	results = []
+	for name, setup, benchmarkSizes, requires in BENCHMARKS:
+		if names and not [n for n in names if name.startswith(n)]:
+			continue
+		absent = missing(requires)
+		if absent:
+			logger.warning('benchmark %s skipped, %s not installed' % (name, ', '.join(absent)))
+		for size in sorted(benchmarkSizes):
+			if sizes and size not in sizes:
+				continue
+			params = benchmarkSizes[size]
+			if absent:
+				result = {'skipped': 'needs %s, which is not installed' % ', '.join(absent)}
+			else:
+				try:
+					function = setup(**params)
+					result = measure(function, repeat, minTime)
+				except Exception as e:
+					logger.error('benchmark %s (%s) failed: %s' % (name, size, e))
+					result = {'error': '%s: %s' % (type(e).__name__, e)}
+			result.update({'name': name, 'size': size, 'params': params})
+			results.append(result)
+	return {'format': FORMAT, 'version': VERSION, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'python': platform.python_version(), 'numpy': numpy.__version__, 'platform': platform.platform(),
+		'results': results}
+
+
+def compare(results, baseline, threshold=1.2):
+	'''[(name, size, median, baseline median, ratio, verdict)] for the benchmarks in both runs
+	
+	verdict is 'slower' if the median grew by more than threshold, 'faster' if it shrank by as much.'''
+	reference = dict([((r['name'], r['size']), r) for r in baseline['results'] if 'median' in r])
+	rows = []
+	for result in results['results']:
+		old = reference.get((result['name'], result['size']))
+		if old is None or 'median' not in result:
+			continue
+		ratio = result['median']/old['median']
+		verdict = ratio > threshold and 'slower' or ratio < 1./threshold and 'faster' or ''
+		rows.append((result['name'], result['size'], result['median'], old['median'], ratio, verdict))
+	return rows
+
+
+def formatTime(seconds):
+	for unit, factor in (('s', 1.), ('ms', 1e-3), ('us', 1e-6)):
+		if seconds >= factor:
+			return '%.3g %s' % (seconds/factor, unit)
+	return '%.3g ns' % (seconds*1e9)
+
+
+def main(argv=None):
+	parser = optparse.OptionParser(usage='python -m labcontrol.Benchmarks [options] [benchmark ...]')
+	parser.add_option('-o', '--output', dest='output', help='save the results as JSON to this file')
+	parser.add_option('-b', '--baseline', dest='baseline', help='compare with the results in this file')
+	parser.add_option('-t', '--threshold', dest='threshold', type='float', default=1.2,
+		help='ratio of medians that counts as a change (default 1.2)')
+	parser.add_option('-s', '--size', dest='sizes', action='append', help='only run this size (realistic, scaled)')
+	parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5, help='runs per benchmark (default 5)')
+	parser.add_option('-l', '--list', dest='list', action='store_true', help='list the benchmarks and exit')
+	(options, args) = parser.parse_args(argv)
+	
+	if options.list:
+		for name, setup, sizes, requires in BENCHMARKS:
+			print('%-30s %s' % (name, ', '.join(['%s %s' % (s, sizes[s]) for s in sorted(sizes)])))
+		return 0
+	
+	results = run(args, options.sizes, options.repeat)
+	for result in results['results']:
+		if 'error' in result:
+			print('%-30s %-10s %s' % (result['name'], result['size'], result['error']))
+		elif 'skipped' in result:
+			print('%-30s %-10s skipped, %s' % (result['name'], result['size'], result['skipped']))
+		else:
+			print('%-30s %-10s %10s (best %s)' % (result['name'], result['size'], formatTime(result['median']), formatTime(result['best'])))
+	if options.output:
+		f = open(options.output, 'w')
+		try:
+			json.dump(results, f, indent=1, sort_keys=True)
+		finally:
+			f.close()
+	if not options.baseline:
+		return 0
+	
+	f = open(options.baseline)
+	try:
+		baseline = json.load(f)
+	finally:
+		f.close()
+	if baseline.get('format') != FORMAT:
+		parser.error('%s is not a benchmark result file' % options.baseline)
+	print('')
+	regressions = 0
+	for name, size, median, old, ratio, verdict in compare(results, baseline, options.threshold):
+		print('%-30s %-10s %10s -> %10s  x%.2f %s' % (name, size, formatTime(old), formatTime(median), ratio, verdict))
+		if verdict == 'slower':
+			regressions += 1
+	return regressions and 1 or 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
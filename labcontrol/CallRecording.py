@@ -0,0 +1,255 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' recording of the calls the controllers make to their instruments, and replay of a recording on the simulators'''
+
+import base64
+import ctypes
+import gzip
+import json
+import numbers
+import threading
+import time
+import numpy
+
+from labcontrol.Instrumentation import metrics, timer
+
+import logging
+logger = logging.getLogger('labalyzer')
+
+FORMAT = 'labcontrol-calls'
+VERSION = 1
+
+# functions returning a new handle through a by reference argument: name -> index of that argument.
+# the handles a simulator hands out differ from the recorded ones, so Replay maps them.
+HANDLE_OUTPUTS = {'DAQmxCreateTask': 1, 'DAQmxLoadTask': 1}
+
+
+def encodeArgument(arg):
+	'''JSON representation of a call argument
+	
+	ctypes values are kept with their type; by reference buffers (arrays,
+	structures) only with their size, as their content is filled in by the driver.
+	arrays passed as pointer are kept with their content: numpy arrays passed
+	with ctypes.data_as and ctypes arrays. other pointers raise TypeError, as
+	their size is unknown; a bare address (array.ctypes.data) can't be told
+	from an integer, so pass arrays with data_as.'''
+	if arg is None or isinstance(arg, bool):
+		return arg
+	array = getattr(arg, '_arr', None) # set by numpy's ctypes.data_as
+	if isinstance(array, numpy.ndarray):
+		return {'array': array.dtype.str, 'shape': list(array.shape),
+			'b64': base64.b64encode(numpy.ascontiguousarray(array).tobytes()).decode('ascii')}
+	if isinstance(arg, ctypes.Array):
+		return {'carray': ctypes.sizeof(arg), 'b64': base64.b64encode(ctypes.string_at(ctypes.addressof(arg), ctypes.sizeof(arg))).decode('ascii')}
+	if isinstance(arg, ctypes._Pointer) or (isinstance(arg, ctypes.c_void_p) and arg.value is not None):
+		raise TypeError('can not record pointer argument %r, its size is unknown' % (arg,))
+	if isinstance(arg, numbers.Integral):
+		return int(arg)
+	if isinstance(arg, numbers.Real):
+		return float(arg)
+	if isinstance(arg, (str, bytes)):
+		if isinstance(arg, str) and all([32 <= ord(c) < 127 or c in '\r\n\t' for c in arg]):
+			return arg
+		return {'b64': base64.b64encode(arg if isinstance(arg, bytes) else arg.encode('latin-1')).decode('ascii')}
+	obj = getattr(arg, '_obj', None) # ctypes.byref
+	if isinstance(obj, ctypes._SimpleCData):
+		return {'ref': type(obj).__name__, 'v': encodeArgument(obj.value)}
+	if obj is not None:
+		return {'buf': ctypes.sizeof(obj)}
+	if isinstance(arg, ctypes._SimpleCData):
+		return {'c': type(arg).__name__, 'v': encodeArgument(arg.value)}
+	return {'repr': repr(arg)}
+
+
+def decodeArgument(arg):
+	'''call argument for a JSON representation made by encodeArgument; unknown objects become None'''
+	if not isinstance(arg, dict):
+		return arg
+	if 'array' in arg:
+		array = numpy.frombuffer(base64.b64decode(arg['b64']), dtype=numpy.dtype(str(arg['array']))).reshape(arg['shape']).copy()
+		return array.ctypes.data_as(ctypes.c_void_p) # keeps the array alive
+	if 'carray' in arg:
+		return ctypes.create_string_buffer(base64.b64decode(arg['b64']), arg['carray'])
+	if 'b64' in arg:
+		return base64.b64decode(arg['b64'])
+	if 'ref' in arg:
+		return ctypes.byref(getattr(ctypes, arg['ref'])(arg['v']))
+	if 'buf' in arg:
+		return ctypes.byref(ctypes.create_string_buffer(arg['buf']))
+	if 'c' in arg:
+		return getattr(ctypes, arg['c'])(arg['v'])
+	return None
+
+
+def recordedValue(arg):
+	'''value of an encoded argument passed by value, None for buffers and references'''
+	if isinstance(arg, dict):
+		if 'c' in arg:
+			return arg['v']
+		return None
+	if isinstance(arg, numbers.Integral) and not isinstance(arg, bool):
+		return arg
+	return None
+
+
+class CallRecorder:
+	'''collects the calls made through the instrumentation proxies
+	
+	each call is stored as [time since start, device, function, arguments,
+	bytes, duration]. recording needs the metrics to be enabled, begin() does so.'''
+	def __init__(self, metrics=metrics):
+		self.metrics = metrics
+		self.calls = []
+		self.start = None
+		self.__lock = threading.Lock()
+	
+	def begin(self):
+		'''start recording every call'''
+		self.start = timer()
+		self.metrics.recorder = self
+		self.metrics.enable()
+		return self
+	
+	def end(self):
+		'''stop recording'''
+		if self.metrics.recorder is self:
+			self.metrics.recorder = None
+	
+	def call(self, device, name, args, start, seconds, noBytes):
+		'''add one call, called by the proxies'''
+		entry = [start - self.start, device, name, [encodeArgument(a) for a in args], noBytes, seconds]
+		self.__lock.acquire()
+		try:
+			self.calls.append(entry)
+		finally:
+			self.__lock.release()
+	
+	def save(self, path):
+		'''write the calls to path as gzipped JSON, one call per line'''
+		self.__lock.acquire()
+		try:
+			calls = sorted(self.calls)
+		finally:
+			self.__lock.release()
+		f = gzip.open(path, 'wb')
+		try:
+			f.write((json.dumps({'format': FORMAT, 'version': VERSION, 'calls': len(calls)}) + '\n').encode('ascii'))
+			for entry in calls:
+				f.write((json.dumps(entry, separators=(',', ':')) + '\n').encode('ascii'))
+		finally:
+			f.close()
+		logger.info('saved %d recorded calls to %s' % (len(calls), path))
+
+
+class Replay:
+	'''a recorded call sequence, played back on simulators (or any objects with the same functions)'''
+	def __init__(self, calls):
+		self.calls = calls
+	
+	@classmethod
+	def load(cls, path):
+		f = gzip.open(path, 'rb')
+		try:
+			header = json.loads(f.readline().decode('ascii'))
+			if header.get('format') != FORMAT or header.get('version') != VERSION:
+				raise ValueError('%s is not a call recording of version %d' % (path, VERSION))
+			calls = [json.loads(line.decode('ascii')) for line in f if line.strip()]
+		finally:
+			f.close()
+		return cls(calls)
+	
+	def devices(self):
+		return sorted(set([entry[1] for entry in self.calls]))
+	
+	def duration(self):
+		'''time from the first call to the end of the last one, as recorded'''
+		if not self.calls:
+			return 0.
+		return max([entry[0] + entry[5] for entry in self.calls]) - self.calls[0][0]
+	
+	def latencies(self):
+		'''{(device, function): mean recorded duration}'''
+		sums = {}
+		for entry in self.calls:
+			total = sums.setdefault((entry[1], entry[2]), [0., 0])
+			total[0] += entry[5]
+			total[1] += 1
+		return dict([(key, total[0] / total[1]) for key, total in sums.items()])
+	
+	def run(self, targets, speed=1.0, latency=True, paced=True):
+		'''call every recorded function on targets[device]; calls of other devices are skipped
+		
+		with paced, each call is made at its recorded time (divided by speed),
+		with latency, each call takes at least its recorded duration, to stand
+		in for the hardware. returns {'elapsed', 'recorded', 'calls', 'late'},
+		late being the largest delay of a call behind its recorded time.
+		
+		handles created by the functions in HANDLE_OUTPUTS are mapped to the
+		ones the target creates, and replaced where they are passed as first
+		argument of a later call of the same device.'''
+		calls = [entry for entry in self.calls if entry[1] in targets]
+		origin = calls and calls[0][0] or 0.
+		late = 0.
+		handles = {} # (device, recorded handle) -> handle created during the replay
+		start = timer()
+		for offset, device, name, args, noBytes, seconds in calls:
+			due = start + (offset - origin) / speed
+			now = timer()
+			if paced and now < due:
+				time.sleep(due - now)
+			elif paced:
+				late = max(late, now - due)
+			decoded = [decodeArgument(a) for a in args]
+			if args and (device, recordedValue(args[0])) in handles:
+				handle = handles[(device, recordedValue(args[0]))]
+				decoded[0] = isinstance(decoded[0], ctypes._SimpleCData) and type(decoded[0])(handle) or handle
+			callStart = timer()
+			getattr(targets[device], name)(*decoded)
+			output = HANDLE_OUTPUTS.get(name)
+			if output is not None and output < len(args) and isinstance(args[output], dict) and 'ref' in args[output]:
+				handles[(device, args[output]['v'])] = decoded[output]._obj.value
+			if latency:
+				remaining = callStart + seconds / speed - timer()
+				if remaining > 0:
+					time.sleep(remaining)
+		return {'elapsed': timer() - start, 'recorded': self.duration() / speed, 'calls': len(calls), 'late': late}
+
+
+class LatencyProxy:
+	'''wraps a simulator so that each function takes as long as in a recording
+	
+	lets the current controller code run against the simulators with the
+	hardware timing of a recorded session. latencies is Replay.latencies().'''
+	def __init__(self, target, device, latencies):
+		self.target = target
+		self.latencies = dict([(name, seconds) for (d, name), seconds in latencies.items() if d == device])
+	
+	def __getattr__(self, name):
+		function = getattr(self.target, name)
+		seconds = self.latencies.get(name)
+		if not seconds or not callable(function):
+			return function
+		def call(*args):
+			start = timer()
+			try:
+				return function(*args)
+			finally:
+				remaining = start + seconds - timer()
+				if remaining > 0:
+					time.sleep(remaining)
+		return call
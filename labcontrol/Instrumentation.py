@@ -0,0 +1,223 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' I/O instrumentation: call counts, bytes moved and latency histograms per device and command,
+for VISA sessions and the ctypes driver libraries (DAQmx, DIO64, Andor)'''
+
+import bisect
+import sys
+import threading
+import time
+
+import logging
+logger = logging.getLogger('labalyzer')
+
+# upper bounds of the latency histogram buckets in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1., 3., 10.)
+
+# best clock available; time.time only ticks every 15 ms on windows
+timer = getattr(time, 'perf_counter', None) or (sys.platform == 'win32' and time.clock or time.time)
+
+
+def argValue(arg):
+	'''python value of a ctypes argument (or a plain number)'''
+	return getattr(arg, 'value', arg)
+
+
+class Metrics:
+	'''counts, bytes and latency histogram of every (device, command)
+	
+	recording is off until enable() is called; the proxies then only check a flag per call.
+	while enabled, every call is also passed on to recorder, if set (see CallRecording).'''
+	def __init__(self):
+		self.enabled = False
+		self.recorder = None
+		self.__lock = threading.Lock()
+		self.__entries = {} # (device, command) -> [count, bytes, seconds, buckets]
+	
+	def enable(self, enabled=True):
+		self.enabled = enabled
+	
+	def disable(self):
+		self.enabled = False
+	
+	def reset(self):
+		'''drop everything recorded so far'''
+		self.__lock.acquire()
+		try:
+			self.__entries.clear()
+		finally:
+			self.__lock.release()
+	
+	def record(self, device, command, seconds, noBytes=0):
+		'''add one call of command on device'''
+		bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+		self.__lock.acquire()
+		try:
+			entry = self.__entries.get((device, command))
+			if entry is None:
+				entry = self.__entries[(device, command)] = [0, 0, 0., [0] * (len(LATENCY_BUCKETS) + 1)]
+			entry[0] += 1
+			entry[1] += noBytes
+			entry[2] += seconds
+			entry[3][bucket] += 1
+		finally:
+			self.__lock.release()
+	
+	def snapshot(self):
+		'''{device: {command: {'count', 'bytes', 'seconds', 'buckets'}}}, buckets are per bucket (not cumulative) counts'''
+		self.__lock.acquire()
+		try:
+			entries = [(key, list(entry[:3]) + [list(entry[3])]) for key, entry in self.__entries.items()]
+		finally:
+			self.__lock.release()
+		result = {}
+		for (device, command), (count, noBytes, seconds, buckets) in entries:
+			result.setdefault(device, {})[command] = {'count': count, 'bytes': noBytes, 'seconds': seconds, 'buckets': buckets}
+		return result
+	
+	def prometheus(self, prefix='labcontrol_io'):
+		'''snapshot in the Prometheus text exposition format'''
+		snapshot = self.snapshot()
+		keys = [(device, command) for device in sorted(snapshot) for command in sorted(snapshot[device])]
+		def labels(device, command, extra=''):
+			command = command.replace('\\', '\\\\').replace('"', '\\"')
+			return '{device="%s",command="%s"%s}' % (device, command, extra)
+		lines = ['# TYPE %s_calls_total counter' % prefix]
+		lines += ['%s_calls_total%s %d' % (prefix, labels(d, c), snapshot[d][c]['count']) for d, c in keys]
+		lines.append('# TYPE %s_bytes_total counter' % prefix)
+		lines += ['%s_bytes_total%s %d' % (prefix, labels(d, c), snapshot[d][c]['bytes']) for d, c in keys]
+		lines.append('# TYPE %s_latency_seconds histogram' % prefix)
+		for d, c in keys:
+			entry = snapshot[d][c]
+			cumulative = 0
+			for bound, count in zip([repr(b) for b in LATENCY_BUCKETS] + ['+Inf'], entry['buckets']):
+				cumulative += count
+				lines.append('%s_latency_seconds_bucket%s %d' % (prefix, labels(d, c, ',le="%s"' % bound), cumulative))
+			lines.append('%s_latency_seconds_sum%s %r' % (prefix, labels(d, c), entry['seconds']))
+			lines.append('%s_latency_seconds_count%s %d' % (prefix, labels(d, c), entry['count']))
+		return '\n'.join(lines) + '\n'
+
+
+# shared by all controllers
+metrics = Metrics()
+
+
+def visaHeader(string):
+	'''command a VISA message is recorded under: the headers of its commands, without their values'''
+	parts = string.split('#', 1)[0].split(';') # binary blocks may contain any byte
+	return ';'.join([part.split(None, 1)[0].lstrip(':').upper() for part in parts if part.strip()])
+
+
+class VisaProxy:
+	'''wraps a VISA session (or its simulator); write, read, read_raw and ask are recorded
+	
+	reads are recorded as "read HEADERS" with the headers of the last query written.'''
+	def __init__(self, instrument, device, metrics=metrics):
+		self.instrument = instrument
+		self.device = device
+		self.metrics = metrics
+		self.__lastQuery = ''
+	
+	def __getattr__(self, name):
+		return getattr(self.instrument, name)
+	
+	def write(self, string):
+		if not self.metrics.enabled:
+			return self.instrument.write(string)
+		start = timer()
+		try:
+			return self.instrument.write(string)
+		finally:
+			elapsed = timer() - start
+			command = visaHeader(string)
+			if '?' in string.split('#', 1)[0]:
+				self.__lastQuery = command
+			self.metrics.record(self.device, command, elapsed, len(string))
+			if self.metrics.recorder is not None:
+				self.metrics.recorder.call(self.device, 'write', (string,), start, elapsed, len(string))
+	
+	def __read(self, name, function):
+		if not self.metrics.enabled:
+			return function()
+		start = timer()
+		answer = None
+		try:
+			answer = function()
+			return answer
+		finally:
+			elapsed = timer() - start
+			self.metrics.record(self.device, ('read ' + self.__lastQuery).strip(), elapsed, len(answer or ''))
+			if self.metrics.recorder is not None:
+				self.metrics.recorder.call(self.device, name, (), start, elapsed, len(answer or ''))
+	
+	def read(self):
+		return self.__read('read', self.instrument.read)
+	
+	def read_raw(self):
+		return self.__read('read_raw', self.instrument.read_raw)
+	
+	def ask(self, string):
+		lock = getattr(self.instrument, 'lock', None) # bus lock of a pooled session
+		if not hasattr(lock, 'acquire'):
+			lock = None
+		if lock is not None:
+			lock.acquire()
+		try:
+			self.write(string)
+			return self.read()
+		finally:
+			if lock is not None:
+				lock.release()
+
+
+class LibraryProxy:
+	'''wraps a ctypes driver library (or its simulator); every function call is recorded
+	
+	payload maps function names to a function of the call arguments returning
+	the number of bytes the call moves, for the calls that transfer data.'''
+	def __init__(self, library, device, payload=None, metrics=metrics):
+		self.library = library
+		self.device = device
+		self.payload = payload or {}
+		self.metrics = metrics
+		self.__functions = {}
+	
+	def __getattr__(self, name):
+		function = self.__functions.get(name)
+		if function is None:
+			function = self.__functions[name] = self.__wrap(name, getattr(self.library, name))
+		return function
+	
+	def __wrap(self, name, function):
+		metrics = self.metrics
+		device = self.device
+		size = self.payload.get(name)
+		def call(*args):
+			if not metrics.enabled:
+				return function(*args)
+			start = timer()
+			try:
+				return function(*args)
+			finally:
+				elapsed = timer() - start
+				noBytes = size and size(args) or 0
+				metrics.record(device, name, elapsed, noBytes)
+				if metrics.recorder is not None:
+					metrics.recorder.call(device, name, args, start, elapsed, noBytes)
+		call.__name__ = name
+		return call
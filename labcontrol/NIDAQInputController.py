@@ -16,12 +16,21 @@
 
 '''interface to NIDAQmx analog input cards'''
 
+import collections
 import ctypes
+import threading
+import time
+import numpy
+from labcontrol.Instrumentation import LibraryProxy, argValue
+from labcontrol.ShotSpool import SpoolWriter
 
 
 import logging
 logger = logging.getLogger('starkalyzer')
 
+# bytes moved by the calls that transfer data, for the I/O metrics
+PAYLOAD_BYTES = {'DAQmxReadAnalogF64': lambda args: 8 * argValue(args[5])}
+
 ##############################
 # Setup some typedefs and constants
 # to correspond with values in
@@ -46,43 +55,177 @@ DAQmx_Val_GroupByScanNumber = 1
 DAQmx_Val_DMA = 10054 
 DAQmx_Val_Interrupts = 10204
 DAQmx_Val_ProgrammedIO = 10264
+DAQmx_Val_Acquired_Into_Buffer = 1
+DAQmx_Val_Task_Commit = 3
+DAQmx_Val_Task_Unreserve = 5
+# int32 CVICALLBACK (TaskHandle taskHandle, int32 everyNsamplesEventType, uInt32 nSamples, void *callbackData)
+EveryNSamplesCallback = ctypes.CFUNCTYPE(int32, TaskHandle, int32, uInt32, ctypes.c_void_p)
+# the errors
+DAQmxErrorSamplesNoLongerAvailable = -200279 # the input buffer overflowed
+DAQmxErrorSamplesNotYetAvailable = -200284 # read timed out
 ##############################
 
 
+# signal of channels the simulator has no signal for: (kind, parameters...), see NIDAQInputSimulator
+DEFAULT_SIGNAL = [('noise', 0.01), ('pulse', 1.0, 1e-4, 2e-5)]
+
+
 class NIDAQInputSimulator:
-	'''simulator, used only if hardware is absent'''
+	'''simulator, used only if hardware is absent
+	
+	generates signals for the configured channels, rate and sample count.
+	signals maps a physical channel to a list of components, summed:
+	('noise', rms), ('offset', volts), ('sine', amplitude, frequency, phase)
+	and ('pulse', height, delay, width[, period]), a gaussian pulse delay
+	seconds after the trigger (or the start, for continuous acquisition),
+	repeating every period seconds if given. values are clipped to the channel
+	range. with realtime, reads wait until the samples would have been acquired.'''
 	#pylint: disable=C0321,C0111,R0913,C0103,W0613 
-	def __init__(self): pass
-	@staticmethod
-	def DAQmxCreateTask(TaskName, handle): logger.debug("Called DAQmxCreateTask in Simulator")
-	@staticmethod
-	def DAQmxStartTask(handle): logger.debug("Called DAQmxStartTask in Simulator")
-	@staticmethod
-	def DAQmxStopTask(handle): logger.debug("Called DAQmxStopTask in Simulator")
-	@staticmethod	
-	def DAQmxClearTask(handle): logger.debug("Called DAQmxClearTask in Simulator")
-	@staticmethod
-	def DAQmxCfgSampClkTiming(handle, Source, Rate, ActiveEdge, SampleMode, sampsPerChanToAcquire): logger.debug("Called DAQmxCfgSampleClkTiming in Simulator")
-	@staticmethod
-	def DAQmxCreateAOVoltageChan(handle, PhysicalChannel, NameToAssignToChannel, MinVal, MaxVal, Units, CustomScaleName): pass # logger.debug("Called DAQmxCreateAOVoltageChan in Simulator")
-	@staticmethod
-	def DAQmxWriteAnalogF64(handle, NumSampsPerChan, AutoStart, Timeout, DataLayout, WriteArray, sampsPerChanWritten, Reserved): logger.debug("Called DAQmxWriteAnalogF64 in Simulator")
-	@staticmethod
-	def DAQmxCfgDigEdgeStartTrig(handle, startTrigger, startEdge): logger.debug("Called DAQmxCfgDigEdgeStartTrig in Simulator")
-	@staticmethod
-	def DAQmxGetErrorString(error, buff, buffersize): pass
-	@staticmethod
-	def DAQmxCfgOutputBuffer(handle, buffersize): pass
-	@staticmethod
-	def DAQmxSetAODataXferMech(handle, PhysicalChannel, value): pass
-	@staticmethod
-	def DAQmxCreateAIVoltageChan(taskHandle, physicalChannel, nameToAssignToChannel, terminalConfig, minVal, maxVal, units, customScaleName): pass
-	@staticmethod
-	def DAQmxReadAnalogF64(handle, noSamples, timeout, fillMode, readArray, arraySizeInSamps, sampsPerChanRead, reserved): pass
-	@staticmethod
-	def DAQmxSetStartTrigType(taskHandle, data): pass
-	@staticmethod
-	def DAQmxCfgDigEdgeRefTrig(taskHandle, triggerSource, triggerEdge, pretriggerSamples): pass
+	def __init__(self, signals=None, realtime=False, seed=None):
+		self.signals = signals or {}
+		self.realtime = realtime
+		self.random = numpy.random.RandomState(seed)
+		self.__noise = self.random.standard_normal(2**20) # reads take random windows of it
+		self.__tasks = {} # handle -> task settings
+		self.__nextHandle = 1
+	def __task(self, handle):
+		return self.__tasks[argValue(handle)]
+	def DAQmxCreateTask(self, TaskName, handle):
+		logger.debug("Called DAQmxCreateTask in Simulator")
+		handle._obj.value = self.__nextHandle
+		self.__tasks[self.__nextHandle] = {'channels': [], 'rate': 1000., 'samples': 1000, 'continuous': False,
+			'trigger': 0, 'position': 0, 'started': None, 'templates': None, 'everyN': None}
+		self.__nextHandle += 1
+		return 0
+	def DAQmxStartTask(self, handle):
+		logger.debug("Called DAQmxStartTask in Simulator")
+		task = self.__task(handle)
+		task['started'] = time.time()
+		task['position'] = 0
+		if task['everyN'] is not None:
+			thread = threading.Thread(target=self.__fireEveryN, args=(argValue(handle), task, task['started']), name='NIDAQ AI simulator events')
+			thread.daemon = True
+			thread.start()
+		return 0
+	def __fireEveryN(self, handle, task, started):
+		'''call the Every N Samples callback whenever n more samples would have been acquired, until the task stops'''
+		n, callback, callbackData = task['everyN']
+		fired = 0
+		while task['started'] == started and (task['continuous'] or (fired + 1)*n <= task['samples']):
+			due = started + (fired + 1)*n/task['rate']
+			if due > time.time():
+				time.sleep(due - time.time())
+			if task['started'] != started:
+				break
+			callback(handle, DAQmx_Val_Acquired_Into_Buffer, n, callbackData)
+			fired += 1
+	def DAQmxStopTask(self, handle):
+		logger.debug("Called DAQmxStopTask in Simulator")
+		self.__task(handle)['started'] = None
+		return 0
+	def DAQmxClearTask(self, handle):
+		logger.debug("Called DAQmxClearTask in Simulator")
+		self.__tasks.pop(argValue(handle), None)
+		return 0
+	def DAQmxCfgSampClkTiming(self, handle, Source, Rate, ActiveEdge, SampleMode, sampsPerChanToAcquire):
+		logger.debug("Called DAQmxCfgSampleClkTiming in Simulator")
+		task = self.__task(handle)
+		task['rate'] = float(argValue(Rate))
+		task['samples'] = int(argValue(sampsPerChanToAcquire))
+		task['continuous'] = argValue(SampleMode) == DAQmx_Val_ContSamps
+		task['templates'] = None
+		return 0
+	def DAQmxCreateAIVoltageChan(self, taskHandle, physicalChannel, nameToAssignToChannel, terminalConfig, minVal, maxVal, units, customScaleName):
+		task = self.__task(taskHandle)
+		task['channels'].append((physicalChannel, float(argValue(minVal)), float(argValue(maxVal))))
+		task['templates'] = None
+		return 0
+	def DAQmxCfgDigEdgeRefTrig(self, taskHandle, triggerSource, triggerEdge, pretriggerSamples):
+		task = self.__task(taskHandle)
+		task['trigger'] = int(argValue(pretriggerSamples))
+		task['templates'] = None
+		return 0
+	def DAQmxCreateAOVoltageChan(self, handle, PhysicalChannel, NameToAssignToChannel, MinVal, MaxVal, Units, CustomScaleName): return 0
+	def DAQmxWriteAnalogF64(self, handle, NumSampsPerChan, AutoStart, Timeout, DataLayout, WriteArray, sampsPerChanWritten, Reserved): return 0
+	def DAQmxCfgDigEdgeStartTrig(self, taskHandle, triggerSource, triggerEdge): return 0
+	def DAQmxGetErrorString(self, error, buff, buffersize): return 0
+	def DAQmxCfgOutputBuffer(self, handle, buffersize): return 0
+	def DAQmxSetAODataXferMech(self, handle, PhysicalChannel, value): return 0
+	def DAQmxSetStartTrigType(self, taskHandle, data): return 0
+	def DAQmxCfgInputBuffer(self, taskHandle, numSampsPerChan): return 0
+	def DAQmxRegisterEveryNSamplesEvent(self, taskHandle, everyNsamplesEventType, nSamples, options, callbackFunction, callbackData):
+		# fired from a thread started with the task, see __fireEveryN
+		everyN = None
+		if callbackFunction:
+			everyN = (int(argValue(nSamples)), callbackFunction, callbackData)
+		self.__task(taskHandle)['everyN'] = everyN
+		return 0
+	def DAQmxTaskControl(self, taskHandle, action): return 0
+	
+	def __signal(self, task, channel, first, n):
+		'''noise free signal of channel for samples first to first+n-1'''
+		t = (numpy.arange(first, first + n) - task['trigger'])/task['rate']
+		signal = numpy.zeros(n)
+		for component in self.signals.get(channel, DEFAULT_SIGNAL):
+			kind, parameters = component[0], component[1:]
+			if kind == 'offset':
+				signal += parameters[0]
+			elif kind == 'sine':
+				amplitude, frequency, phase = parameters
+				signal += amplitude*numpy.sin(2*numpy.pi*frequency*t + phase)
+			elif kind == 'pulse':
+				height, delay, width = parameters[:3]
+				x = t - delay
+				if len(parameters) > 3:
+					x = (x + parameters[3]/2) % parameters[3] - parameters[3]/2
+				signal += height*numpy.exp(-0.5*(x/width)**2)
+			elif kind != 'noise':
+				raise ValueError('unknown signal component ' + repr(kind))
+		return signal
+	
+	def __noiseLevel(self, channel):
+		return sum([c[1] for c in self.signals.get(channel, DEFAULT_SIGNAL) if c[0] == 'noise'])
+	
+	def DAQmxReadAnalogF64(self, handle, noSamples, timeout, fillMode, readArray, arraySizeInSamps, sampsPerChanRead, reserved):
+		task = self.__task(handle)
+		channels = task['channels']
+		n = int(argValue(noSamples))
+		if n < 0: # DAQmx_Val_Auto: everything
+			n = task['samples']
+		if not task['continuous']:
+			n = min(n, task['samples'])
+		n = min(n, int(argValue(arraySizeInSamps))//max(len(channels), 1))
+		if self.realtime and task['started'] is not None:
+			due = task['started'] + (task['position'] + n)/task['rate']
+			if due > time.time():
+				time.sleep(due - time.time())
+		byScan = argValue(fillMode) == DAQmx_Val_GroupByScanNumber
+		if readArray is not None and not byScan:
+			data = numpy.frombuffer(readArray._obj, dtype=numpy.float64)[:len(channels)*n].reshape(len(channels), n)
+		else:
+			data = numpy.empty((len(channels), n))
+		if task['continuous']:
+			for i, (channel, low, high) in enumerate(channels):
+				data[i] = self.__signal(task, channel, task['position'], n)
+		else:
+			# every shot has the same signal relative to the trigger, only the noise differs
+			if task['templates'] is None:
+				task['templates'] = numpy.array([self.__signal(task, c, 0, task['samples']) for c, low, high in channels]).reshape(len(channels), -1)
+			data[:] = task['templates'][:, :n]
+		for i, (channel, low, high) in enumerate(channels):
+			rms = self.__noiseLevel(channel)
+			if rms and n <= len(self.__noise):
+				start = self.random.randint(0, len(self.__noise) - n + 1)
+				data[i] += rms*self.__noise[start:start + n]
+			elif rms:
+				data[i] += rms*self.random.standard_normal(n)
+			numpy.clip(data[i], low, high, data[i])
+		task['position'] += n
+		if readArray is not None and byScan:
+			numpy.frombuffer(readArray._obj, dtype=numpy.float64)[:data.size] = data.T.ravel()
+		if sampsPerChanRead is not None:
+			sampsPerChanRead._obj.value = n
+		return 0
 
 
 class NIDAQInputController:
@@ -93,16 +236,69 @@ class NIDAQInputController:
 		except AttributeError: # on error, use the simulator
 			logger.warn("can't load NIDAQ driver, using simulator")
 			self.__nidaq = NIDAQInputSimulator()
+		self.__nidaq = LibraryProxy(self.__nidaq, 'nidaq-ai', PAYLOAD_BYTES)
 		self.taskIsConfigured = False
 		self.taskIsRunning = False
-		
-	def initialize(self, noSamples, samplesPerSecond, channels):
-		'''initializing NIDAQ Input Hardware'''
+		self.streaming = False # task is configured for continuous acquisition
+		self.overflows = 0 # chunks lost while streaming
+		self.__reader = None
+		self.reducer = None # ShotReducer fed with every record
+		self.__everyN = None # registered EveryNSamplesCallback
+		self.spool = None # SpoolWriter every record read is appended to
+		self.__tasks = {} # configuration -> prepared task
+		self.__taskKey = None # configuration of the current task
+		self.__buffer = None
+		self.__eventBuffer = None # the Every N Samples callback reads into this one
+		self.triggerPosition = None # samples before the trigger in a record, None when streaming
+	
+	def __selectTask(self, key):
+		'''make the prepared task for configuration key the current one; False if there is none'''
+		if self.taskIsConfigured and self.__taskKey == key:
+			return True
 		if self.taskIsConfigured:
-			logger.error('tried to re-initialize nidaq controller while task was not cleared, call shutdown first')
+			# leave the current task, but keep it prepared
+			if self.streaming:
+				self.stopStreaming()
+				self.streaming = False
+			if self.taskIsRunning:
+				self.stopTask()
+			self.__unregisterEveryN()
+			self.CHK(self.__nidaq.DAQmxTaskControl(self.__taskHandle, DAQmx_Val_Task_Unreserve))
+			self.taskIsConfigured = False
+		if key not in self.__tasks:
+			return False
+		logger.debug('reusing prepared NIDAQ AI task')
+		self.__taskHandle = self.__tasks[key]
+		self.__taskKey = key
+		self.CHK(self.__nidaq.DAQmxTaskControl(self.__taskHandle, DAQmx_Val_Task_Commit))
+		self.taskIsConfigured = True
+		return True
+	
+	def __prepareTask(self, key):
+		'''keep the task just configured for key, and commit it, so starting it is fast'''
+		self.__tasks[key] = self.__taskHandle
+		self.__taskKey = key
+		self.CHK(self.__nidaq.DAQmxTaskControl(self.__taskHandle, DAQmx_Val_Task_Commit))
+		self.taskIsConfigured = True
+	
+	def initialize(self, noSamples, samplesPerSecond, channels):
+		'''initializing NIDAQ Input Hardware
+		
+		tasks are kept for every configuration; initializing with one used before
+		switches back to its task instead of creating a new one.'''
+		key = ('finite', noSamples, float(samplesPerSecond), tuple(sorted([(dev, tuple(channels[dev])) for dev in channels])))
+		selected = self.__selectTask(key)
+		self.noChannels = len(channels)
+		self.noSamples = noSamples
+		self.triggerPosition = noSamples//2 # the reference trigger leaves half the record before it
+		self.channels = dict(channels)
+		self.samplesPerSecond = samplesPerSecond
+		self.__checkReducer()
+		if self.__buffer is None or self.__buffer.shape != (self.noChannels, noSamples):
+			self.__buffer = numpy.zeros((self.noChannels, noSamples)) # reused by every readData
+		if selected:
 			return
-			
-				
+		
 		logger.debug('initializing NIDAQ AI')
 		self.__taskHandle = TaskHandle(0)
 		self.CHK(self.__nidaq.DAQmxCreateTask("", ctypes.byref(self.__taskHandle)))
@@ -119,10 +315,7 @@ class NIDAQInputController:
 		self.CHK(self.__nidaq.DAQmxSetStartTrigType(self.__taskHandle, int32(10150)))
 		self.CHK(self.__nidaq.DAQmxCfgDigEdgeRefTrig(self.__taskHandle, "/dev3/PFI0", int32(10280), uInt32(noSamples/2)))
 		
-		self.noChannels = len(channels)
-		self.noSamples = noSamples
-		
-		self.taskIsConfigured = True
+		self.__prepareTask(key)
 		
 		logger.info("NIDAQ Controller initialized")
 
@@ -142,16 +335,286 @@ class NIDAQInputController:
 			self.__nidaq.DAQmxGetErrorString(err, ctypes.byref(buf), buf_size)
 			logger.error('nidaq generated warning %d: %s'%(err, repr(buf.value)))
 	
-	def readData(self):
+	def readData(self, out=None):
+		'''read the acquired record, returns a (channels x samples) array
+		
+		the data is read straight into out, a C contiguous float64 array of shape
+		(channels, samples), or else into a buffer owned by the controller, which
+		is overwritten by the next readData. the result is a view of that memory,
+		with fewer samples if the read timed out early.'''
+		if out is None:
+			out = self.__buffer
+		elif out.shape != (self.noChannels, self.noSamples) or out.dtype != numpy.float64 or not out.flags.c_contiguous:
+			raise ValueError('readData needs a C contiguous float64 array of shape %s, got %s %s' % ((self.noChannels, self.noSamples), out.dtype, out.shape))
 		sRead = int32(0)
-		tmp = self.noSamples*self.noChannels
-		buffType = float64*tmp
-		buff = buffType(*[0]*tmp)
+		buff = (float64*out.size).from_buffer(out) # shares the memory of out
 
-		self.__nidaq.DAQmxReadAnalogF64(self.__taskHandle, int32(self.noSamples), float64(200), DAQmx_Val_GroupByChannel, ctypes.byref(buff), uInt32(tmp), ctypes.byref(sRead), None)
+		self.__nidaq.DAQmxReadAnalogF64(self.__taskHandle, int32(self.noSamples), float64(200), DAQmx_Val_GroupByChannel, ctypes.byref(buff), uInt32(out.size), ctypes.byref(sRead), None)
 		
 		logger.debug(str(sRead.value) + " samples read")
-		return buff	
+		if sRead.value == self.noSamples:
+			if self.__everyN is None: # else the callback has done this
+				self.__recordRead(out)
+			return out
+		# grouped by channel, a short read is packed with sRead samples per channel
+		return out.reshape(-1)[:self.noChannels*sRead.value].reshape(self.noChannels, sRead.value)
+	
+	def __recordRead(self, record):
+		'''hand a complete record to the reducer and the spool'''
+		if self.reducer is not None:
+			self.reducer.add(record)
+		if self.spool is not None:
+			self.spool.append(record)
+	
+	def initializeStreaming(self, chunkSize, samplesPerSecond, channels, noChunks=64, policy='block', trigger=None):
+		'''configure continuous acquisition, read in chunks of chunkSize samples per channel
+		
+		a reader thread started by startStreaming fills a ring buffer of noChunks
+		chunks, which chunks() hands out. when the consumer falls behind and the
+		ring is full, policy 'block' stops reading, so the samples queue up in
+		the DAQmx buffer (of the same size again) until it overflows, while
+		'drop' overwrites the oldest unread chunk. either way, lost chunks are
+		counted in overflows. trigger is a terminal like "/dev3/PFI0" to start
+		on, or None to start right away. like initialize, this reuses the task
+		of a configuration used before; a running stream is stopped first.'''
+		if policy not in ('block', 'drop'):
+			raise ValueError('unknown backpressure policy ' + repr(policy))
+		if self.__reader is not None:
+			self.stopStreaming()
+		
+		key = ('continuous', chunkSize, float(samplesPerSecond), tuple(sorted([(dev, tuple(channels[dev])) for dev in channels])), noChunks, trigger)
+		if not self.__selectTask(key):
+			logger.debug('initializing NIDAQ AI for streaming')
+			self.__taskHandle = TaskHandle(0)
+			self.CHK(self.__nidaq.DAQmxCreateTask("", ctypes.byref(self.__taskHandle)))
+			for dev in sorted(channels.keys()):
+				self.CHK(self.__nidaq.DAQmxCreateAIVoltageChan(self.__taskHandle, dev, "", -1, float64(channels[dev][0]), float64(channels[dev][1]), DAQmx_Val_Volts, None))
+			# for continuous samples, the sample count only sets the size of the DAQmx buffer
+			self.CHK(self.__nidaq.DAQmxCfgSampClkTiming(self.__taskHandle, "", float64(samplesPerSecond), DAQmx_Val_Rising, DAQmx_Val_ContSamps, uInt64(chunkSize*noChunks)))
+			self.CHK(self.__nidaq.DAQmxCfgInputBuffer(self.__taskHandle, uInt32(chunkSize*noChunks)))
+			if trigger is not None:
+				self.CHK(self.__nidaq.DAQmxCfgDigEdgeStartTrig(self.__taskHandle, trigger, DAQmx_Val_Rising))
+			self.__prepareTask(key)
+		
+		self.noChannels = len(channels)
+		self.noSamples = chunkSize
+		self.triggerPosition = None # chunks have no fixed position relative to the trigger
+		self.channels = dict(channels)
+		self.samplesPerSecond = samplesPerSecond
+		self.__checkReducer()
+		self.policy = policy
+		# one slot more than noChunks, for the chunk chunks() has handed out
+		self.__ring = numpy.zeros((noChunks + 1, self.noChannels, chunkSize))
+		self.__ringLock = threading.Condition()
+		self.__free = list(range(noChunks + 1)) # slots that can be read into
+		self.__filled = collections.deque() # slots holding unread chunks, oldest first
+		self.__held = None # slot of the chunk chunks() has handed out
+		self.__stop = threading.Event()
+		self.__streamError = None
+		self.overflows = 0
+		self.streaming = True
+		logger.info("NIDAQ Controller initialized for streaming")
+	
+	def startStreaming(self):
+		'''start the task and the reader thread'''
+		if not self.streaming:
+			logger.error('tried to start streaming, but the task is not configured for it, call initializeStreaming first')
+			return
+		self.__stop.clear()
+		self.startTask()
+		self.__reader = threading.Thread(target=self.__readChunks, name='NIDAQ AI reader')
+		self.__reader.daemon = True
+		self.__reader.start()
+	
+	def stopStreaming(self):
+		'''stop the reader thread and the task; unread chunks stay available to chunks()'''
+		if not self.streaming:
+			return
+		self.__stop.set()
+		if self.__reader is not None:
+			self.__ringLock.acquire()
+			try:
+				self.__ringLock.notify_all()
+			finally:
+				self.__ringLock.release()
+			self.__reader.join()
+			self.__reader = None
+		if self.taskIsRunning:
+			self.stopTask()
+	
+	def __readChunks(self):
+		'''reader thread: move chunks from the DAQmx buffer into the ring until stopped'''
+		chunkTime = 1.*self.noSamples/self.samplesPerSecond
+		scratch = numpy.zeros(self.noChannels*self.noSamples) # the rest of a chunk after a partial read
+		while not self.__stop.is_set():
+			slot = None
+			self.__ringLock.acquire()
+			try:
+				while not self.__free and not self.__stop.is_set():
+					if self.policy == 'drop' and self.__filled:
+						# the oldest unread chunk, never the one handed out
+						self.__free.append(self.__filled.popleft())
+						self.overflows += 1
+						break
+					self.__ringLock.wait(chunkTime)
+				if not self.__stop.is_set():
+					slot = self.__free.pop()
+			finally:
+				self.__ringLock.release()
+			if slot is None:
+				break
+			filled = self.__fillChunk(self.__ring[slot], scratch, chunkTime)
+			self.__ringLock.acquire()
+			try:
+				if filled:
+					self.__filled.append(slot)
+				else:
+					self.__free.append(slot)
+				self.__ringLock.notify_all()
+			finally:
+				self.__ringLock.release()
+		self.__ringLock.acquire()
+		try:
+			self.__stop.set()
+			self.__ringLock.notify_all()
+		finally:
+			self.__ringLock.release()
+	
+	def __fillChunk(self, chunk, scratch, chunkTime):
+		'''read one chunk; True once it is complete, False if it was lost or streaming stopped
+		
+		a read that times out early keeps the samples it got, the rest of the
+		chunk is read after them.'''
+		sRead = int32(0)
+		done = 0 # samples per channel in chunk so far
+		while done < self.noSamples:
+			n = self.noSamples - done
+			if done:
+				target = scratch
+			else: # grouped by channel, a short read is packed at the start
+				target = chunk.reshape(-1)
+			buff = (float64*(self.noChannels*n)).from_buffer(target)
+			sRead.value = 0
+			err = self.__nidaq.DAQmxReadAnalogF64(self.__taskHandle, int32(n), float64(10*chunkTime + 1), DAQmx_Val_GroupByChannel, ctypes.byref(buff), uInt32(self.noChannels*n), ctypes.byref(sRead), None)
+			if err == DAQmxErrorSamplesNoLongerAvailable:
+				# the DAQmx buffer overflowed and the task stopped; count what was lost and go on
+				logger.warn('NIDAQ input buffer overflowed while streaming, restarting the task')
+				self.overflows += 1
+				self.CHK(self.__nidaq.DAQmxStopTask(self.__taskHandle))
+				self.CHK(self.__nidaq.DAQmxStartTask(self.__taskHandle))
+				return False
+			if err is not None and err < 0 and err != DAQmxErrorSamplesNotYetAvailable:
+				self.CHK(err)
+				self.__streamError = err
+				self.__stop.set()
+				return False
+			k = sRead.value
+			if k and (done or k < n):
+				chunk[:, done:done + k] = target[:self.noChannels*k].reshape(self.noChannels, k).copy()
+			done += k
+			if done < self.noSamples and self.__stop.is_set():
+				logger.info('streaming stopped, dropping the last %d samples per channel of an incomplete chunk' % done)
+				return False
+		return True
+	
+	def chunks(self, timeout=None):
+		'''generator of (channels x chunkSize) chunks, in order, until streaming stops and the ring is empty
+		
+		a chunk is a view of the ring, valid until the next chunk is requested;
+		copy it to keep it. the reader never writes into it meanwhile, with
+		either policy. raises IOError when no chunk arrives within timeout
+		seconds or the reader failed.'''
+		while True:
+			self.__ringLock.acquire()
+			try:
+				if self.__held is not None: # the consumer is done with it
+					self.__free.append(self.__held)
+					self.__held = None
+					self.__ringLock.notify_all()
+				start = time.time()
+				while not self.__filled and not self.__stop.is_set():
+					if timeout is not None and time.time() - start > timeout:
+						raise IOError('no NIDAQ chunk within %g s' % timeout)
+					self.__ringLock.wait(timeout is None and 1. or timeout)
+				if not self.__filled:
+					break
+				slot = self.__held = self.__filled.popleft()
+			finally:
+				self.__ringLock.release()
+			yield self.__ring[slot]
+		if self.__streamError is not None:
+			raise IOError('NIDAQ streaming failed with error %d' % self.__streamError)
+	
+	def pendingChunks(self):
+		'''number of chunks in the ring that have not been handed out yet'''
+		return len(self.__filled)
+	
+	def attachReducer(self, reducer, everyN=False):
+		'''feed every complete record to reducer, a ShotReducer
+		
+		without everyN, records are added when readData is called. with everyN,
+		the record is read and added in a DAQmx Every N Samples callback as soon
+		as it is acquired, into a buffer of its own, and appended to the spool
+		there; no readData is needed. this has to be done before the task is
+		started.'''
+		self.detachReducer()
+		self.reducer = reducer
+		if everyN:
+			if self.taskIsRunning:
+				logger.error('Every N Samples events can only be registered before the task is started')
+				return
+			self.__eventBuffer = numpy.zeros((self.noChannels, self.noSamples))
+			self.__everyN = EveryNSamplesCallback(self.__recordAcquired) # keep a reference, or ctypes frees it
+			self.CHK(self.__nidaq.DAQmxRegisterEveryNSamplesEvent(self.__taskHandle, DAQmx_Val_Acquired_Into_Buffer, uInt32(self.noSamples), 0, self.__everyN, None))
+	
+	def detachReducer(self):
+		'''stop feeding records to the reducer'''
+		self.__unregisterEveryN()
+		self.reducer = None
+	
+	def __checkReducer(self):
+		'''detach the reducer if its records don't have the shape of the new configuration'''
+		if self.reducer is not None and (self.reducer.noChannels, self.reducer.noSamples) != (self.noChannels, self.noSamples):
+			logger.warn('detaching the shot reducer, it takes %d x %d records, but now %d channels x %d samples are read' %
+				(self.reducer.noChannels, self.reducer.noSamples, self.noChannels, self.noSamples))
+			self.detachReducer()
+	
+	def __unregisterEveryN(self):
+		'''feed the reducer from readData again'''
+		if self.__everyN is not None:
+			self.CHK(self.__nidaq.DAQmxRegisterEveryNSamplesEvent(self.__taskHandle, DAQmx_Val_Acquired_Into_Buffer, uInt32(self.noSamples), 0, None, None))
+			self.__everyN = None
+	
+	def __recordAcquired(self, taskHandle, eventType, nSamples, callbackData):
+		'''Every N Samples callback: read the record, reduce and spool it'''
+		try:
+			sRead = int32(0)
+			record = self.__eventBuffer
+			buff = (float64*record.size).from_buffer(record)
+			self.CHK(self.__nidaq.DAQmxReadAnalogF64(self.__taskHandle, int32(self.noSamples), float64(0), DAQmx_Val_GroupByChannel, ctypes.byref(buff), uInt32(record.size), ctypes.byref(sRead), None))
+			if sRead.value == self.noSamples:
+				self.__recordRead(record)
+			else:
+				logger.warn('Every N Samples callback read only %d of %d samples' % (sRead.value, self.noSamples))
+		except Exception as e: # must not propagate into the driver
+			logger.error('reducing NIDAQ record failed: %s' % e)
+		return 0
+	
+	def openSpool(self, path, **options):
+		'''append every record readData returns to a new spool file at path, see SpoolWriter
+		
+		the header gets the trigger position of the current configuration, none when streaming.'''
+		self.closeSpool()
+		names = sorted(self.channels.keys())
+		self.spool = SpoolWriter(path, names, [self.channels[n] for n in names], self.samplesPerSecond, self.noSamples,
+			self.triggerPosition, **options)
+		return self.spool
+	
+	def closeSpool(self):
+		'''finish writing the spool'''
+		if self.spool is not None:
+			spool, self.spool = self.spool, None
+			spool.close()
 	
 	def startTask(self):
 		'''start task'''
@@ -166,7 +629,17 @@ class NIDAQInputController:
 		self.taskIsRunning = False
 
 	def shutdown(self):
-		'''shutdown interface'''
-		self.CHK(self.__nidaq.DAQmxClearTask(self.__taskHandle))
+		'''shutdown interface, clears all prepared tasks'''
+		if self.streaming:
+			self.stopStreaming()
+			self.streaming = False
+		if self.taskIsRunning:
+			self.stopTask()
+		self.detachReducer()
+		self.closeSpool()
+		for handle in self.__tasks.values():
+			self.CHK(self.__nidaq.DAQmxClearTask(handle))
+		self.__tasks = {}
+		self.__taskKey = None
 		self.taskIsConfigured = False
 
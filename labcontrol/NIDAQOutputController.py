@@ -19,6 +19,8 @@
 from labalyzer.constants import (MODE_DIRECT)
 from labalyzer.LabalyzerSettings import settings
 import ctypes
+from labcontrol.Instrumentation import LibraryProxy, argValue
+from labcontrol.ParallelSetup import WorkerPool, SetupError
 
 
 import logging
@@ -48,8 +50,22 @@ DAQmx_Val_GroupByScanNumber = 1
 DAQmx_Val_DMA = 10054 
 DAQmx_Val_Interrupts = 10204
 DAQmx_Val_ProgrammedIO = 10264
+DAQmx_Val_Task_Commit = 3
+DAQmx_Val_Task_Unreserve = 5
 ##############################
 
+# bytes moved by the calls that transfer data, for the I/O metrics; each board has 8 channels
+PAYLOAD_BYTES = {'DAQmxWriteAnalogF64': lambda args: 8 * 8 * argValue(args[1])}
+
+BOARD_TIMEOUT = 30.0 # s for the work on one board, a long DMA upload included
+
+
+class NIDAQError(Exception):
+	'''a DAQmx call returned an error code'''
+	def __init__(self, code):
+		Exception.__init__(self, 'DAQmx error %d' % code)
+		self.code = code
+
 
 class NIDAQOutputSimulator:
 	'''simulator, used only if hardware is absent'''
@@ -77,6 +93,8 @@ class NIDAQOutputSimulator:
 	def DAQmxCfgOutputBuffer(handle, buffersize): pass
 	@staticmethod
 	def DAQmxSetAODataXferMech(handle, PhysicalChannel, value): pass
+	@staticmethod
+	def DAQmxTaskControl(handle, action): pass
 
 
 
@@ -88,8 +106,13 @@ class NIDAQOutputController:
 		except: # on error, use the simulator
 			logger.warn("can't load NIDAQ driver, using simulator")
 			self.__nidaq = NIDAQOutputSimulator()
+		self.__nidaq = LibraryProxy(self.__nidaq, 'nidaq-ao', PAYLOAD_BYTES)
 		self.taskIsConfigured = False
 		self.taskIsRunning = False
+		self.__tasks = {} # (mode, channels) -> prepared pair of tasks
+		self.__taskKey = None # key of the current pair, None until a mode is set
+		self.__timing = {} # id of task handle -> (source, rate, samples) last configured
+		self.__boards = None # WorkerPool with a thread per board, the driver calls release the GIL
 		
 	def initialize(self):
 		'''initilaize hardware'''
@@ -97,9 +120,23 @@ class NIDAQOutputController:
 			logger.error('tried to re-initialize nidaq controller while task was not cleared, call shutdown first')
 			return
 		
-		self.__taskHandle = [TaskHandle(0), TaskHandle(0)]
-		self.CHK(self.__nidaq.DAQmxCreateTask("", ctypes.byref(self.__taskHandle[0])))
-		self.CHK(self.__nidaq.DAQmxCreateTask("", ctypes.byref(self.__taskHandle[1])))
+		# not configured for a mode yet, the first setMode takes this pair
+		self.__taskHandle = self.__createTasks()
+		self.__taskKey = None
+		
+		self.taskIsConfigured = True
+		
+		logger.info("NIDAQ Controller initialized")
+	
+	def __channelKey(self):
+		'''the channel configuration, tasks are kept per channel configuration'''
+		return tuple(sorted([(k, v.boardNumber, v.channelNumber, v.GetDeviceString()) for k, v in settings['AnalogChannels'].iteritems()]))
+	
+	def __createTasks(self):
+		'''create a task for each board, with its AO channels'''
+		taskHandle = [TaskHandle(0), TaskHandle(0)]
+		self.CHK(self.__nidaq.DAQmxCreateTask("", ctypes.byref(taskHandle[0])))
+		self.CHK(self.__nidaq.DAQmxCreateTask("", ctypes.byref(taskHandle[1])))
 		
 		# apparently these have to be sorted in the order of the data array below
 		# limits still need ot be set properly?!
@@ -114,11 +151,20 @@ class NIDAQOutputController:
 				if v.boardNumber not in [0, 1]:
 					logger.error("there was a channel which did not belong to a known device! boardNumber was %d", v.boardNumber)
 				else:
-					self.CHK(self.__nidaq.DAQmxCreateAOVoltageChan( self.__taskHandle[v.boardNumber], v.GetDeviceString(), "", float64(-10), float64(10), DAQmx_Val_Volts, None))
-		
-		self.taskIsConfigured = True
-		
-		logger.info("NIDAQ Controller initialized")
+					self.CHK(self.__nidaq.DAQmxCreateAOVoltageChan( taskHandle[v.boardNumber], v.GetDeviceString(), "", float64(-10), float64(10), DAQmx_Val_Volts, None))
+		return taskHandle
+	
+	def __cfgTiming(self, board, source, rate, samples):
+		'''set the sample clock of a board's task, unless it is set like that already'''
+		handle = self.__taskHandle[board]
+		if self.__timing.get(id(handle)) == (source, rate, samples):
+			return
+		err = self.__nidaq.DAQmxCfgSampClkTiming(handle, source, float64(rate), DAQmx_Val_Rising, DAQmx_Val_FiniteSamps, uInt64(samples))
+		self.CHK(err)
+		if err is None or err >= 0: # else it is tried again next time
+			self.__timing[id(handle)] = (source, rate, samples)
+		else:
+			self.__timing.pop(id(handle), None)
 
 
 	def CHK( self, err ):
@@ -137,47 +183,104 @@ class NIDAQOutputController:
 			logger.error('nidaq generated warning %d: %s'%(err, repr(buf.value)))
 		return 1
 
-	def programmeChannels(self, aodata):
-		'''programme timeframe data to hardware'''
-		logger.debug("programming NIDAQ channels")
-		periodLength = len(aodata[0])/8
-		# determine sample timing
+	def __call(self, function, *args):
+		'''call a DAQmx function, raise NIDAQError if it fails'''
+		err = function(*args)
+		self.CHK(err)
+		if err is not None and err < 0:
+			raise NIDAQError(err)
+		return err
+	
+	def __forEachBoard(self, function):
+		'''run function(board) for both boards at once; returns {board: result}
+		
+		raises SetupError with the errors of all boards that failed.'''
+		if self.__boards is None:
+			self.__boards = WorkerPool(2, 'nidaq-ao')
+		return self.__boards.run(dict([(board, (function, (board,))) for board in range(len(self.__taskHandle))]), BOARD_TIMEOUT)
+	
+	def __programmeBoard(self, board, data, periodLength):
+		'''programme one board, returns the number of samples written'''
 		# setting the source to "PFI0" means that each sample is output only after a trigger is received on PFI0
-		self.CHK(self.__nidaq.DAQmxCfgSampClkTiming( self.__taskHandle[0], "PFI0", float64(settings['SamplesPerMillisecond']*1000), DAQmx_Val_Rising, DAQmx_Val_FiniteSamps, uInt64(periodLength))) # has to be after create AO Channel, but before writing to it; setting the source terminal to "PFI0" should enable to trigger from the DIO card!
-		self.CHK(self.__nidaq.DAQmxCfgSampClkTiming( self.__taskHandle[1], "PFI0", float64(settings['SamplesPerMillisecond']*1000), DAQmx_Val_Rising, DAQmx_Val_FiniteSamps, uInt64(periodLength))) # has to be after create AO Channel, but before writing to it; setting the source terminal to "PFI0" should enable to trigger from the DIO card!
-
+		# has to be after create AO Channel, but before writing to it; setting the source terminal to "PFI0" should enable to trigger from the DIO card!
+		self.__cfgTiming(board, "PFI0", settings['SamplesPerMillisecond']*1000, periodLength)
 		sampsWritten = ctypes.c_int32(0)
+		self.__call(self.__nidaq.DAQmxWriteAnalogF64, self.__taskHandle[board], int32(periodLength), 0, float64(-1), DAQmx_Val_GroupByScanNumber, data.ctypes.data_as(ctypes.c_void_p), ctypes.byref(sampsWritten), None)
+		logger.info(str(sampsWritten.value) + ' samples written to Dev' + str(board + 1))
+		return sampsWritten.value
+
+	def programmeChannels(self, aodata):
+		'''programme timeframe data to hardware, both boards at once
 		
-		self.CHK(self.__nidaq.DAQmxWriteAnalogF64( self.__taskHandle[0], int32(periodLength), 0, float64(-1), DAQmx_Val_GroupByScanNumber, aodata[0].ctypes.data, ctypes.byref(sampsWritten), None))
-		logger.info(str(sampsWritten.value) + ' samples written to Dev1')
-		self.CHK(self.__nidaq.DAQmxWriteAnalogF64( self.__taskHandle[1], int32(periodLength), 0, float64(-1), DAQmx_Val_GroupByScanNumber, aodata[1].ctypes.data, ctypes.byref(sampsWritten), None))
-		logger.info(str(sampsWritten.value) + ' samples written to Dev2')
+		returns {board: samples written}; raises SetupError with the errors of
+		all boards that failed.'''
+		logger.debug("programming NIDAQ channels")
+		periodLength = len(aodata[0])/8
+		return self.__forEachBoard(lambda board: self.__programmeBoard(board, aodata[board], periodLength))
 
 	def startTask(self):
 		'''start task'''
 		logger.debug('starting NIDAQ tasks')
-		self.CHK(self.__nidaq.DAQmxStartTask(self.__taskHandle[0]))
-		self.CHK(self.__nidaq.DAQmxStartTask(self.__taskHandle[1]))
+		self.__forEachBoard(lambda board: self.__call(self.__nidaq.DAQmxStartTask, self.__taskHandle[board]))
 		self.taskIsRunning = True
 		
 	def stopTask(self):
-		'''stop task'''
+		'''stop task; errors are only logged, so setMode and shutdown can go on'''
 		logger.debug('stopping NIDAQ tasks')
-		self.CHK(self.__nidaq.DAQmxStopTask(self.__taskHandle[0]))
-		self.CHK(self.__nidaq.DAQmxStopTask(self.__taskHandle[1]))
+		try:
+			self.__forEachBoard(lambda board: self.__call(self.__nidaq.DAQmxStopTask, self.__taskHandle[board]))
+		except SetupError as e:
+			logger.error('stopping NIDAQ tasks failed: %s' % e)
 		self.taskIsRunning = False
 
 	def shutdown(self):
-		'''shutdown interface'''
-		self.CHK(self.__nidaq.DAQmxClearTask(self.__taskHandle[0]))
-		self.CHK(self.__nidaq.DAQmxClearTask(self.__taskHandle[1]))
+		'''shutdown interface, clears all prepared tasks'''
+		taskHandles = list(self.__tasks.values())
+		if self.taskIsConfigured and self.__taskKey is None: # initialized, but no mode set
+			taskHandles.append(self.__taskHandle)
+		for taskHandle in taskHandles:
+			self.CHK(self.__nidaq.DAQmxClearTask(taskHandle[0]))
+			self.CHK(self.__nidaq.DAQmxClearTask(taskHandle[1]))
+		self.__tasks = {}
+		self.__taskKey = None
+		if self.__boards is not None:
+			self.__boards.close()
+			self.__boards = None
+		self.__timing = {}
 		self.taskIsConfigured = False
 
 	def setMode(self, mode):
-		'''set mode: direct control or programmed'''
+		'''set mode: direct control or programmed
+		
+		each mode has its own pair of tasks, configured the first time the mode
+		is set and kept until shutdown; switching modes only unreserves the
+		tasks of one and commits those of the other.'''
 		if self.taskIsRunning:
 			self.stopTask()
 
+		key = (mode == MODE_DIRECT and 'direct' or 'timed', self.__channelKey())
+		fresh = self.taskIsConfigured and self.__taskKey is None # the pair initialize created
+		if self.taskIsConfigured and not fresh:
+			if self.__taskKey == key:
+				return
+			self.CHK(self.__nidaq.DAQmxTaskControl(self.__taskHandle[0], DAQmx_Val_Task_Unreserve))
+			self.CHK(self.__nidaq.DAQmxTaskControl(self.__taskHandle[1], DAQmx_Val_Task_Unreserve))
+		if key in self.__tasks:
+			logger.debug('reusing prepared NIDAQ AO tasks')
+			self.__taskHandle = self.__tasks[key]
+		else:
+			# separate tasks per mode, as reconfiguring a task for the other mode gives weird errors
+			if not fresh:
+				self.__taskHandle = self.__createTasks()
+			self.__configureMode(mode)
+			self.__tasks[key] = self.__taskHandle
+		self.__taskKey = key
+		self.taskIsConfigured = True
+		self.CHK(self.__nidaq.DAQmxTaskControl(self.__taskHandle[0], DAQmx_Val_Task_Commit))
+		self.CHK(self.__nidaq.DAQmxTaskControl(self.__taskHandle[1], DAQmx_Val_Task_Commit))
+
+	def __configureMode(self, mode):
+		'''configure buffer, transfer mechanism and timing of new tasks for mode'''
 		devByChannel = {} # we'll need this in either case
 		for k, v in settings['AnalogChannels'].iteritems():
 			keys = devByChannel.setdefault(v.channelNumber, [])
@@ -186,9 +289,6 @@ class NIDAQOutputController:
 		if mode == MODE_DIRECT:
 			# 0 buffer size
 			# not sure if this is the right thing to do
-			self.shutdown()
-			self.initialize()
-			
 			self.CHK(self.__nidaq.DAQmxCfgOutputBuffer(self.__taskHandle[0], ctypes.c_uint32(0)))
 			self.CHK(self.__nidaq.DAQmxCfgOutputBuffer(self.__taskHandle[1], ctypes.c_uint32(0)))
 
@@ -199,11 +299,9 @@ class NIDAQOutputController:
 						logger.error("there was a channel which did not belong to a known device! boardNumber was %d", v.boardNumber)
 					else:
 						self.CHK(self.__nidaq.DAQmxSetAODataXferMech(self.__taskHandle[v.boardNumber], v.GetDeviceString(), DAQmx_Val_ProgrammedIO))
-			self.CHK(self.__nidaq.DAQmxCfgSampClkTiming( self.__taskHandle[0], "ao/SampleClockTimebase", float64(1), DAQmx_Val_Rising, DAQmx_Val_FiniteSamps, uInt64(1)))
-			self.CHK(self.__nidaq.DAQmxCfgSampClkTiming( self.__taskHandle[1], "ao/SampleClockTimebase", float64(1), DAQmx_Val_Rising, DAQmx_Val_FiniteSamps, uInt64(1)))  
+			self.__cfgTiming(0, "ao/SampleClockTimebase", 1, 1)
+			self.__cfgTiming(1, "ao/SampleClockTimebase", 1, 1)
 		else: # we presume all other cases are timeframe-output
-			self.shutdown() # this is ugly, why do I have to shutdown and recreate the task after switching to direct control? but not doing this gives weird errors
-			self.initialize()
 			# extend buffer size
 			# not sure if this is the right thing to do
 			self.CHK(self.__nidaq.DAQmxCfgOutputBuffer(self.__taskHandle[0], ctypes.c_uint32(10**5))) 
@@ -222,11 +320,11 @@ class NIDAQOutputController:
 		'''force direct output'''
 		self.taskIsRunning = True
 		sampsWritten = ctypes.c_int32(0)
-		if (self.CHK(self.__nidaq.DAQmxWriteAnalogF64(self.__taskHandle[0], int32(1), 1, float64(-1), DAQmx_Val_GroupByScanNumber, aodata[0].ctypes.data, ctypes.byref(sampsWritten), None))) > 0:
+		if (self.CHK(self.__nidaq.DAQmxWriteAnalogF64(self.__taskHandle[0], int32(1), 1, float64(-1), DAQmx_Val_GroupByScanNumber, aodata[0].ctypes.data_as(ctypes.c_void_p), ctypes.byref(sampsWritten), None))) > 0:
 			#print sampsWritten, 'samples written on dev1'
 			#print aodata[0]
                         pass
-		if (self.CHK(self.__nidaq.DAQmxWriteAnalogF64(self.__taskHandle[1], int32(1), 1, float64(-1), DAQmx_Val_GroupByScanNumber, aodata[1].ctypes.data, ctypes.byref(sampsWritten), None))) > 0:
+		if (self.CHK(self.__nidaq.DAQmxWriteAnalogF64(self.__taskHandle[1], int32(1), 1, float64(-1), DAQmx_Val_GroupByScanNumber, aodata[1].ctypes.data_as(ctypes.c_void_p), ctypes.byref(sampsWritten), None))) > 0:
 			#print sampsWritten, 'samples written on dev2'
 			#print aodata[1]
                         pass
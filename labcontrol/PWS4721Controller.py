@@ -17,6 +17,9 @@
 ''' Controller for Tektronix PWS4721 Voltage Supply, via VISA. could also control other visa devices'''
 
 
+from labcontrol.StateCache import StateCache
+from labcontrol.Instrumentation import VisaProxy
+
 import logging
 logger = logging.getLogger('labalyzer')
 
@@ -43,6 +46,17 @@ class PWS4721Controller:
 		except:
 			logger.warn("can't load visa driver for PWS4721, using simulator")
 			self.__pws = PWS4721Simulator()
+		self.__pws = StateCache(VisaProxy(self.__pws, 'pws4721'))
+
+	def resync(self):
+		'''forget which settings were sent, after a front panel change or reset'''
+		self.__pws.resync()
+
+	def batch(self, opc=False):
+		'''context in which all commands are collected and sent as compound messages
+		
+		with opc=True, the block only ends when the instrument has processed them'''
+		return self.__pws.batch(opc)
 
 	def startOutput(self,data):
 		voltage=data["Voltage"]
@@ -55,8 +69,9 @@ class PWS4721Controller:
 		
 	
 	def setVoltage(self, voltage):
-		self.__pws.write('VOLTAGE ' + str(voltage))
-		self.__pws.write('OUTPUT ON') # urgs should not be here
+		with self.__pws.batch():
+			self.__pws.write('VOLTAGE ' + str(voltage))
+			self.__pws.write('OUTPUT ON') # urgs should not be here
 
 
 		
@@ -0,0 +1,231 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' configure several instruments at the same time, so a shot's setup takes as long as the slowest instrument'''
+
+import sys
+import threading
+import time
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+import logging
+logger = logging.getLogger('labalyzer')
+
+
+class SetupError(Exception):
+	'''one or more instruments failed or timed out; errors maps instrument name -> exception'''
+	def __init__(self, errors, results):
+		Exception.__init__(self, 'setup failed for ' + ', '.join(['%s (%s)' % (name, errors[name]) for name in sorted(errors)]))
+		self.errors = errors
+		self.results = results # of the instruments that succeeded
+
+
+class SetupTimeout(Exception):
+	'''an instrument did not finish within its timeout'''
+
+
+_abandoned = {} # id of an instrument controller -> its _Job that timed out and is still running
+_abandonedLock = threading.Lock()
+
+
+def _owner(function):
+	'''the controller a bound method belongs to, None for plain functions'''
+	return getattr(function, '__self__', None)
+
+
+class _Job(threading.Thread):
+	'''runs one instrument's setup call
+	
+	a job that timed out is abandoned: when its call finally returns, the
+	controller's resync() is called, as its cached state can't be trusted, and
+	only then can the next setup of that controller start.'''
+	def __init__(self, name, function, args):
+		threading.Thread.__init__(self, name='setup-' + str(name))
+		self.daemon = True # a hanging VISA call must not keep the programme alive
+		self.function = function
+		self.args = args
+		self.result = None
+		self.error = None
+		self.done = False
+		self.abandoned = False
+	
+	def run(self):
+		try:
+			self.result = self.function(*self.args)
+		except Exception:
+			self.error = sys.exc_info()[1]
+		_abandonedLock.acquire()
+		try:
+			if not self.abandoned:
+				self.done = True
+				return
+		finally:
+			_abandonedLock.release()
+		owner = _owner(self.function)
+		logger.warn('abandoned setup %s returned, resyncing its instrument' % self.name)
+		try:
+			getattr(owner, 'resync', lambda: None)()
+		except Exception as e:
+			logger.error('resync after abandoned setup %s failed: %s' % (self.name, e))
+		_abandonedLock.acquire()
+		try:
+			self.done = True
+			if _abandoned.get(id(owner)) is self:
+				del _abandoned[id(owner)]
+		finally:
+			_abandonedLock.release()
+	
+	def finish(self, seconds):
+		'''wait up to seconds for the job; True if it is done, else it is abandoned'''
+		self.join(seconds)
+		_abandonedLock.acquire()
+		try:
+			if self.done:
+				return True
+			self.abandoned = True
+			owner = _owner(self.function)
+			if owner is not None:
+				_abandoned[id(owner)] = self
+			return False
+		finally:
+			_abandonedLock.release()
+
+
+class _PoolJob:
+	'''one call run by a WorkerPool thread'''
+	def __init__(self, function, args):
+		self.function = function
+		self.args = args
+		self.result = None
+		self.error = None
+		self.finished = threading.Event()
+	
+	def run(self):
+		try:
+			self.result = self.function(*self.args)
+		except Exception:
+			self.error = sys.exc_info()[1]
+		self.finished.set()
+
+
+def _limit(timeout, name):
+	'''timeout of job name, timeout being one value for all jobs or a dict name -> timeout'''
+	return timeout.get(name, 5.0) if isinstance(timeout, dict) else timeout
+
+
+def _collect(jobs, started, timeout, finished):
+	'''results and errors of jobs, a dict name -> job; finished(job, seconds) waits for a job'''
+	results = {}
+	errors = {}
+	for name, job in jobs.items():
+		limit = _limit(timeout, name)
+		if not finished(job, max(started + limit - time.time(), 0)):
+			errors[name] = SetupTimeout('no response within %g s' % limit)
+		elif job.error is not None:
+			errors[name] = job.error
+		else:
+			results[name] = job.result
+	return results, errors
+
+
+def runConcurrently(jobs, timeout=5.0):
+	'''run jobs, a dict name -> (function, args), each in its own thread
+	
+	timeout is in s, either one value for all jobs or a dict name -> timeout.
+	ctypes and VISA calls release the GIL while they wait for the hardware, so
+	calls to different buses and drivers overlap; the instruments behind the
+	GPIB-LAN gateway share one bus lock (see VisaSessionPool), so their calls
+	still run one after another. returns a dict name -> return value; raises
+	SetupError with all failures and timeouts once every job has finished or
+	timed out. a job that timed out keeps running, see _Job; the controller's
+	next setup waits for it within its timeout, so setups never overlap.'''
+	started = time.time()
+	threads = {}
+	busy = {}
+	for name, (function, args) in jobs.items():
+		_abandonedLock.acquire()
+		try:
+			previous = _abandoned.get(id(_owner(function)))
+		finally:
+			_abandonedLock.release()
+		if previous is not None:
+			previous.join(max(started + _limit(timeout, name) - time.time(), 0))
+			if not previous.done:
+				busy[name] = SetupTimeout('the previous setup, which timed out, is still running')
+				continue
+		threads[name] = _Job(name, function, args)
+		threads[name].start()
+	results, errors = _collect(threads, started, timeout, lambda job, seconds: job.finish(seconds))
+	errors.update(busy)
+	logger.debug('concurrent setup of %d instruments took %.3f s' % (len(jobs), time.time() - started))
+	if errors:
+		raise SetupError(errors, results)
+	return results
+
+
+def startOutputs(controllers, data, timeout=5.0):
+	'''call startOutput(data[name]) on every controllers[name] at the same time'''
+	return runConcurrently(dict([(name, (controllers[name].startOutput, (data[name],))) for name in data]), timeout)
+
+
+class WorkerPool:
+	'''a few threads that are kept to run jobs like runConcurrently, without starting new threads each time
+	
+	jobs beyond size wait for a free thread. a job that times out keeps its
+	thread busy until it returns.'''
+	def __init__(self, size=2, name='worker'):
+		self.__queue = queue.Queue()
+		self.__threads = []
+		for i in range(size):
+			thread = threading.Thread(target=self.__work, name='%s-%d' % (name, i))
+			thread.daemon = True
+			thread.start()
+			self.__threads.append(thread)
+	
+	def __work(self):
+		while True:
+			job = self.__queue.get()
+			if job is None:
+				break
+			job.run()
+	
+	def run(self, jobs, timeout=5.0):
+		'''run jobs, a dict name -> (function, args), on the pool; returns and raises like runConcurrently'''
+		started = time.time()
+		pending = {}
+		for name, (function, args) in jobs.items():
+			pending[name] = _PoolJob(function, args)
+			self.__queue.put(pending[name])
+		def finished(job, seconds):
+			job.finished.wait(seconds)
+			return job.finished.is_set()
+		results, errors = _collect(pending, started, timeout, finished)
+		if errors:
+			raise SetupError(errors, results)
+		return results
+	
+	def close(self, timeout=1.0):
+		'''let the threads end once the queued jobs are done, waiting up to timeout s for them'''
+		for _ in self.__threads:
+			self.__queue.put(None)
+		deadline = time.time() + timeout
+		for thread in self.__threads:
+			thread.join(max(deadline - time.time(), 0))
+		self.__threads = []
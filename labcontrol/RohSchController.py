@@ -19,23 +19,100 @@
 ''' Controller for Rhode Schwarz microwave source, via VISA. could also control other visa devices'''
 
 import logging
+from labcontrol.VisaSessionPool import pool
+from labcontrol.StateCache import StateCache, ALL_SETTINGS
+from labcontrol.Instrumentation import VisaProxy
 import numpy as np
 import math
 import os
 import sys
 
+# settings the R&S source may change by itself when one of them is set
+COUPLED_SETTINGS = {'SOUR:FREQ:MODE': ALL_SETTINGS, 'APPL': ALL_SETTINGS}
+
+class PowerCalibration:
+    '''source power (dBm) needed at a given frequency (Hz), interpolated from a calibration table
+    
+    outside the table, extrapolation is 'clamp' (use the power of the nearest
+    point), 'linear' (continue the slope of the outermost two points) or
+    'error' (raise ValueError).'''
+    def __init__(self, frequencies, powers, extrapolation='clamp'):
+        if extrapolation not in ('clamp', 'linear', 'error'):
+            raise ValueError('unknown extrapolation policy ' + repr(extrapolation))
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        order = np.argsort(frequencies)
+        self.frequencies = frequencies[order]
+        self.powers = np.asarray(powers, dtype=np.float64)[order]
+        self.extrapolation = extrapolation
+
+    @classmethod
+    def fromFile(cls, fileName, extrapolation='clamp'):
+        '''read a table with frequency (MHz) and power (dBm) columns, as in ressources/'''
+        table = np.loadtxt(fileName, delimiter=',', skiprows=1, ndmin=2)
+        return cls(table[:, 0]*10**6, table[:, 1], extrapolation)
+
+    def getPowers(self, frequencies):
+        '''calibrated powers for an array of frequencies, e.g. a whole scan'''
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        powers = np.interp(frequencies, self.frequencies, self.powers)
+        outside = (frequencies < self.frequencies[0]) | (frequencies > self.frequencies[-1])
+        if not outside.any():
+            return powers
+        if self.extrapolation == 'error':
+            raise ValueError('frequencies outside of calibration range %g - %g Hz' % (self.frequencies[0], self.frequencies[-1]))
+        if self.extrapolation == 'linear' and len(self.frequencies) > 1:
+            below = frequencies < self.frequencies[0]
+            above = frequencies > self.frequencies[-1]
+            slopeLow = (self.powers[1] - self.powers[0])/(self.frequencies[1] - self.frequencies[0])
+            slopeHigh = (self.powers[-1] - self.powers[-2])/(self.frequencies[-1] - self.frequencies[-2])
+            powers[below] = self.powers[0] + slopeLow*(frequencies[below] - self.frequencies[0])
+            powers[above] = self.powers[-1] + slopeHigh*(frequencies[above] - self.frequencies[-1])
+        return powers
+
+    def getPower(self, frequency):
+        '''calibrated power for a single frequency'''
+        return float(self.getPowers(frequency))
+
+
 class RohSchSimulator:
-    '''simulator, if visa is not present'''
+    '''simulator, if visa is not present
+    
+    keeps track of an uploaded frequency/power list and its current index;
+    trigger() emulates a pulse on the trigger input.'''
     #pylint: disable=C0321,C0111,R0913,C0103,W0613
     def __init__(self):
         self.lastCommand = None
+        self.listFrequencies = []
+        self.listPowers = []
+        self.listIndex = 0
+        self.mode = 'CW'
 
     def read(self):
+        if self.lastCommand and self.lastCommand.split(';')[-1].lstrip(':') == 'SOUR:LIST:IND?':
+            return str(self.listIndex)
         return None
 
     def write(self, string):
         '''visa command write function'''
         self.lastCommand = string
+        for command in string.split(';'):
+            command = command.strip().lstrip(':')
+            if command.startswith('SOUR:LIST:FREQ '):
+                self.listFrequencies = [float(f) for f in command.split(' ', 1)[1].split(',')]
+            elif command.startswith('SOUR:LIST:POW '):
+                self.listPowers = [float(p) for p in command.split(' ', 1)[1].split(',')]
+            elif command == 'SOUR:LIST:RES':
+                self.listIndex = 0
+            elif command.startswith('SOUR:FREQ:MODE '):
+                self.mode = command.split(' ', 1)[1]
+                self.listIndex = 0
+            elif command == 'SOUR:LIST:TRIG:EXEC':
+                self.trigger()
+
+    def trigger(self):
+        '''step to the next list entry, as a trigger pulse would in list step mode'''
+        if self.mode == 'LIST' and self.listFrequencies:
+            self.listIndex = (self.listIndex + 1) % len(self.listFrequencies)
 
 
 class RohSchController:
@@ -46,20 +123,22 @@ class RohSchController:
         elif logID == 'starkalyzer':
             self.logger=logging.getLogger('starkalyzer')
         try:
-            import visa #pylint: disable=F0401
             # try-clause
             
-            self.__rohsch = visa.instrument('TCPIP0::10.0.0.3::gpib0,28::INSTR', timeout = 1)
+            self.__rohsch = pool.handle('TCPIP0::10.0.0.3::gpib0,28::INSTR', timeout = 1, lazy = True)
             self.logger.warn("RohSch function generator loaded")
         except:
             self.logger.warn("can't load visa driver for RohSch function generator, using simulator")
             self.__rohsch = RohSchSimulator()
+        self.__rohsch = StateCache(VisaProxy(self.__rohsch, 'rohsch'), COUPLED_SETTINGS)
 
-    def initialize(self):
-        '''hardware initialization'''
+    def initialize(self, extrapolation='clamp'):
+        '''hardware initialization
+        
+        extrapolation is the PowerCalibration policy for frequencies outside the calibration table'''
         localfolder = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
         file_name = os.path.join(localfolder, "ressources/rsCalibrationCurve1.2mW.csv")
-        self.__table = np.loadtxt(file_name, delimiter=',', skiprows=1)
+        self.__calibration = PowerCalibration.fromFile(file_name, extrapolation)
         self.__rohsch.write('*RST;*CLS')
         self.__rohsch.write('OUTP:STAT ON')
         self.__rohsch.write('POW ' + str(-12.0) + 'dBm')
@@ -73,6 +152,16 @@ class RohSchController:
         self.setFrequency(self.__startFreq)
         
 
+    def resync(self):
+        '''forget which settings were sent, after a front panel change or reset'''
+        self.__rohsch.resync()
+
+    def batch(self, opc=False):
+        '''context in which all commands are collected and sent as compound messages
+        
+        with opc=True, the block only ends when the instrument has processed them'''
+        return self.__rohsch.batch(opc)
+
     def startOutput(self,data):
         freq = data["Freq"] #in Hz
         output = data["Power"] # in dBm
@@ -83,43 +172,70 @@ class RohSchController:
 
         if mode is True:
             self.logger.debug("Automatic output power mode activated for R&S")
-            count = 0
-            point_found = False
-            
-            for point in self.__table:
-                point_freq = point[0] * 10**6
-                if point_freq > freq and not point_found:
-                    #linear interpolation
-                    y1 = self.__table[count - 1][1]
-                    y2 = point[1]
-                    x1 = self.__table[count - 1][0]
-                    x2 = point[0]
-
-                    point_found = True
-
-                    power = y1 + ((y2-y1)/(x2-x1)) * (freq * 10**(-6) - x1)
-                    
-                elif point_freq == freq:
-                    power = point[1]
-                    point_found = True
-                    
-                count += 1
+            power = self.__calibration.getPower(freq)
         else:
             power=output
 
         self.logger.debug("R&S will be ramped from "+str(self.__startFreq)+"Hz to " +str(freq) +"Hz and output power set to " + str(power) +" dBm")
-        self.setPower(power)
-        self.setFrequency(freq)
+        with self.__rohsch.batch():
+            self.setPower(power)
+            self.setFrequency(freq)
         
         
 
+    def uploadList(self, frequencies, powers=None, trigger='EXT', dwell=0.01):
+        '''upload a whole scan as instrument list and switch to list mode
+        
+        frequencies in Hz; powers in dBm, calibrated powers are used if None.
+        each trigger pulse (trigger='EXT'), or each advanceList() call
+        (trigger='SING'), steps to the next point without further SCPI traffic.
+        call stopList before using startOutput/setFrequency again.'''
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        if powers is None:
+            powers = self.calibratedPowers(frequencies)
+        powers = np.asarray(powers, dtype=np.float64)
+        if len(frequencies) != len(powers) or len(frequencies) == 0:
+            raise ValueError('need the same, non-zero number of frequencies and powers')
+        with self.__rohsch.batch():
+            self.__rohsch.write('SOUR:LIST:SEL "labcontrol"')
+            self.__rohsch.write('SOUR:LIST:FREQ ' + ','.join(['%.3f' % f for f in frequencies]))
+            self.__rohsch.write('SOUR:LIST:POW ' + ','.join(['%.2f' % p for p in powers]))
+            self.__rohsch.write('SOUR:LIST:DWEL ' + str(dwell))
+            self.__rohsch.write('SOUR:LIST:MODE STEP')
+            self.__rohsch.write('SOUR:LIST:TRIG:SOUR ' + trigger)
+            self.__rohsch.write('SOUR:FREQ:MODE LIST')
+            self.__rohsch.write('SOUR:LIST:LEAR')
+            self.__rohsch.write('SOUR:LIST:RES')
+        self.logger.debug("R&S list with " + str(len(frequencies)) + " points uploaded")
+
+    def advanceList(self):
+        '''step to the next list point by software trigger'''
+        self.__rohsch.write('SOUR:LIST:TRIG:EXEC')
+
+    def resetList(self):
+        '''go back to the first list point'''
+        self.__rohsch.write('SOUR:LIST:RES')
+
+    def getListIndex(self):
+        '''index of the current list point'''
+        return int(self.__rohsch.ask('SOUR:LIST:IND?'))
+
+    def stopList(self):
+        '''leave list mode and go back to the stepped sweep used by setFrequency'''
+        self.__rohsch.write('SOUR:FREQ:MODE SWE')
+
+    def calibratedPowers(self, frequencies):
+        '''calibrated output powers (dBm) for all frequencies (Hz) of a scan, computed at once'''
+        return self.__calibration.getPowers(frequencies)
+
     def setFrequency(self, frequency):
 ##        self.__rohsch.write('FREQ ' + str(frequency))
-        self.__rohsch.write('SOUR:FREQ:STAR ' + str(self.__startFreq))
-        self.__rohsch.write('SOUR:FREQ:STOP ' + str(frequency))
-        self.__startFreq=frequency
-        self.logger.debug("R&S sweep start frequency set to " + str(self.__startFreq))
-        self.__rohsch.write('TRIG')
+        with self.__rohsch.batch():
+            self.__rohsch.write('SOUR:FREQ:STAR ' + str(self.__startFreq))
+            self.__rohsch.write('SOUR:FREQ:STOP ' + str(frequency))
+            self.__startFreq=frequency
+            self.logger.debug("R&S sweep start frequency set to " + str(self.__startFreq))
+            self.__rohsch.write('TRIG')
         
 
     def setPower(self, power):
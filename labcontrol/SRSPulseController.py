@@ -17,17 +17,110 @@
 ''' Controller for Agilent 33250A Function Generator, via VISA. could also control other visa devices'''
 
 import logging
+from labcontrol.VisaSessionPool import pool
+from labcontrol.StateCache import StateCache
+from labcontrol.Instrumentation import VisaProxy
 from labalyzer import constants
 
+# trigger, output level and impedance setup, sent before the delays
+SETUP_COMMANDS = ["TM 1",   # set trigger to Ext (external)
+                  "OM 4,0", # set AB output channel to TTL
+                  "OM 7,0", # set CD output channel to TTL
+                  "TZ 0,0", # set Trigger input impendance to 50 Ohm
+                  "TZ 4,0", # set AB output impendance to 50 Ohm
+                  "TZ 7,1"] # set CD output impendance to High
+
+
+def _delayCommands(cdFirst, delay, ab, cd):
+    '''DT commands as (channel, command): the later of the AB and CD pulses is delayed by delay (ns, as string)'''
+    if cdFirst:
+        return [(5, "DT 5,1,0"),
+                (6, "DT 6,5," + str(cd) + "E-9"),
+                (2, "DT 2,1," + delay + "E-9"),
+                (3, "DT 3,2," + str(ab) + "E-9")]
+    return [(2, "DT 2,1,0"),
+            (3, "DT 3,2," + str(ab) + "E-9"),
+            (5, "DT 5,1," + delay + "E-9"),
+            (6, "DT 6,5," + str(cd) + "E-9")]
+
+
+def delayCommands(srsPulseSettings):
+    '''DT commands as (channel, command) for the settings startOutput takes'''
+    if srsPulseSettings["PulseLength"] == 0:
+        RD = srsPulseSettings["RelativeDelay"] + constants.DELAY_REDBLUE
+        if RD < 0:
+            return _delayCommands(True, str(RD * -1.0), srsPulseSettings["ABPulseLength"], srsPulseSettings["CDPulseLength"])
+        return _delayCommands(RD == 0, str(RD), srsPulseSettings["ABPulseLength"], srsPulseSettings["CDPulseLength"])
+    if srsPulseSettings["RelativeDelay"] <= 0:
+        return _delayCommands(True, str(srsPulseSettings["RelativeDelay"] * -1.0 + constants.DELAY_REDBLUE), srsPulseSettings["PulseLength"], srsPulseSettings["PulseLength"])
+    return _delayCommands(False, str(srsPulseSettings["RelativeDelay"] + constants.DELAY_REDBLUE), srsPulseSettings["PulseLength"], srsPulseSettings["PulseLength"])
+
+
+class DelayScanProgramme:
+    '''delay scan compiled to the DT commands each point needs
+    
+    steps[i] holds only the commands of point order[i] whose channel delay
+    differs from the step before; steps[0] also holds SETUP_COMMANDS. with
+    reorder=True, the points are visited in an order that greedily minimizes
+    the number of changed channels between consecutive steps.'''
+    def __init__(self, points, reorder=False):
+        commands = [dict(delayCommands(point)) for point in points]
+        self.order = list(range(len(points)))
+        if reorder and points:
+            self.order = self.__reorder(commands)
+        self.points = [points[i] for i in self.order]
+        self.__commands = [delayCommands(point) for point in self.points]
+        self.steps = []
+        previous = {}
+        for i, current in enumerate(self.__commands):
+            step = [command for channel, command in current if previous.get(channel) != command]
+            if i == 0:
+                step = SETUP_COMMANDS + step
+            self.steps.append(step)
+            previous = dict(current)
+
+    @staticmethod
+    def __reorder(commands):
+        '''greedy nearest neighbour order, starting with the first point'''
+        def distance(a, b):
+            return len([c for c in a if a[c] != b.get(c)])
+        remaining = list(range(1, len(commands)))
+        order = [0]
+        while remaining:
+            nearest = min(remaining, key=lambda i: (distance(commands[i], commands[order[-1]]), i))
+            remaining.remove(nearest)
+            order.append(nearest)
+        return order
+
+    def __len__(self):
+        return len(self.steps)
+
+    def fullCommands(self, step):
+        '''all commands needed to set step, regardless of the step before'''
+        return SETUP_COMMANDS + [command for channel, command in self.__commands[step]]
+
+    def noCommands(self):
+        '''number of commands sent when running all steps in order'''
+        return sum([len(step) for step in self.steps])
+
+
 class SRSPulseSimulator:
-    '''simulator, if visa is not present'''
+    '''simulator, if visa is not present
+    
+    keeps the delay (reference channel, delay) of every channel that was set'''
     #pylint: disable=C0321,C0111,R0913,C0103,W0613
     def __init__(self):
         self.lastCommand = None
+        self.delays = {}
 
     def write(self, string):
         '''visa command write function'''
         self.lastCommand = string
+        for command in string.split(';'):
+            command = command.strip()
+            if command.startswith('DT '):
+                channel, reference, delay = command[3:].split(',')
+                self.delays[int(channel)] = (int(reference), delay)
 
 
 class SRSPulseController:
@@ -38,13 +131,14 @@ class SRSPulseController:
         elif logID == 'starkalyzer':
                         self.logger=logging.getLogger('starkalyzer')
         try:
-            import visa #pylint: disable=F0401
             # try-clause
-            self.__pulse = visa.instrument('TCPIP0::10.0.0.3::gpib0,15::INSTR', timeout = 1)
+            self.__pulse = pool.handle('TCPIP0::10.0.0.3::gpib0,15::INSTR', timeout = 1, lazy = True)
             self.logger.warn("SRS pulse generator loaded")
         except:
             self.logger.warn("can't load visa driver for SRS Pulse generator, using simulator")
             self.__pulse = SRSPulseSimulator()
+        self.__pulse = StateCache(VisaProxy(self.__pulse, 'srs'), keyArgs=1, separator=';', opcQuery=None)
+        self.__scanStep = None # (programme, step) last run by runDelayScanStep
 
 
     def initialize(self):
@@ -52,75 +146,65 @@ class SRSPulseController:
         pass
 
 
-    def startOutput(self, srsPulseSettings):
-        self.__pulse.write("TM 1")    # set trigger to Ext (external)
-        self.__pulse.write("OM 4,0")  # set AB output channel to TTL
-        self.__pulse.write("OM 7,0")  # set CD output channel to TTL
-        self.__pulse.write("TZ 0,0")  # set Trigger input impendance to 50 Ohm
-        self.__pulse.write("TZ 4,0")  # set AB output impendance to 50 Ohm
-        self.__pulse.write("TZ 7,1")  # set CD output impendance to High
-
-        RD = srsPulseSettings["RelativeDelay"] + constants.DELAY_REDBLUE
-        if srsPulseSettings["PulseLength"] == 0:
-            if RD < 0:
-                self.__pulse.write("DT 5,1,0")
-                self.__pulse.write("DT 6,5," + str(srsPulseSettings["CDPulseLength"]) + "E-9")
-                self.__pulse.write("DT 2,1," + str(RD * -1.0) + "E-9")
-                self.__pulse.write("DT 3,2," + str(srsPulseSettings["ABPulseLength"]) + "E-9")
-
-            elif RD == 0:
-                self.__pulse.write("DT 5,1,0")
-                self.__pulse.write("DT 6,5," + str(srsPulseSettings["CDPulseLength"]) + "E-9")
-                self.__pulse.write("DT 2,1," + str(RD) + "E-9")
-                self.__pulse.write("DT 3,2," + str(srsPulseSettings["ABPulseLength"]) + "E-9")
-
-            elif RD > 0:
-                self.__pulse.write("DT 2,1,0")
-                self.__pulse.write("DT 3,2," + str(srsPulseSettings["ABPulseLength"]) + "E-9")
-                self.__pulse.write("DT 5,1," + str(RD) + "E-9")
-                self.__pulse.write("DT 6,5," + str(srsPulseSettings["CDPulseLength"]) + "E-9")
-
-        else:
-            if srsPulseSettings["RelativeDelay"] <= 0:
-                self.__pulse.write("DT 5,1,0")
-                self.__pulse.write("DT 6,5," + str(srsPulseSettings["PulseLength"]) + "E-9")
-                self.__pulse.write("DT 2,1," + str(srsPulseSettings["RelativeDelay"] * -1.0 + constants.DELAY_REDBLUE) + "E-9")
-                self.__pulse.write("DT 3,2," + str(srsPulseSettings["PulseLength"]) + "E-9")
+    def resync(self):
+        '''forget which settings were sent, after a front panel change or reset'''
+        self.__pulse.resync()
+        self.__scanStep = None
 
-            elif srsPulseSettings["RelativeDelay"] > 0:
-                self.__pulse.write("DT 2,1,0")
-                self.__pulse.write("DT 3,2," + str(srsPulseSettings["PulseLength"]) + "E-9")
-                self.__pulse.write("DT 5,1," + str(srsPulseSettings["RelativeDelay"] + constants.DELAY_REDBLUE) + "E-9")
-                self.__pulse.write("DT 6,5," + str(srsPulseSettings["PulseLength"]) + "E-9")
+    def batch(self, opc=False):
+        '''context in which all commands are collected and sent as compound messages
+        
+        with opc=True, the block only ends when the instrument has processed them'''
+        return self.__pulse.batch(opc)
 
+    def startOutput(self, srsPulseSettings):
+        with self.__pulse.batch():
+            for command in SETUP_COMMANDS:
+                self.__pulse.write(command)
+            for channel, command in delayCommands(srsPulseSettings):
+                self.__pulse.write(command)
+        self.__scanStep = None
 
 
     def preparePulse(self, channel_conf, mode):
-        if mode == "Ext":
-            self.__pulse.write("TM 1")    # set trigger to Ext (external)
-            self.logger.debug("External mode initialized")
-
-        elif mode == "SS":
-            self.__pulse.write("TM 2")    # set trigger to SS (single shot)
-            self.logger.debug("Single shot mode initialized")
-
-        self.__pulse.write("OM 4,0")  # set AB output channel to TTL
-        self.__pulse.write("OM 7,0")  # set CD output channel to TTL
-        self.__pulse.write("TZ 0,0")  # set Trigger input impendance to 50 Ohm
-        self.__pulse.write("TZ 4,0")  # set AB output impendance to 50 Ohm
-        self.__pulse.write("TZ 7,1")  # set CD output impendance to High
-
-        if channel_conf["RD"] <= 0:
-            self.__pulse.write("DT 5,1,0")
-            self.__pulse.write("DT 6,5," + str(channel_conf["CD"]) + "E-9")
-            self.__pulse.write("DT 2,1," + str(channel_conf["RD"] * -1.0) + "E-9")
-            self.__pulse.write("DT 3,2," + str(channel_conf["AB"]) + "E-9")
-
-        elif channel_conf["RD"] > 0:
-            self.__pulse.write("DT 2,1,0")
-            self.__pulse.write("DT 3,2," + str(channel_conf["AB"]) + "E-9")
-            self.__pulse.write("DT 5,1," + str(channel_conf["RD"]) + "E-9")
-            self.__pulse.write("DT 6,5," + str(channel_conf["CD"]) + "E-9")
+        with self.__pulse.batch():
+            if mode == "Ext":
+                self.__pulse.write("TM 1")    # set trigger to Ext (external)
+                self.logger.debug("External mode initialized")
+
+            elif mode == "SS":
+                self.__pulse.write("TM 2")    # set trigger to SS (single shot)
+                self.logger.debug("Single shot mode initialized")
+
+            for command in SETUP_COMMANDS[1:]:
+                self.__pulse.write(command)
+
+            if channel_conf["RD"] <= 0:
+                commands = _delayCommands(True, str(channel_conf["RD"] * -1.0), channel_conf["AB"], channel_conf["CD"])
+            else:
+                commands = _delayCommands(False, str(channel_conf["RD"]), channel_conf["AB"], channel_conf["CD"])
+            for channel, command in commands:
+                self.__pulse.write(command)
+        self.__scanStep = None
+
+    def compileDelayScan(self, points, reorder=False):
+        '''precompile a scan over a list of startOutput settings, see DelayScanProgramme'''
+        return DelayScanProgramme(points, reorder)
+
+    def runDelayScanStep(self, programme, step):
+        '''set the delays of step of a compiled scan
+        
+        run right after the step before, only the precompiled changed delays are
+        written; otherwise (first step, other order, after resync or other
+        settings) all commands of the step go through the state cache.'''
+        if step > 0 and self.__scanStep == (programme, step - 1):
+            commands = programme.steps[step]
+        else:
+            commands = programme.fullCommands(step)
+        with self.__pulse.batch():
+            for command in commands:
+                self.__pulse.write(command)
+        self.__scanStep = (programme, step)
 
     def sendPulse(self):
         self.__pulse.write("SS")
@@ -17,36 +17,282 @@
 ''' Controller for Tektronix 3054C, via VISA. could also control other visa devices'''
 
 # from labalyzer.LabalyzerSettings import settings
-from array import array
+from collections import namedtuple
+import calendar
+import re
+import time
+import numpy
+from labcontrol.Instrumentation import VisaProxy
 
 import logging
 logger = logging.getLogger('labalyzer')
 
+MEASUREMENT_SLOTS = 4 # MEASU:MEAS<x> slots of the TDS3000 series
+MEASUREMENT_INVALID = 9.9E37 # value the scope returns if a measurement can't be made
+
+# fields of the WFMP? response, in the order the scope sends them
+Preamble = namedtuple('Preamble', ['byteWidth', 'bitWidth', 'encoding', 'binaryFormat', 'byteOrder',
+	'noPoints', 'waveformID', 'pointFormat', 'xIncr', 'ptOff', 'xZero', 'xUnit',
+	'yMult', 'yZero', 'yOff', 'yUnit'])
+
+def parsePreamble(response):
+	'''parse the response to WFMP? into a Preamble'''
+	fields = [f.strip('"') for f in re.findall(r'"[^"]*"|[^;]+', response.strip())]
+	if len(fields) != len(Preamble._fields):
+		raise ValueError('unexpected waveform preamble: ' + repr(response))
+	return Preamble(int(fields[0]), int(fields[1]), fields[2], fields[3], fields[4],
+		int(fields[5]), fields[6], fields[7], float(fields[8]), int(fields[9]), float(fields[10]), fields[11],
+		float(fields[12]), float(fields[13]), float(fields[14]), fields[15])
+
+
+def parseBlockHeader(data, start=0):
+	'''parse an IEEE 488.2 definite length block header ("#<n><length>") at position start
+	
+	returns (offset, length) of the payload in data'''
+	if len(data) < start + 2 or data[start:start + 1] != b'#':
+		raise ValueError('not a binary block')
+	noDigits = int(data[start + 1:start + 2])
+	if noDigits == 0:
+		# indefinite length block, runs until the terminating newline
+		length = len(data) - start - 2
+		if data[-1:] == b'\n':
+			length -= 1
+		return start + 2, length
+	length = int(data[start + 2:start + 2 + noDigits])
+	if len(data) < start + 2 + noDigits + length:
+		raise ValueError('binary block is truncated')
+	return start + 2 + noDigits, length
+
+
+def splitResponse(data):
+	'''split the response to a compound query (answers separated by ';') into fields
+	
+	binary blocks and strings may contain ';', so they are skipped as a whole.
+	returns a list of (start, end) spans into data, one per field'''
+	spans = []
+	pos = 0
+	while pos < len(data):
+		if data[pos:pos + 1] == b'#':
+			offset, length = parseBlockHeader(data, pos)
+			end = offset + length
+		else:
+			end = pos
+			if data[pos:pos + 1] == b'"': # quoted strings may contain ';' as well
+				end = data.find(b'"', pos + 1) + 1
+				if end == 0:
+					raise ValueError('unterminated string in response')
+			end = data.find(b';', end)
+			if end < 0:
+				end = len(data)
+		spans.append((pos, end))
+		pos = end + 1 # skip the separator
+	if spans and data[spans[-1][0]:spans[-1][0] + 1] != b'#':
+		start, end = spans[-1]
+		spans[-1] = (start, start + len(data[start:end].rstrip()))
+	return spans
+
+
+def decodeCurve(data, yMult, yOff, y0, width=2, dtype=numpy.float64, start=0, out=None):
+	'''convert a CURVE? block (signed, LSB first) at position start to scaled values, without copying the raw data
+	
+	if out is given, the values are written into it and it has to match the record length'''
+	offset, length = parseBlockHeader(data, start)
+	raw = numpy.frombuffer(data, dtype='<i%d' % width, count=length // width, offset=offset)
+	if out is None:
+		values = raw.astype(dtype)
+	else:
+		if out.shape != raw.shape:
+			raise ValueError('record length %d does not match output length %d' % (len(raw), len(out)))
+		values = out
+		values[...] = raw
+	values -= yOff
+	values *= yMult
+	values += y0
+	return values
+
+
+def parseTimestamps(response):
+	'''parse the response to HOR:FAST:TIMESTAMP:ALL:<wfm>? into seconds relative to the first frame
+	
+	timestamps look like "02 Mar 2009 20:44:30.788194390"; seconds and fractions are
+	subtracted separately to keep the sub-microsecond resolution.'''
+	seconds = []
+	fractions = []
+	for stamp in re.findall(r'"([^"]*)"', response):
+		whole, fraction = stamp.strip().split('.')
+		seconds.append(calendar.timegm(time.strptime(whole, '%d %b %Y %H:%M:%S')))
+		fractions.append(float('0.' + fraction))
+	if not seconds:
+		raise ValueError('no frame timestamps in response')
+	return (numpy.array(seconds, dtype=numpy.float64) - seconds[0]) + (numpy.array(fractions) - fractions[0])
+
+
+class TimeAxis:
+	'''time axis of a trace, x0 + xIncr*i; only computed when it is needed'''
+	def __init__(self, x0, xIncr, length):
+		self.x0 = x0
+		self.xIncr = xIncr
+		self.length = length
+	
+	def __len__(self):
+		return self.length
+	
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return self.__array__()[index]
+		if index < 0:
+			index += self.length
+		if not 0 <= index < self.length:
+			raise IndexError('time axis index out of range')
+		return self.x0 + self.xIncr*index
+	
+	def __iter__(self):
+		return iter(self.__array__())
+	
+	def __array__(self, dtype=None, copy=None):
+		values = self.x0 + self.xIncr*numpy.arange(self.length, dtype=numpy.float64)
+		if dtype is not None:
+			values = values.astype(dtype)
+		return values
+
+
 class ScopeSimulator:
-	'''simulator, if visa is not present'''
+	'''simulator, if visa is not present
+	
+	produces noisy traces with gaussian pulses for any record length and data
+	width, with a preamble that matches the transferred data. pulses is a list
+	of (position, height, width): position and width as fractions of the record,
+	height in divisions; noise is the rms noise in divisions. latency (s per
+	command) and bandwidth (bytes/s) model the bus, for offline benchmarking.'''
 	#pylint: disable=C0321,C0111,R0913,C0103,W0613 
-	def __init__(self):
+	def __init__(self, recordLength=10000, pulses=((0.3, 2.0, 0.01),), noise=0.05, latency=0., bandwidth=None, seed=None):
 		self.lastCommand = None
+		self.settings = {'HOR:FAST:STATE': 'OFF', 'HOR:FAST:COUN': '1', 'DAT:FRAMESTAR': '1', 'DAT:FRAMESTOP': '1',
+			'DAT:WID': '2', 'DAT:STAR': '1', 'DAT:STOP': str(recordLength), 'DAT:SOU': 'CH1',
+			'HOR:RECO': str(recordLength), 'HOR:SCA': '4.0E-5'}
+		self.pulses = pulses
+		self.noise = noise
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.triggerPosition = 0.204 # fraction of the record before the trigger
+		self.framePeriod = 1e-3 # s between emulated FastFrame triggers
+		self.random = numpy.random.RandomState(seed)
 	
 	def read(self): 
 		'''visa command read function'''
-		if self.lastCommand == 'WFMP?':
+		if ';' in self.lastCommand:
+			# compound command, answer every query in it
+			responses = [self.respond(c.lstrip(':')) for c in self.lastCommand.split(';')]
+			response = ';'.join([r for r in responses if r is not None])
+		else:
+			response = self.respond(self.lastCommand)
+		self.wait(response and len(response) or 0)
+		return response
+	def respond(self, command):
+		'''response to a single query'''
+		if command == 'WFMP?':
 			# return waveform header
-			return '2;16;BIN;RI;LSB;10000;"Ch1, DC coupling, 1.0E-3 V/div, 4.0E-5 s/div, 10000 points, Sample mode";Y;4.0E-8;0;-8.16E-5;"s";1.5625E-7;0.0E0;7.424E3;"V"'
-		elif self.lastCommand == 'CURVE?':
-			# return waveform data
-			ar = array('h', 10000*[0])
-			return '#520000' + ar.tostring()
-		elif self.lastCommand == 'WFMP:XZERO?': return '-8.16E-5'
-		elif self.lastCommand == 'WFMP:XINCR?': return '4.0E-8'
-		elif self.lastCommand == 'WFMP:YZERO?': return '0.0E0'
-		elif self.lastCommand == 'WFMP:YMULT?': return '1.5625E-7'
-		elif self.lastCommand == 'WFMP:YOFF?': return '7.424E3'
+			return '%d;%d;BIN;RI;LSB;%d;"Ch%d, DC coupling, %.1E V/div, %.1E s/div, %d points, Sample mode";Y;%.6E;0;%.6E;"s";%.6E;0.0E0;%.6E;"V"' % (
+				self.width(), 8*self.width(), self.noPoints(), self.channel(), self.scale(), float(self.settings['HOR:SCA']),
+				self.recordLength(), self.xIncr(), self.xZero(), self.yMult(), self.yOff())
+		elif command == 'CURVE?':
+			# return waveform data, one record per frame in FastFrame mode
+			start = int(self.settings['DAT:STAR']) - 1
+			records = [self.digitize(self.trace(self.channel()))[start:start + self.noPoints()] for _ in range(self.noFrames())]
+			payload = numpy.concatenate(records).astype('<i%d' % self.width()).tostring()
+			length = str(len(payload))
+			return '#' + str(len(length)) + length + payload
+		elif command.startswith('HOR:FAST:TIMESTAMP:ALL:'):
+			t0 = 1234567890
+			stamps = []
+			for frame in range(int(self.settings['DAT:FRAMESTAR']) - 1, int(self.settings['DAT:FRAMESTAR']) - 1 + self.noFrames()):
+				t = frame*self.framePeriod
+				stamps.append('"%s.%09d"' % (time.strftime('%d %b %Y %H:%M:%S', time.gmtime(t0 + int(t))), int(round((t - int(t))*1e9))))
+			return ','.join(stamps)
+		elif command == 'ACQ:STATE?': return '0' # acquisition is always complete
+		elif command.startswith('MEASU:MEAS') and command.endswith(':VAL?'):
+			return '%g' % self.measure(command[len('MEASU:MEAS'):-len(':VAL?')])
+		elif command == 'WFMP:XZERO?': return '%.6E' % self.xZero()
+		elif command == 'WFMP:XINCR?': return '%.6E' % self.xIncr()
+		elif command == 'WFMP:YZERO?': return '0.0E0'
+		elif command == 'WFMP:YMULT?': return '%.6E' % self.yMult()
+		elif command == 'WFMP:YOFF?': return '%.6E' % self.yOff()
 		else:
 			return None
+	def wait(self, noBytes):
+		'''emulate bus latency and bandwidth'''
+		delay = self.latency
+		if self.bandwidth:
+			delay += 1.*noBytes/self.bandwidth
+		if delay > 0:
+			time.sleep(delay)
+	def channel(self):
+		return int(self.settings['DAT:SOU'].upper().lstrip('CH'))
+	def scale(self, channel=None):
+		'''vertical scale in V/div'''
+		return float(self.settings.get('CH%d:SCA' % (channel or self.channel()), '1.0E-3'))
+	def position(self, channel=None):
+		'''vertical position in divisions'''
+		return float(self.settings.get('CH%d:POS' % (channel or self.channel()), '-1.16'))
+	def width(self):
+		return int(self.settings['DAT:WID'])
+	def recordLength(self):
+		return int(self.settings['HOR:RECO'])
+	def xIncr(self):
+		return float(self.settings['HOR:SCA'])*10/self.recordLength()
+	def xZero(self):
+		'''time of the first transferred point'''
+		return (int(self.settings['DAT:STAR']) - 1 - self.triggerPosition*self.recordLength())*self.xIncr()
+	def yMult(self, channel=None):
+		# 25 digitizer levels per division, 16 bit samples carry 8 more bits
+		return self.scale(channel)/25/256**(self.width() - 1)
+	def yOff(self, channel=None):
+		return -self.position(channel)*25*256**(self.width() - 1)
+	def trace(self, channel):
+		'''one acquisition of channel in V'''
+		n = self.recordLength()
+		x = numpy.arange(n, dtype=numpy.float64)/n
+		divisions = self.noise*self.random.standard_normal(n)
+		for position, height, width in self.pulses:
+			divisions += height*numpy.exp(-0.5*((x - position)/width)**2)
+		return divisions*self.scale(channel)
+	def digitize(self, volts):
+		'''convert a trace to the integer levels CURVE? transfers'''
+		limit = 2**(8*self.width() - 1)
+		return numpy.clip(numpy.round(volts/self.yMult() + self.yOff()), -limit, limit - 1)
+	def measure(self, slot):
+		'''value of measurement slot, from a fresh acquisition of its source'''
+		prefix = 'MEASU:MEAS' + slot
+		if self.settings.get(prefix + ':STATE') != 'ON':
+			return MEASUREMENT_INVALID
+		volts = self.trace(int(self.settings.get(prefix + ':SOU1', 'CH1').upper().lstrip('CH')))
+		typ = self.settings.get(prefix + ':TYP', '')
+		if typ in ('AMP', 'PK2'): return volts.max() - volts.min()
+		elif typ in ('MEAN', 'CMEAN'): return volts.mean()
+		elif typ == 'MAX': return volts.max()
+		elif typ == 'MINI': return volts.min()
+		elif typ in ('RMS', 'CRMS'): return numpy.sqrt((volts**2).mean())
+		elif typ == 'ARE': return volts.sum()*self.xIncr()
+		return MEASUREMENT_INVALID
+	def noPoints(self):
+		'''number of points per record CURVE? returns, within DAT:STAR/DAT:STOP'''
+		return max(min(int(self.settings['DAT:STOP']), self.recordLength()) - int(self.settings['DAT:STAR']) + 1, 0)
+	def noFrames(self):
+		'''number of frames CURVE? returns, emulating FastFrame memory'''
+		if self.settings['HOR:FAST:STATE'] != 'ON':
+			return 1
+		first = int(self.settings['DAT:FRAMESTAR'])
+		last = min(int(self.settings['DAT:FRAMESTOP']), int(self.settings['HOR:FAST:COUN']))
+		return max(last - first + 1, 0)
 	def write(self, string): 
 		'''visa command write function'''
 		self.lastCommand = string
+		for command in string.split(';'):
+			command = command.lstrip(':')
+			if ' ' in command and not command.endswith('?'):
+				header, value = command.split(' ', 1)
+				self.settings[header.upper()] = value
+		self.wait(len(string))
 
 
 class ScopeController:
@@ -59,6 +305,13 @@ class ScopeController:
 		except ImportError:
 			logger.warn("can't load visa/Scope driver, using simulator")
 			self.__scope = ScopeSimulator()
+		self.__scope = VisaProxy(self.__scope, 'scope')
+		self.__preambles = {} # (channel, width, window) -> Preamble, valid until a setting of that channel changes
+		self.__dataFormat = None # (width, window) last sent to the scope
+		self.__settings = {} # (channel, command) -> last value sent
+		self.__source = None
+		self.__noFrames = None # number of armed FastFrame frames
+		self.__noMeasurements = 0 # number of configured MEASU slots
 		#except:
 		#	self.__scope = ScopeSimulator()
 		#	print "UNDIAGNOSED SCOPE PROBLEM"
@@ -66,43 +319,331 @@ class ScopeController:
 
 	def initialize(self):
 		'''hardware initialization'''
-		self.__scope.write('DAT:WID 2')
+		self.invalidatePreamble()
+		self.__setDataFormat(2, None)
 		self.__scope.write('DAT:ENC SRI')
 		
 	
-	def getTrace(self, channel):
-		'''measure trace from scope, using channel number "channel"'''
+	def invalidatePreamble(self, channel=None):
+		'''forget the cached waveform preamble of channel (all channels if None)
+
+		call this after settings were changed on the front panel'''
+		if channel is None:
+			self.__preambles.clear()
+			self.__settings.clear()
+			self.__source = None
+			self.__dataFormat = None
+		else:
+			self.__dropPreambles(channel)
+			for key in [k for k in self.__settings if k[0] == channel]:
+				del self.__settings[key]
+
+	def __dropPreambles(self, channel):
+		'''remove the cached preambles of channel, for all data formats'''
+		for key in [k for k in self.__preambles if k[0] == channel]:
+			del self.__preambles[key]
+
+	def __setSetting(self, channel, command, value, invalidates=True):
+		'''send a setting, invalidating the cached preamble(s) only if it actually changed'''
+		key = (channel, command)
+		if self.__settings.get(key) == value:
+			return
+		self.__scope.write(command + ' ' + str(value))
+		self.__settings[key] = value
+		if not invalidates:
+			return
+		if channel is None: # horizontal settings affect all channels
+			self.__preambles.clear()
+		else:
+			self.__dropPreambles(channel)
+
+	def setVerticalScale(self, channel, voltsPerDiv):
+		'''set vertical scale of channel in V/div'''
+		self.__setSetting(channel, 'CH%d:SCA' % channel, voltsPerDiv)
+
+	def setVerticalPosition(self, channel, divisions):
+		'''set vertical position of channel in divisions'''
+		self.__setSetting(channel, 'CH%d:POS' % channel, divisions)
+
+	def setVerticalOffset(self, channel, offset):
+		'''set vertical offset of channel in V'''
+		self.__setSetting(channel, 'CH%d:OFFS' % channel, offset)
+
+	def setHorizontalScale(self, secondsPerDiv):
+		'''set horizontal scale in s/div'''
+		self.__setSetting(None, 'HOR:SCA', secondsPerDiv)
+
+	def setRecordLength(self, noPoints):
+		'''set horizontal record length in points'''
+		self.__setSetting(None, 'HOR:RECO', noPoints)
+
+	def __selectSource(self, channel):
+		'''point DAT:SOU to channel, if it isn't already'''
+		if self.__source != channel:
+			self.__scope.write('DAT:SOU Ch' + str(channel))
+			self.__source = channel
+
+	def __setDataFormat(self, width, window):
+		'''set transfer width (1 or 2 bytes) and sample window, sending only what changed
+		
+		window is (start, stop), 0-based with stop excluded, or None for the whole record'''
+		if width not in (1, 2):
+			raise ValueError('data width has to be 1 or 2 bytes, not %r' % (width,))
+		if window is not None:
+			start, stop = window
+			if start < 0 or stop <= start:
+				raise ValueError('invalid sample window %r' % (window,))
+			window = (int(start), int(stop))
+		if self.__dataFormat == (width, window):
+			return
+		oldWidth, oldWindow = self.__dataFormat or (None, ())
+		commands = []
+		if width != oldWidth:
+			commands.append('DAT:WID %d' % width)
+		if window != oldWindow:
+			if window is None: # the scope clips DAT:STOP to the record length
+				commands.append('DAT:STAR 1;:DAT:STOP 1000000000')
+			else:
+				commands.append('DAT:STAR %d;:DAT:STOP %d' % (window[0] + 1, window[1]))
+		self.__scope.write(';:'.join(commands))
+		self.__dataFormat = (width, window)
+
+	def __currentFormat(self):
+		'''(width, window) of the transfers, the default one is set if none was sent yet'''
+		if self.__dataFormat is None:
+			self.__setDataFormat(2, None)
+		return self.__dataFormat
+
+	def getPreamble(self, channel):
+		'''waveform preamble of channel, queried with a single WFMP? only if it is not cached
+		
+		preambles are cached per data width and window, as these change the preamble'''
+		key = (channel,) + self.__currentFormat()
+		preamble = self.__preambles.get(key)
+		if preamble is None:
+			self.__selectSource(channel)
+			self.__scope.write('WFMP?')
+			preamble = parsePreamble(self.__scope.read())
+			self.__preambles[key] = preamble
+		return preamble
+
+	def getPreambles(self, channels):
+		'''waveform preambles of several channels; all missing ones are queried in one compound message
+		
+		returns (preambles, errors), dicts keyed by channel'''
+		dataFormat = self.__currentFormat()
+		missing = [c for c in channels if (c,) + dataFormat not in self.__preambles]
+		errors = {}
+		if missing:
+			self.__scope.write(';:'.join(['DAT:SOU Ch%d;:WFMP?' % c for c in missing]))
+			self.__source = missing[-1]
+			response = self.__scope.read()
+			try:
+				allSpans = splitResponse(response)
+			except ValueError:
+				allSpans = []
+			noFields = len(Preamble._fields)
+			for i, c in enumerate(missing):
+				try:
+					spans = allSpans[i*noFields:(i + 1)*noFields]
+					self.__preambles[(c,) + dataFormat] = parsePreamble(response[spans[0][0]:spans[-1][1]])
+				except (IndexError, ValueError) as e:
+					errors[c] = 'no valid preamble: ' + str(e)
+		preambles = dict([(c, self.__preambles[(c,) + dataFormat]) for c in channels if (c,) + dataFormat in self.__preambles])
+		return preambles, errors
+
+	def getTraces(self, channels, dtype=numpy.float64, window=None, width=2):
+		'''measure traces of several channels with a single compound CURVE? transaction
+		
+		window and width are used as in getTrace.
+		returns (x, y, errors): x is the TimeAxis shared by all channels, y is a
+		(channels x samples) array in the order of channels, and errors maps each
+		channel that could not be read to a message; its row in y is NaN.'''
+		try: 
+			import visa #pylint: disable=F0401
+			visaError = visa.VisaIOError
+		except ImportError:
+			visaError = ()
+		channels = list(channels)
+		try:
+			self.__setDataFormat(width, window)
+			preambles, errors = self.getPreambles(channels)
+			readable = [c for c in channels if c in preambles]
+			if not readable:
+				return None, None, errors
+			self.__scope.write(';:'.join(['DAT:SOU Ch%d;:CURVE?' % c for c in readable]))
+			self.__source = readable[-1]
+			response = self.__scope.read()
+		except visaError:
+			logger.error('Timeout occured while acquiring scope data!. Make sure there is a trace to acquire!')
+			return None, None, dict([(c, 'VISA timeout') for c in channels])
+
+		try:
+			spans = splitResponse(response)
+		except ValueError as e: # a corrupt block makes everything after it unreadable
+			spans = []
+			logger.warn("ERROR splitting scope data: " + str(e))
+		reference = preambles[readable[0]]
+		yvalues = None
+		for i, c in enumerate(readable):
+			preamble = preambles[c]
+			try:
+				start = spans[i][0]
+				if yvalues is None:
+					noPoints = parseBlockHeader(response, start)[1] // preamble.byteWidth
+					yvalues = numpy.empty((len(channels), noPoints), dtype=dtype)
+					yvalues.fill(numpy.nan)
+					reference, referenceChannel = preamble, c
+				if (preamble.xIncr, preamble.xZero, preamble.ptOff) != (reference.xIncr, reference.xZero, reference.ptOff):
+					raise ValueError('horizontal settings differ from channel %d' % referenceChannel)
+				decodeCurve(response, preamble.yMult, preamble.yOff, preamble.yZero, preamble.byteWidth, dtype, start, yvalues[channels.index(c)])
+			except (IndexError, ValueError) as e:
+				logger.warn("ERROR converting scope data of channel %d: %s" % (c, e))
+				errors[c] = str(e)
+		if yvalues is None:
+			return None, None, errors
+		xvalues = TimeAxis(reference.xZero - reference.ptOff*reference.xIncr, reference.xIncr, yvalues.shape[1])
+		return xvalues, yvalues, errors
+
+	def armFrames(self, noFrames):
+		'''arm a FastFrame (segmented memory) acquisition of noFrames triggers
+		
+		needs a scope with FastFrame support (DPO/MSO series); the scope then
+		captures one record per trigger without any VISA traffic until getFrames.'''
+		self.__setSetting(None, 'HOR:FAST:STATE', 'ON')
+		self.__setSetting(None, 'HOR:FAST:COUN', noFrames)
+		self.__noFrames = noFrames
+		self.__setSetting(None, 'ACQ:STOPA', 'SEQ', False)
+		self.__scope.write('ACQ:STATE RUN')
+
+	def disableFrames(self):
+		'''go back to one record per acquisition, acquiring continuously'''
+		self.__setSetting(None, 'HOR:FAST:STATE', 'OFF')
+		self.__setSetting(None, 'ACQ:STOPA', 'RUNST', False)
+		self.__scope.write('ACQ:STATE RUN')
+		self.__noFrames = None
+
+	def isAcquiring(self):
+		'''True while the armed acquisition has not captured all frames'''
+		self.__scope.write('ACQ:STATE?')
+		return self.__scope.read().strip() not in ('0', 'STOP')
+
+	def getFrames(self, channel, dtype=numpy.float64, width=2):
+		'''fetch all frames captured since armFrames in one transfer
+		
+		the whole record of every frame is transferred, with width bytes per sample.
+		returns (x, y, timestamps): x is the TimeAxis of a single frame, y is a
+		(frames x samples) array and timestamps holds the trigger time of every
+		frame in s, relative to the first one.'''
+		try: 
+			import visa #pylint: disable=F0401
+			visaError = visa.VisaIOError
+		except ImportError:
+			visaError = ()
+		if self.__noFrames is None:
+			logger.error('FastFrame acquisition was not armed, call armFrames first')
+			return None, None, None
+		try:
+			self.__setDataFormat(width, None)
+			preamble = self.getPreamble(channel)
+			self.__scope.write('DAT:SOU Ch%d;:DAT:FRAMESTAR 1;:DAT:FRAMESTOP %d;:CURVE?;:HOR:FAST:TIMESTAMP:ALL:CH%d?' % (channel, self.__noFrames, channel))
+			self.__source = channel
+			response = self.__scope.read()
+		except visaError:
+			logger.error('Timeout occured while acquiring scope frames! Make sure all triggers arrived!')
+			return None, None, None
+		try:
+			spans = splitResponse(response)
+			yvalues = decodeCurve(response, preamble.yMult, preamble.yOff, preamble.yZero, preamble.byteWidth, dtype, spans[0][0])
+			yvalues = yvalues.reshape((self.__noFrames, -1))
+		except (IndexError, ValueError) as e:
+			logger.warn("ERROR converting scope frames: " + str(e))
+			return None, None, None
+		try:
+			timestamps = parseTimestamps(response[spans[1][0]:spans[1][1]])
+		except (IndexError, ValueError) as e:
+			logger.warn("could not read frame timestamps: " + str(e))
+			timestamps = None
+		xvalues = TimeAxis(preamble.xZero - preamble.ptOff*preamble.xIncr, preamble.xIncr, yvalues.shape[1])
+		return xvalues, yvalues, timestamps
+
+	def configureMeasurements(self, measurements):
+		'''set up on-instrument measurements, as a list of (channel, type) tuples
+		
+		type is a MEASU:MEAS<x>:TYP value, e.g. 'AMP', 'MEAN', 'ARE' or 'PK2'. only
+		slots whose configuration changed are written, so this is cheap to repeat.'''
+		if len(measurements) > MEASUREMENT_SLOTS:
+			raise ValueError('the scope has only %d measurement slots' % MEASUREMENT_SLOTS)
+		for slot, (channel, typ) in enumerate(measurements):
+			prefix = 'MEASU:MEAS%d' % (slot + 1)
+			self.__setSetting(None, prefix + ':SOU1', 'CH%d' % channel, False)
+			self.__setSetting(None, prefix + ':TYP', typ.upper(), False)
+			self.__setSetting(None, prefix + ':STATE', 'ON', False)
+		for slot in range(len(measurements), MEASUREMENT_SLOTS):
+			self.__setSetting(None, 'MEASU:MEAS%d:STATE' % (slot + 1), 'OFF', False)
+		self.__noMeasurements = len(measurements)
+
+	def getMeasurements(self):
+		'''read all configured measurements with one compound query
+		
+		returns an array with one value per configured measurement, NaN where
+		the scope could not make the measurement, or None on a VISA error.'''
+		try: 
+			import visa #pylint: disable=F0401
+			visaError = visa.VisaIOError
+		except ImportError:
+			visaError = ()
+		if not self.__noMeasurements:
+			logger.error('no scope measurements configured, call configureMeasurements first')
+			return None
+		try:
+			self.__scope.write(';:'.join(['MEASU:MEAS%d:VAL?' % (slot + 1) for slot in range(self.__noMeasurements)]))
+			response = self.__scope.read()
+		except visaError:
+			logger.error('Timeout occured while reading scope measurements!')
+			return None
+		values = numpy.empty(self.__noMeasurements)
+		values.fill(numpy.nan)
+		for i, field in enumerate(response.strip().split(';')[:self.__noMeasurements]):
+			try:
+				value = float(field)
+			except ValueError:
+				logger.warn("ERROR converting scope measurement: " + repr(field))
+				continue
+			if value < MEASUREMENT_INVALID:
+				values[i] = value
+		return values
+
+	def getTrace(self, channel, dtype=numpy.float64, window=None, width=2):
+		'''measure trace from scope, using channel number "channel"
+		
+		window = (start, stop) transfers only samples start to stop-1 of the record
+		(DAT:STAR/DAT:STOP), width = 1 transfers 8 bit samples instead of 16 bit,
+		e.g. for low resolution monitoring.
+		returns (x, y), where y is a numpy array of type dtype (use numpy.float32
+		to halve memory for long records) and x is a TimeAxis, which is only
+		turned into an array when it is actually used.'''
 		try: 
 			import visa #urgh, that's what I get for importing modules in __init__
+			visaError = visa.VisaIOError
 		except ImportError:
-			pass
+			visaError = ()
 		try:
-			self.__scope.write('DAT:SOU Ch' + str(channel))
-			self.__scope.write('WFMP:XZERO?')
-			x0 = float(self.__scope.read())
-			self.__scope.write('WFMP:XINCR?')
-			xIncr = float(self.__scope.read())
-			self.__scope.write('WFMP:YZERO?')
-			y0 = float(self.__scope.read())
-			self.__scope.write('WFMP:YMULT?')
-			yMult = float(self.__scope.read())
-			self.__scope.write('WFMP:YOFF?')
-			yOff = float(self.__scope.read())
+			self.__setDataFormat(width, window)
+			preamble = self.getPreamble(channel)
+			self.__selectSource(channel)
 
 			self.__scope.write('CURVE?')
 			data = self.__scope.read()
-			startIndex = 2 + int(data[1]) # there is a 'second header' of sorts, saying how long the data is; we don't need it.
-			yval = array('h')
 			try:
-				yval.fromstring(data[startIndex:])
+				yvalues = decodeCurve(data, preamble.yMult, preamble.yOff, preamble.yZero, preamble.byteWidth, dtype)
 			except ValueError:
 				logger.warn("ERROR converting scope data!")
 				return None, None
 		
-			xvalues = [x0 + xIncr*x for x in range(10000)]
-			yvalues = [(y - yOff)*yMult + y0 for y in yval]
+			xvalues = TimeAxis(preamble.xZero - preamble.ptOff*preamble.xIncr, preamble.xIncr, len(yvalues))
 			return xvalues, yvalues
-		except visa.VisaIOError:
+		except visaError:
 			logger.error('Timeout occured while acquiring scope data!. Make sure there is a trace to acquire!')
 			return None
 
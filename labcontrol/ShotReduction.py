@@ -0,0 +1,109 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' on-line reduction of analog input shots: running mean and variance of the traces and of gated integrals'''
+
+import numpy
+
+import logging
+logger = logging.getLogger('starkalyzer')
+
+
+class ShotReducer:
+	'''accumulates (channels x samples) records shot by shot, without keeping them
+	
+	keeps the running mean and variance of every sample (if traces is set) and,
+	for each gate name -> (start, stop) in samples, of the per channel integral
+	over samples start to stop-1 (in V*s if samplesPerSecond is given, else the
+	sum). memory does not grow with the number of shots, unless keepRaw is set,
+	in which case a copy of every record is appended to records.'''
+	def __init__(self, noChannels, noSamples, gates=None, samplesPerSecond=None, traces=True, keepRaw=False):
+		self.noChannels = noChannels
+		self.noSamples = noSamples
+		self.gates = dict(gates or {})
+		for name, (start, stop) in self.gates.items():
+			if not 0 <= start < stop <= noSamples:
+				raise ValueError('gate %s (%d, %d) is not within the %d samples of a record' % (name, start, stop, noSamples))
+		self.dt = samplesPerSecond and 1./samplesPerSecond or 1.
+		self.traces = traces
+		self.keepRaw = keepRaw
+		self.reset()
+	
+	def reset(self):
+		'''forget all shots'''
+		self.noShots = 0
+		self.records = []
+		self.lastGates = {} # gate name -> integrals of the last shot
+		if self.traces:
+			self.__mean = numpy.zeros((self.noChannels, self.noSamples))
+			self.__m2 = numpy.zeros((self.noChannels, self.noSamples)) # sum of squared deviations
+			self.__delta = numpy.empty((self.noChannels, self.noSamples))
+			self.__temp = numpy.empty((self.noChannels, self.noSamples))
+		self.__gateMean = dict([(name, numpy.zeros(self.noChannels)) for name in self.gates])
+		self.__gateM2 = dict([(name, numpy.zeros(self.noChannels)) for name in self.gates])
+	
+	def add(self, record):
+		'''add one shot, a (channels x samples) array'''
+		record = numpy.asarray(record)
+		if record.shape != (self.noChannels, self.noSamples):
+			raise ValueError('expected a record of shape %s, got %s' % ((self.noChannels, self.noSamples), record.shape))
+		self.noShots += 1
+		n = self.noShots
+		if self.traces:
+			# Welford's update, without allocating
+			numpy.subtract(record, self.__mean, self.__delta)
+			numpy.multiply(self.__delta, 1./n, self.__temp)
+			self.__mean += self.__temp
+			numpy.subtract(record, self.__mean, self.__temp)
+			self.__temp *= self.__delta
+			self.__m2 += self.__temp
+		for name, (start, stop) in self.gates.items():
+			value = record[:, start:stop].sum(axis=1)*self.dt
+			self.lastGates[name] = value
+			delta = value - self.__gateMean[name]
+			self.__gateMean[name] += delta/n
+			self.__gateM2[name] += delta*(value - self.__gateMean[name])
+		if self.keepRaw:
+			self.records.append(record.copy())
+	
+	def mean(self):
+		'''mean trace, (channels x samples)'''
+		return self.__mean.copy()
+	
+	def variance(self, ddof=1):
+		'''variance of every sample over the shots, (channels x samples)'''
+		if self.noShots <= ddof:
+			return numpy.zeros_like(self.__m2)
+		return self.__m2/(self.noShots - ddof)
+	
+	def gateMean(self, name):
+		'''mean integral of gate name, per channel'''
+		return self.__gateMean[name].copy()
+	
+	def gateVariance(self, name, ddof=1):
+		'''variance of the integral of gate name over the shots, per channel'''
+		if self.noShots <= ddof:
+			return numpy.zeros(self.noChannels)
+		return self.__gateM2[name]/(self.noShots - ddof)
+	
+	def summary(self):
+		'''{'shots': n, gate name: (mean, standard error) per channel}'''
+		result = {'shots': self.noShots}
+		for name in self.gates:
+			error = numpy.sqrt(self.gateVariance(name)/max(self.noShots, 1))
+			result[name] = (self.gateMean(name), error)
+		return result
@@ -0,0 +1,174 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' on-disk spool of acquired (channels x samples) records: appended by a background writer, read back as memmap views'''
+
+import json
+import os
+import threading
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+import numpy
+
+import logging
+logger = logging.getLogger('starkalyzer')
+
+MAGIC = b'LCSPOOL1'
+HEADER_SIZE = 4096 # the data starts here, the JSON header is padded to it
+
+
+def _writeHeader(f, header):
+	text = json.dumps(header, sort_keys=True).encode('ascii')
+	if len(MAGIC) + len(text) + 1 > HEADER_SIZE:
+		raise ValueError('spool header too long, %d bytes' % len(text))
+	f.seek(0)
+	f.write(MAGIC + text + b'\n' + b' '*(HEADER_SIZE - len(MAGIC) - len(text) - 1))
+
+
+def readHeader(path):
+	'''the header of a spool file, as a dict'''
+	f = open(path, 'rb')
+	try:
+		block = f.read(HEADER_SIZE)
+	finally:
+		f.close()
+	if not block.startswith(MAGIC):
+		raise ValueError('%s is not a shot spool' % path)
+	return json.loads(block[len(MAGIC):].split(b'\n', 1)[0].decode('ascii'))
+
+
+class SpoolWriter:
+	'''appends records to a spool file from a background thread
+	
+	the header holds the channel names and ranges, the sample rate and the
+	trigger position (in samples, None for records not aligned to a trigger);
+	records are written back to back after it.
+	append copies the record and returns right away; when more than queueSize
+	records wait to be written, it blocks. the writer writes up to chunkShots
+	queued records at once.'''
+	def __init__(self, path, channels, ranges, samplesPerSecond, noSamples, triggerPosition=0, dtype=numpy.float64, queueSize=64, chunkShots=16):
+		self.path = path
+		self.header = {'channels': list(channels), 'ranges': [list(r) for r in ranges], 'samplesPerSecond': samplesPerSecond,
+			'noSamples': noSamples, 'triggerPosition': triggerPosition, 'dtype': numpy.dtype(dtype).str, 'shots': 0}
+		self.shape = (len(self.header['channels']), noSamples)
+		self.dtype = numpy.dtype(dtype)
+		self.chunkShots = chunkShots
+		self.noShots = 0 # records written to disk
+		self.__queue = queue.Queue(queueSize)
+		self.__error = None
+		self.closed = False # no more records are accepted
+		self.__file = open(path, 'w+b')
+		_writeHeader(self.__file, self.header)
+		self.__writer = threading.Thread(target=self.__write, name='spool writer ' + os.path.basename(path))
+		self.__writer.daemon = True
+		self.__writer.start()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+	
+	def append(self, record):
+		'''queue a (channels x samples) record for writing'''
+		if self.closed:
+			raise ValueError('spool %s is closed' % self.path)
+		if self.__error is not None:
+			raise IOError('writing spool %s failed: %s' % (self.path, self.__error))
+		record = numpy.asarray(record)
+		if record.shape != self.shape:
+			raise ValueError('expected a record of shape %s, got %s' % (self.shape, record.shape))
+		self.__queue.put(numpy.array(record, dtype=self.dtype)) # the caller may reuse its buffer
+	
+	def __write(self):
+		'''writer thread'''
+		done = False
+		while not done:
+			records = [self.__queue.get()]
+			while len(records) < self.chunkShots:
+				try:
+					records.append(self.__queue.get_nowait())
+				except queue.Empty:
+					break
+			if records[-1] is None:
+				records.pop()
+				done = True
+			if self.__error is not None:
+				continue # keep draining, so append doesn't block
+			try:
+				self.__file.seek(0, os.SEEK_END)
+				for record in records:
+					self.__file.write(record.tobytes())
+				self.__file.flush()
+				self.noShots += len(records)
+			except Exception as e:
+				logger.error('writing spool %s failed: %s' % (self.path, e))
+				self.__error = e
+	
+	def close(self):
+		'''write the remaining records and the final header'''
+		if self.__file is None:
+			return
+		self.closed = True
+		self.__queue.put(None)
+		self.__writer.join()
+		self.header['shots'] = self.noShots
+		_writeHeader(self.__file, self.header)
+		self.__file.close()
+		self.__file = None
+		logger.debug('spooled %d shots to %s' % (self.noShots, self.path))
+		if self.__error is not None:
+			raise IOError('writing spool %s failed: %s' % (self.path, self.__error))
+
+
+class SpoolReader:
+	'''read access to a spool file; shots are memmap views, nothing is loaded until used
+	
+	the number of shots is taken from the file size, so a spool that is still
+	being written can be read; refresh() picks up records written since.'''
+	def __init__(self, path):
+		self.path = path
+		self.header = readHeader(path)
+		self.dtype = numpy.dtype(str(self.header['dtype']))
+		self.shape = (len(self.header['channels']), self.header['noSamples'])
+		self.refresh()
+	
+	def refresh(self):
+		shotSize = self.dtype.itemsize*self.shape[0]*self.shape[1]
+		self.noShots = (os.path.getsize(self.path) - HEADER_SIZE)//shotSize
+		self.__data = None
+		if self.noShots > 0:
+			self.__data = numpy.memmap(self.path, self.dtype, 'r', HEADER_SIZE, (self.noShots,) + self.shape)
+	
+	def __len__(self):
+		return self.noShots
+	
+	def __getitem__(self, index):
+		'''shot index, or shots start:stop, as memmap views'''
+		if self.__data is None:
+			raise IndexError('spool %s is empty' % self.path)
+		return self.__data[index]
+	
+	def shots(self, start=0, stop=None):
+		'''(shots x channels x samples) memmap view of shots start to stop-1'''
+		return self[start:stop]
+	
+	def channel(self, name):
+		'''index of channel name'''
+		return self.header['channels'].index(name)
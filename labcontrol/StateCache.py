@@ -0,0 +1,202 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' write-through cache of instrument settings, suppresses SCPI commands that would not change anything,
+and collects commands into compound messages'''
+
+from contextlib import contextmanager
+
+ALL_SETTINGS = '*' # in a coupling table: the command may change every other setting
+
+
+class StateCache:
+	'''wraps a visa instrument (or its simulator) and remembers the last value sent for each setting
+	
+	a command "HEADER value" is only written if value differs from the one sent
+	before. commands without a value (TRIG, SS, *CLS, ...) and queries are always
+	written. keyArgs is the number of leading comma separated arguments that
+	select the setting instead of being its value (1 for "DT 5,1,0" on the SRS
+	DG535), if there are more arguments than that. coupled maps a header to the
+	headers whose cached values become unknown when it is sent, because the
+	instrument may change them as well; ALL_SETTINGS forgets everything. *RST
+	and resync() clear the whole cache.
+	
+	inside a batch() block, writes are collected and sent as compound messages
+	joined by separator, each at most maxLength characters long.'''
+	def __init__(self, instrument, coupled=None, keyArgs=0, separator=';:', maxLength=256, opcQuery='*OPC?'):
+		self.instrument = instrument
+		self.coupled = coupled or {}
+		self.keyArgs = keyArgs
+		self.separator = separator
+		self.maxLength = maxLength
+		self.opcQuery = opcQuery # None if the instrument has no operation complete query
+		self.__state = {}
+		self.__pending = None # commands collected in a batch
+		self.__depth = 0 # nesting level of batch()
+		self.sent = 0 # number of commands actually written
+		self.suppressed = 0 # number of commands dropped because nothing would change
+		self.messages = 0 # number of messages written to the instrument
+
+	def __getattr__(self, name):
+		# everything but write (read, ask, timeout, ...) goes straight to the instrument
+		return getattr(self.instrument, name)
+	
+	def resync(self):
+		'''forget all cached settings, e.g. after a front panel change'''
+		self.__state.clear()
+	
+	def __parse(self, command):
+		'''split command into (key, value); value is None for commands that are not settings'''
+		command = command.strip()
+		if '?' in command or ' ' not in command:
+			return command.lstrip(':').upper(), None
+		header, value = command.split(None, 1)
+		header = header.lstrip(':').upper()
+		args = value.split(',')
+		if self.keyArgs and len(args) > self.keyArgs:
+			header = header + ' ' + ','.join(args[:self.keyArgs])
+			value = ','.join(args[self.keyArgs:])
+		return header, value.strip()
+	
+	def __forgetCoupled(self, key):
+		'''drop settings the instrument may have changed when key was sent'''
+		header = key.split(' ')[0]
+		if header in ('*RST', '*RCL'):
+			self.__state.clear()
+			return
+		coupled = self.coupled.get(header, self.coupled.get(header.split(':')[0], ()))
+		if coupled == ALL_SETTINGS:
+			self.__state.clear()
+			return
+		for other in coupled:
+			for k in [k for k in self.__state if k.split(' ')[0] == other]:
+				del self.__state[k]
+	
+	def write(self, string):
+		'''visa command write function, drops the parts of string that are already set'''
+		parts = []
+		for command in string.split(';'):
+			key, value = self.__parse(command)
+			if value is not None and self.__state.get(key) == value:
+				self.suppressed += 1
+				continue
+			parts.append(command)
+			self.__forgetCoupled(key)
+			if value is not None:
+				self.__state[key] = value
+		if not parts:
+			return
+		if self.__pending is None:
+			self.__send(';'.join(parts), len(parts))
+		else:
+			self.__pending.extend(parts)
+			if '?' in string: # the caller is going to read the answer
+				self.__flush()
+	
+	def ask(self, string):
+		'''write a query and read its answer, after the commands collected so far'''
+		if self.__pending:
+			self.__flush()
+		return self.instrument.ask(string)
+	
+	def writeBlock(self, header, data):
+		'''write header followed by data as a definite length binary block
+		
+		binary data may contain any byte, so it bypasses the cache; a pending
+		batch is sent first to keep the order of commands.'''
+		if self.__pending:
+			self.__flush()
+		key = header.strip().lstrip(':').upper()
+		self.__forgetCoupled(key)
+		self.__state.pop(key, None)
+		length = str(len(data))
+		self.__send(header + ' #' + str(len(length)) + length + data, 1)
+	
+	def __send(self, message, noCommands, query=False):
+		'''write one message to the instrument; a query message is sent with ask, its answer is returned'''
+		try:
+			if query:
+				answer = self.instrument.ask(message)
+			else:
+				self.instrument.write(message)
+		except:
+			# we don't know what arrived, so don't trust the cache any more
+			self.resync()
+			raise
+		self.sent += noCommands
+		self.messages += 1
+		if query:
+			return answer
+	
+	def __join(self, message, command):
+		'''append command to a compound message'''
+		command = command.strip().lstrip(':')
+		if command.startswith('*'): # common commands don't take a path
+			return message + ';' + command
+		return message + self.separator + command
+	
+	def __flush(self, query=False):
+		'''send the collected commands in as few messages as maxLength allows
+		
+		with query, the last message ends with a query and its answer is returned.'''
+		message = None
+		noCommands = 0
+		for command in self.__pending:
+			if message is None:
+				message, noCommands = command, 1
+				continue
+			joined = self.__join(message, command)
+			if len(joined) > self.maxLength:
+				self.__send(message, noCommands)
+				message, noCommands = command, 1
+			else:
+				message = joined
+				noCommands += 1
+		self.__pending = []
+		if message is not None:
+			return self.__send(message, noCommands, query)
+	
+	@contextmanager
+	def batch(self, opc=False):
+		'''collect all writes of a with-block and send them when it ends
+		
+		with opc=True the last message ends with an operation complete query,
+		so the block only returns when the instrument has processed everything.
+		if the block raises, nothing is sent and the cache is cleared.'''
+		if self.__pending is None:
+			self.__pending = []
+		self.__depth += 1
+		try:
+			yield self
+		except:
+			self.__depth -= 1
+			if self.__depth == 0:
+				self.__pending = None
+				self.resync()
+			raise
+		self.__depth -= 1
+		if self.__depth > 0:
+			return
+		try:
+			if opc and self.opcQuery:
+				# the answer only comes when everything is processed
+				self.__pending.append(self.opcQuery)
+				self.__flush(True)
+			else:
+				self.__flush()
+		finally:
+			self.__pending = None
@@ -18,6 +18,7 @@
 
 
 from labalyzer.LabalyzerSettings import settings
+from labcontrol.Instrumentation import LibraryProxy, argValue
 import ctypes
 
 import time # only for testing purposes
@@ -25,6 +26,9 @@ import time # only for testing purposes
 import logging
 logger = logging.getLogger('labalyzer')
 
+# bytes moved by the calls that transfer data, for the I/O metrics; a scan is 6 16 bit words
+PAYLOAD_BYTES = {'DIO64_Out_Write': lambda args: 12 * argValue(args[2])}
+
 ##############################
 # Setup some typedefs and constants
 
@@ -119,6 +123,7 @@ class ViewpointController:
 			logger.warn("can't load DIO driver, using simulator!")
 			self.__dio = ViewpointSimulator()
 			self.simulate = True
+		self.__dio = LibraryProxy(self.__dio, 'dio64', PAYLOAD_BYTES)
 
 	def initialize(self):
 		'''initialize dio64 hardware'''
@@ -147,7 +152,7 @@ class ViewpointController:
 
 		self._timeframeLength = (diodata[-6]	| diodata[-5] << 16)/settings['DigitalSamplesPerMillisecond']
 		self.__dio.DIO64_Out_Status(0, ctypes.byref(scansAvailable), ctypes.byref(dioStatus)) # necessary?
-		self.__dio.DIO64_Out_Write(0, diodata.ctypes.data, len(diodata)/6, ctypes.byref(dioStatus))
+		self.__dio.DIO64_Out_Write(0, diodata.ctypes.data_as(ctypes.c_void_p), len(diodata)/6, ctypes.byref(dioStatus))
 
 	def start(self):
 		'''start exection of programmed data'''
@@ -0,0 +1,164 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' pool of VISA sessions, shared by the controllers of instruments behind the GPIB-LAN gateway'''
+
+import threading
+
+import logging
+logger = logging.getLogger('labalyzer')
+
+# VISA status codes after which the session is known to be gone, so a write can't have arrived
+VI_ERROR_INV_OBJECT = -1073807346 # session was closed
+VI_ERROR_CONN_LOST = -1073807194
+DEAD_SESSION_ERRORS = (VI_ERROR_INV_OBJECT, VI_ERROR_CONN_LOST)
+
+
+def sessionIsDead(error):
+	'''True if error says the session is gone; not for timeouts, after which the command may still have been executed'''
+	return getattr(error, 'error_code', None) in DEAD_SESSION_ERRORS
+
+
+def busName(resource):
+	'''name of the bus a resource is on, e.g. TCPIP0::10.0.0.3::gpib0 for TCPIP0::10.0.0.3::gpib0,10::INSTR'''
+	parts = resource.split('::')
+	if len(parts) >= 3 and ',' in parts[2]:
+		return '::'.join(parts[:2] + [parts[2].split(',')[0]])
+	return resource
+
+
+class VisaHandle:
+	'''a controller's handle to a pooled VISA session
+	
+	the session is only opened on first use and reopened after a failure.
+	every access holds the lock of the bus while it lasts; use ask for a query,
+	which keeps the lock from writing the query until its answer is read, so
+	other threads can't interleave. a query written with write and read with
+	read is not protected against that.'''
+	def __init__(self, pool, resource, timeout):
+		self.pool = pool
+		self.resource = resource
+		self.timeout = timeout
+		self.lock = pool.busLock(busName(resource))
+	
+	def __session(self, reconnect=False):
+		return self.pool.session(self.resource, self.timeout, reconnect)
+	
+	def write(self, string):
+		'''visa command write function, reconnects and writes again once if the session was lost
+		
+		other errors, timeouts in particular, are raised: the command may have
+		reached the instrument, and commands like TRIG must not run twice.'''
+		self.lock.acquire()
+		try:
+			session = self.__session()
+			try:
+				session.write(string)
+			except Exception as e:
+				if not sessionIsDead(e):
+					raise
+				logger.warn('VISA session to %s was lost (%s), reconnecting' % (self.resource, e))
+				self.__session(True).write(string)
+		finally:
+			self.lock.release()
+	
+	def read(self):
+		'''visa command read function; a failed read drops the session, as the answer is lost'''
+		self.lock.acquire()
+		try:
+			try:
+				return self.__session().read()
+			except:
+				self.pool.close(self.resource)
+				raise
+		finally:
+			self.lock.release()
+	
+	def ask(self, string):
+		'''write a query and read its answer, holding the bus lock for both'''
+		self.lock.acquire()
+		try:
+			self.write(string)
+			return self.read()
+		finally:
+			self.lock.release()
+	
+	def close(self):
+		self.pool.close(self.resource)
+
+
+class VisaSessionPool:
+	'''opens at most one VISA session per resource and one lock per bus'''
+	def __init__(self):
+		self.__sessions = {}
+		self.__busLocks = {}
+		self.__lock = threading.Lock()
+	
+	def handle(self, resource, timeout=1, lazy=False):
+		'''handle to resource; raises ImportError if there is no VISA library
+		
+		the session is opened right away, so an unreachable instrument raises here
+		and the controller can fall back to its simulator; with lazy=True it is
+		only opened on first use.'''
+		import visa #pylint: disable=F0401,W0612
+		handle = VisaHandle(self, resource, timeout)
+		if not lazy:
+			self.session(resource, timeout)
+		return handle
+	
+	def busLock(self, bus):
+		'''lock serializing all access to bus'''
+		self.__lock.acquire()
+		try:
+			return self.__busLocks.setdefault(bus, threading.RLock())
+		finally:
+			self.__lock.release()
+	
+	def session(self, resource, timeout=1, reconnect=False):
+		'''open VISA session to resource, opening it if necessary'''
+		self.__lock.acquire()
+		try:
+			if reconnect:
+				self.__close(resource)
+			if resource not in self.__sessions:
+				import visa #pylint: disable=F0401
+				logger.debug('opening VISA session to ' + resource)
+				self.__sessions[resource] = visa.instrument(resource, timeout = timeout)
+			return self.__sessions[resource]
+		finally:
+			self.__lock.release()
+	
+	def __close(self, resource):
+		session = self.__sessions.pop(resource, None)
+		if session is not None:
+			try:
+				session.close()
+			except Exception as e:
+				logger.debug('closing VISA session to %s failed: %s' % (resource, e))
+	
+	def close(self, resource=None):
+		'''close the session to resource, or all sessions'''
+		self.__lock.acquire()
+		try:
+			for r in (resource is None and list(self.__sessions) or [resource]):
+				self.__close(r)
+		finally:
+			self.__lock.release()
+
+
+# shared by all controllers
+pool = VisaSessionPool()
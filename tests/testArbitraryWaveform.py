@@ -0,0 +1,115 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' tests of the arbitrary waveform upload and slot table, on the Agilent simulator'''
+
+import unittest
+import numpy
+
+from labcontrol.AgilentController import AgilentController
+from labcontrol.ArbitraryWaveform import dacCodes, waveformHash, DAC_MAX, MAX_POINTS
+
+
+def shape(i, points=100):
+	'''a different waveform for every i'''
+	return numpy.sin(numpy.linspace(0, (i + 1)*numpy.pi, points))
+
+
+class DacCodesTest(unittest.TestCase):
+	def testFloatsAreScaled(self):
+		codes = dacCodes([-2., -1., 0., 0.5, 1.])
+		self.assertEqual(codes.dtype, numpy.dtype('<i2'))
+		self.assertEqual(list(codes), [-DAC_MAX, -DAC_MAX, 0, 1024, DAC_MAX])
+	
+	def testIntegersAreCodes(self):
+		self.assertEqual(list(dacCodes([-5000, 3, 5000])), [-DAC_MAX, 3, DAC_MAX])
+	
+	def testSize(self):
+		self.assertRaises(ValueError, dacCodes, [])
+		self.assertRaises(ValueError, dacCodes, numpy.zeros(MAX_POINTS + 1))
+		self.assertRaises(ValueError, dacCodes, numpy.zeros((2, 10)))
+
+
+class WaveformSlotsTest(unittest.TestCase):
+	def setUp(self):
+		self.controller = AgilentController('labalyzer')
+		self.cache = self.controller._AgilentController__agilent
+		self.simulator = self.cache.instrument.instrument
+		self.slots = self.controller._AgilentController__waveforms
+	
+	def testUploadToVolatileMemory(self):
+		self.assertEqual(self.controller.setArbitrary(shape(0)), 'VOLATILE')
+		self.assertEqual(self.simulator.volatile, dacCodes(shape(0)).tobytes())
+		self.assertTrue(shape(0) in self.slots)
+		self.assertFalse(shape(1) in self.slots)
+	
+	def testSameWaveformIsNotUploadedAgain(self):
+		self.controller.setArbitrary(shape(0))
+		self.assertEqual(self.controller.setArbitrary(shape(0)), 'VOLATILE')
+		self.assertEqual((self.slots.uploads, self.slots.hits, self.slots.copies), (1, 1, 0))
+	
+	def testRepeatedShapesArePersisted(self):
+		names = [self.controller.setArbitrary(shape(i % 2)) for i in range(6)]
+		self.assertEqual(names, ['VOLATILE', 'VOLATILE', 'ARB1', 'ARB2', 'ARB1', 'ARB2'])
+		self.assertEqual((self.slots.uploads, self.slots.copies), (4, 2))
+		self.assertEqual(self.simulator.waveforms['ARB1'], dacCodes(shape(0)).tobytes())
+		self.assertEqual(self.simulator.waveforms['ARB2'], dacCodes(shape(1)).tobytes())
+	
+	def testPersistFlag(self):
+		for i in range(4):
+			self.assertEqual(self.controller.setArbitrary(shape(i % 2), persist=False), 'VOLATILE')
+		self.assertEqual(self.slots.copies, 0)
+		self.assertEqual(self.controller.setArbitrary(shape(2), persist=True), 'ARB1')
+		self.assertEqual(self.slots.uploads, 5)
+	
+	def testLeastRecentlyUsedSlotIsOverwritten(self):
+		for i in range(len(self.slots.names)):
+			self.controller.setArbitrary(shape(i), persist=True)
+		self.controller.setArbitrary(shape(0)) # ARB2 is now the least recently used
+		self.assertEqual(self.controller.setArbitrary(shape(9), persist=True), 'ARB2')
+		self.assertFalse(shape(1) in self.slots)
+		self.assertEqual(self.controller.setArbitrary(shape(0)), 'ARB1')
+		self.assertEqual(self.simulator.waveforms['ARB2'], dacCodes(shape(9)).tobytes())
+	
+	def testResyncUploadsAgain(self):
+		self.controller.setArbitrary(shape(0), persist=True)
+		self.controller.resync()
+		self.assertFalse(shape(0) in self.slots)
+		self.controller.setArbitrary(shape(0))
+		self.assertEqual(self.slots.uploads, 2)
+	
+	def testSelectingKeepsTheOtherSettings(self):
+		self.controller.setArbitrary(shape(0)) # FUNC USER may change everything
+		self.controller.setOffset(0.5)
+		self.controller.setArbitrary(shape(1))
+		self.controller.setArbitrary(shape(0))
+		self.simulator.lastCommand = None
+		self.controller.setOffset(0.5)
+		self.assertEqual(self.simulator.lastCommand, None)
+	
+	def testNewVolatileDataIsSelectedAgain(self):
+		self.controller.setArbitrary(shape(0))
+		self.controller.setArbitrary(shape(1))
+		self.assertEqual(self.simulator.lastCommand, 'FUNC:USER VOLATILE')
+	
+	def testContentAddressing(self):
+		self.assertEqual(waveformHash(dacCodes(shape(0))), waveformHash(dacCodes(list(shape(0)))))
+		self.assertNotEqual(waveformHash(dacCodes(shape(0))), waveformHash(dacCodes(shape(1))))
+
+
+if __name__ == '__main__':
+	unittest.main()
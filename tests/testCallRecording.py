@@ -0,0 +1,129 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' tests of call recording and replay, with the Agilent and NIDAQ input simulators'''
+
+import ctypes
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from labcontrol.Instrumentation import metrics
+from labcontrol.CallRecording import CallRecorder, Replay, encodeArgument, decodeArgument
+from labcontrol.AgilentController import AgilentController, AgilentSimulator
+from labcontrol.NIDAQInputController import NIDAQInputController, NIDAQInputSimulator
+
+
+class ArgumentTest(unittest.TestCase):
+	def roundTrip(self, arg):
+		return decodeArgument(encodeArgument(arg))
+	
+	def testPlainValues(self):
+		for arg in (None, True, 3, 2.5, 'FREQ 1000'):
+			self.assertEqual(self.roundTrip(arg), arg)
+	
+	def testBinaryString(self):
+		self.assertEqual(self.roundTrip('\x00\xff#'), '\x00\xff#')
+	
+	def testCtypesValues(self):
+		value = self.roundTrip(ctypes.c_double(1.5))
+		self.assertEqual((type(value), value.value), (ctypes.c_double, 1.5))
+		reference = self.roundTrip(ctypes.byref(ctypes.c_ulong(7)))
+		self.assertEqual((type(reference._obj), reference._obj.value), (ctypes.c_ulong, 7))
+	
+	def testOutputBufferKeepsItsSize(self):
+		buff = (ctypes.c_double*10)()
+		self.assertEqual(encodeArgument(ctypes.byref(buff)), {'buf': 80})
+		self.assertEqual(ctypes.sizeof(self.roundTrip(ctypes.byref(buff))._obj), 80)
+	
+	def testArrayPointerKeepsItsContent(self):
+		array = numpy.arange(6, dtype=numpy.float64).reshape(2, 3)
+		pointer = self.roundTrip(array.ctypes.data_as(ctypes.c_void_p))
+		self.assertEqual(ctypes.string_at(pointer, array.nbytes), array.tobytes())
+	
+	def testCtypesArrayKeepsItsContent(self):
+		buff = self.roundTrip((ctypes.c_char*4)('a', 'b'))
+		self.assertEqual(buff.raw, 'ab\x00\x00')
+	
+	def testPointerOfUnknownSizeIsRefused(self):
+		value = ctypes.c_long(1)
+		self.assertRaises(TypeError, encodeArgument, ctypes.pointer(value))
+		self.assertRaises(TypeError, encodeArgument, ctypes.c_void_p(ctypes.addressof(value)))
+
+
+class RecordingTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.recorder = CallRecorder().begin()
+	
+	def tearDown(self):
+		self.recorder.end()
+		metrics.disable()
+		metrics.reset()
+		shutil.rmtree(self.directory)
+	
+	def saveAndLoad(self):
+		self.recorder.end()
+		path = os.path.join(self.directory, 'calls.json.gz')
+		self.recorder.save(path)
+		return Replay.load(path)
+	
+	def testVisaRoundTrip(self):
+		controller = AgilentController('labalyzer')
+		simulator = controller._AgilentController__agilent.instrument.instrument
+		with controller.batch():
+			controller.setFrequency(1000)
+			controller.setAmplitude(2)
+		controller.setArbitrary(numpy.linspace(-1, 1, 50))
+		replay = self.saveAndLoad()
+		self.assertEqual(replay.devices(), ['agilent'])
+		self.assertEqual([entry[2] for entry in replay.calls], ['write']*len(replay.calls))
+		target = AgilentSimulator()
+		result = replay.run({'agilent': target}, latency=False, paced=False)
+		self.assertEqual(result['calls'], len(self.recorder.calls))
+		self.assertEqual(target.volatile, simulator.volatile) # the binary block arrived unchanged
+		self.assertEqual(target.lastCommand, simulator.lastCommand)
+	
+	def testLibraryRoundTrip(self):
+		controller = NIDAQInputController()
+		source = controller._NIDAQInputController__nidaq.library
+		controller.initialize(100, 10000, {'Dev3/ai0': (-10., 10.), 'Dev3/ai1': (-5., 5.)})
+		controller.startTask()
+		controller.readData()
+		controller.stopTask()
+		replay = self.saveAndLoad()
+		target = NIDAQInputSimulator()
+		target.DAQmxCreateTask('', ctypes.byref(ctypes.c_ulong())) # the replayed task gets another handle
+		result = replay.run({'nidaq-ai': target}, latency=False, paced=False)
+		self.assertEqual(result['calls'], len(self.recorder.calls))
+		recorded = source._NIDAQInputSimulator__tasks[1]
+		replayed = target._NIDAQInputSimulator__tasks[2]
+		for key in ('channels', 'rate', 'samples', 'trigger', 'position'):
+			self.assertEqual(replayed[key], recorded[key])
+		self.assertEqual(replayed['position'], 100) # the read went to the mapped handle
+	
+	def testOtherDevicesAreSkipped(self):
+		controller = AgilentController('labalyzer')
+		controller.setFrequency(1000)
+		replay = self.saveAndLoad()
+		self.assertEqual(replay.run({'srs': AgilentSimulator()}, latency=False, paced=False)['calls'], 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
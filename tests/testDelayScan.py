@@ -0,0 +1,120 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' tests of the delay scan compiler, on the SRS DG535 simulator'''
+
+import unittest
+
+try:
+	from labcontrol.SRSPulseController import SRSPulseController, DelayScanProgramme, SETUP_COMMANDS, delayCommands
+	missing = None
+except ImportError as e: # the controller needs labalyzer
+	missing = str(e)
+
+
+def scanPoints(delays):
+	'''startOutput settings of a scan over the relative delay'''
+	return [{'PulseLength': 0, 'RelativeDelay': delay, 'ABPulseLength': 10, 'CDPulseLength': 20} for delay in delays]
+
+
+@unittest.skipIf(missing, 'SRSPulseController can not be imported: %s' % missing)
+class DelayScanProgrammeTest(unittest.TestCase):
+	def testFirstStepSetsEverything(self):
+		points = scanPoints([10, 20])
+		programme = DelayScanProgramme(points)
+		self.assertEqual(programme.steps[0], SETUP_COMMANDS + [command for channel, command in delayCommands(points[0])])
+		self.assertEqual(programme.fullCommands(1), SETUP_COMMANDS + [command for channel, command in delayCommands(points[1])])
+	
+	def testLaterStepsOnlyHoldChanges(self):
+		programme = DelayScanProgramme(scanPoints([10, 20, 30, 30]))
+		self.assertEqual(len(programme), 4)
+		for step in programme.steps[1:3]:
+			self.assertEqual(len(step), 1)
+			self.assertTrue(step[0].startswith('DT 5,1,'))
+		self.assertEqual(programme.steps[3], [])
+		self.assertEqual(programme.noCommands(), len(SETUP_COMMANDS) + 4 + 2)
+	
+	def testReorderVisitsEveryPointOnce(self):
+		# the sign of the delay decides which pulse comes first, changing all delays
+		delays = [-100, 100, -200, 200, -300, 300]
+		plain = DelayScanProgramme(scanPoints(delays))
+		reordered = DelayScanProgramme(scanPoints(delays), reorder=True)
+		self.assertEqual(sorted(reordered.order), list(range(len(delays))))
+		self.assertEqual(reordered.order[0], 0)
+		self.assertEqual(reordered.points, [scanPoints(delays)[i] for i in reordered.order])
+		self.assertTrue(reordered.noCommands() < plain.noCommands())
+	
+	def testEmptyScan(self):
+		programme = DelayScanProgramme([], reorder=True)
+		self.assertEqual((len(programme), programme.noCommands()), (0, 0))
+
+
+@unittest.skipIf(missing, 'SRSPulseController can not be imported: %s' % missing)
+class DelayScanRunTest(unittest.TestCase):
+	def setUp(self):
+		self.controller = SRSPulseController('labalyzer')
+		self.cache = self.controller._SRSPulseController__pulse
+		self.simulator = self.cache.instrument.instrument
+	
+	def delaysOf(self, point):
+		'''delays the simulator has after startOutput(point) on a fresh controller'''
+		controller = SRSPulseController('labalyzer')
+		controller.startOutput(point)
+		return controller._SRSPulseController__pulse.instrument.instrument.delays
+	
+	def testStepsSetTheDelaysOfTheirPoint(self):
+		delays = [-100, 100, -200, 200, 0, 50]
+		programme = self.controller.compileDelayScan(scanPoints(delays), reorder=True)
+		for step in range(len(programme)):
+			self.controller.runDelayScanStep(programme, step)
+			self.assertEqual(self.simulator.delays, self.delaysOf(programme.points[step]))
+	
+	def testStepsInOrderOnlySendChanges(self):
+		programme = self.controller.compileDelayScan(scanPoints([10, 20, 30]))
+		self.controller.runDelayScanStep(programme, 0)
+		self.controller.runDelayScanStep(programme, 1)
+		self.assertEqual(self.simulator.lastCommand, programme.steps[1][0])
+	
+	def testStepsOutOfOrder(self):
+		programme = self.controller.compileDelayScan(scanPoints([-100, 100, 10]))
+		self.controller.runDelayScanStep(programme, 0)
+		self.controller.runDelayScanStep(programme, 2)
+		self.assertEqual(self.simulator.delays, self.delaysOf(programme.points[2]))
+		self.controller.runDelayScanStep(programme, 1)
+		self.assertEqual(self.simulator.delays, self.delaysOf(programme.points[1]))
+	
+	def testResyncSendsTheFullStep(self):
+		programme = self.controller.compileDelayScan(scanPoints([10, 20]))
+		self.controller.runDelayScanStep(programme, 0)
+		self.controller.resync()
+		self.simulator.delays.clear() # as if the front panel had been used
+		sent = self.cache.sent
+		self.controller.runDelayScanStep(programme, 1)
+		self.assertEqual(self.cache.sent - sent, len(programme.fullCommands(1)))
+		self.assertEqual(self.simulator.delays, self.delaysOf(programme.points[1]))
+	
+	def testOtherSettingsInBetween(self):
+		points = scanPoints([10, 20, 30])
+		programme = self.controller.compileDelayScan(points)
+		self.controller.runDelayScanStep(programme, 0)
+		self.controller.startOutput(scanPoints([500])[0])
+		self.controller.runDelayScanStep(programme, 1)
+		self.assertEqual(self.simulator.delays, self.delaysOf(points[1]))
+
+
+if __name__ == '__main__':
+	unittest.main()
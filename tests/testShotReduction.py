@@ -0,0 +1,120 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' tests of the on-line shot reduction, alone and fed by the NIDAQ input simulator'''
+
+import time
+import unittest
+import numpy
+
+from labcontrol.ShotReduction import ShotReducer
+from labcontrol.NIDAQInputController import NIDAQInputController
+
+CHANNELS = {'Dev3/ai0': (-10., 10.), 'Dev3/ai1': (-10., 10.)}
+
+
+class ShotReducerTest(unittest.TestCase):
+	def setUp(self):
+		self.records = numpy.random.RandomState(0).standard_normal((20, 2, 50))
+	
+	def testMeanAndVariance(self):
+		reducer = ShotReducer(2, 50)
+		for record in self.records:
+			reducer.add(record)
+		self.assertEqual(reducer.noShots, 20)
+		self.assertTrue(numpy.allclose(reducer.mean(), self.records.mean(axis=0)))
+		self.assertTrue(numpy.allclose(reducer.variance(), self.records.var(axis=0, ddof=1)))
+		self.assertTrue(numpy.allclose(reducer.variance(0), self.records.var(axis=0)))
+	
+	def testGates(self):
+		reducer = ShotReducer(2, 50, {'signal': (10, 20), 'background': (0, 10)}, samplesPerSecond=1000., traces=False)
+		for record in self.records:
+			reducer.add(record)
+		integrals = self.records[:, :, 10:20].sum(axis=2)/1000.
+		self.assertTrue(numpy.allclose(reducer.gateMean('signal'), integrals.mean(axis=0)))
+		self.assertTrue(numpy.allclose(reducer.gateVariance('signal'), integrals.var(axis=0, ddof=1)))
+		self.assertTrue(numpy.allclose(reducer.lastGates['signal'], integrals[-1]))
+		summary = reducer.summary()
+		self.assertEqual(summary['shots'], 20)
+		self.assertTrue(numpy.allclose(summary['signal'][1], numpy.sqrt(integrals.var(axis=0, ddof=1)/20)))
+	
+	def testFewShots(self):
+		reducer = ShotReducer(2, 50, {'signal': (10, 20)})
+		reducer.add(self.records[0])
+		self.assertEqual(reducer.variance().tolist(), numpy.zeros((2, 50)).tolist())
+		self.assertEqual(reducer.gateVariance('signal').tolist(), [0., 0.])
+	
+	def testResetAndKeepRaw(self):
+		reducer = ShotReducer(2, 50, keepRaw=True)
+		for record in self.records[:3]:
+			reducer.add(record)
+		self.assertEqual(len(reducer.records), 3)
+		self.assertTrue(numpy.array_equal(reducer.records[1], self.records[1]))
+		reducer.reset()
+		self.assertEqual((reducer.noShots, reducer.records), (0, []))
+		self.assertEqual(reducer.mean().tolist(), numpy.zeros((2, 50)).tolist())
+	
+	def testShapes(self):
+		reducer = ShotReducer(2, 50)
+		self.assertRaises(ValueError, reducer.add, numpy.zeros((2, 49)))
+		self.assertRaises(ValueError, ShotReducer, 2, 50, {'late': (40, 51)})
+		self.assertRaises(ValueError, ShotReducer, 2, 50, {'empty': (10, 10)})
+
+
+class ControllerReducerTest(unittest.TestCase):
+	def setUp(self):
+		self.controller = NIDAQInputController()
+		self.controller.initialize(200, 100000, CHANNELS)
+	
+	def tearDown(self):
+		self.controller.shutdown()
+	
+	def testReadDataFeedsTheReducer(self):
+		reducer = ShotReducer(2, 200)
+		self.controller.attachReducer(reducer)
+		records = []
+		for _ in range(5):
+			self.controller.startTask()
+			records.append(self.controller.readData().copy())
+			self.controller.stopTask()
+		self.assertEqual(reducer.noShots, 5)
+		self.assertTrue(numpy.allclose(reducer.mean(), numpy.mean(records, axis=0)))
+	
+	def testEveryNCallbackFeedsTheReducer(self):
+		reducer = ShotReducer(2, 200)
+		self.controller.attachReducer(reducer, everyN=True)
+		self.controller.startTask()
+		deadline = time.time() + 5
+		while reducer.noShots == 0 and time.time() < deadline:
+			time.sleep(0.001)
+		self.controller.stopTask()
+		self.assertEqual(reducer.noShots, 1)
+	
+	def testReducerIsDetachedWhenTheShapeChanges(self):
+		reducer = ShotReducer(2, 200)
+		self.controller.attachReducer(reducer)
+		self.controller.initialize(200, 50000, CHANNELS) # same shape, other rate
+		self.assertTrue(self.controller.reducer is reducer)
+		self.controller.initialize(100, 100000, CHANNELS)
+		self.assertTrue(self.controller.reducer is None)
+		self.controller.startTask()
+		self.controller.readData()
+		self.assertEqual(reducer.noShots, 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,127 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' tests of the shot spool: writing and reading back, alone and from the NIDAQ input simulator'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from labcontrol.ShotSpool import SpoolWriter, SpoolReader, readHeader
+from labcontrol.ShotReduction import ShotReducer
+from labcontrol.NIDAQInputController import NIDAQInputController
+
+CHANNELS = {'Dev3/ai0': (-10., 10.), 'Dev3/ai1': (-5., 5.)}
+
+
+class SpoolTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'shots.spool')
+		self.records = numpy.random.RandomState(0).standard_normal((40, 2, 30))
+	
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+	
+	def testRoundTrip(self):
+		writer = SpoolWriter(self.path, ['a', 'b'], [(-1, 1), (-2, 2)], 1000., 30, triggerPosition=15, chunkShots=4)
+		for record in self.records:
+			writer.append(record)
+		writer.close()
+		reader = SpoolReader(self.path)
+		self.assertEqual(len(reader), 40)
+		self.assertTrue(numpy.array_equal(reader.shots(), self.records))
+		self.assertTrue(numpy.array_equal(reader[7], self.records[7]))
+		self.assertEqual(reader.channel('b'), 1)
+		header = readHeader(self.path)
+		self.assertEqual((header['shots'], header['triggerPosition'], header['ranges']), (40, 15, [[-1, 1], [-2, 2]]))
+	
+	def testCallerMayReuseItsBuffer(self):
+		buff = numpy.zeros((2, 30))
+		writer = SpoolWriter(self.path, ['a', 'b'], [(-1, 1), (-1, 1)], 1000., 30, dtype=numpy.float32)
+		for record in self.records[:5]:
+			buff[:] = record
+			writer.append(buff)
+		writer.close()
+		shots = SpoolReader(self.path).shots()
+		self.assertEqual(shots.dtype, numpy.float32)
+		self.assertTrue(numpy.allclose(shots, self.records[:5], atol=1e-6))
+	
+	def testSpoolBeingWritten(self):
+		writer = SpoolWriter(self.path, ['a', 'b'], [(-1, 1), (-1, 1)], 1000., 30)
+		try:
+			reader = SpoolReader(self.path)
+			self.assertEqual(len(reader), 0)
+			self.assertRaises(IndexError, reader.__getitem__, 0)
+			writer.append(self.records[0])
+		finally:
+			writer.close()
+		reader.refresh()
+		self.assertEqual(len(reader), 1)
+	
+	def testClosedSpool(self):
+		with SpoolWriter(self.path, ['a', 'b'], [(-1, 1), (-1, 1)], 1000., 30) as writer:
+			self.assertRaises(ValueError, writer.append, numpy.zeros((2, 29)))
+		self.assertRaises(ValueError, writer.append, self.records[0])
+		writer.close() # again, does nothing
+	
+	def testNotASpool(self):
+		f = open(self.path, 'wb')
+		f.write(b'x'*5000)
+		f.close()
+		self.assertRaises(ValueError, SpoolReader, self.path)
+
+
+class ControllerSpoolTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'shots.spool')
+		self.controller = NIDAQInputController()
+	
+	def tearDown(self):
+		self.controller.shutdown()
+		shutil.rmtree(self.directory)
+	
+	def testReducerAndSpoolGetTheSameRecords(self):
+		self.controller.initialize(100, 100000, CHANNELS)
+		reducer = ShotReducer(2, 100, {'pulse': (40, 60)})
+		self.controller.attachReducer(reducer)
+		self.controller.openSpool(self.path)
+		records = []
+		for _ in range(6):
+			self.controller.startTask()
+			records.append(self.controller.readData().copy())
+			self.controller.stopTask()
+		self.controller.closeSpool()
+		reader = SpoolReader(self.path)
+		self.assertEqual(reader.header['channels'], sorted(CHANNELS))
+		self.assertEqual(reader.header['triggerPosition'], 50)
+		self.assertTrue(numpy.array_equal(reader.shots(), records))
+		self.assertTrue(numpy.allclose(reader.shots().mean(axis=0), reducer.mean()))
+		self.assertTrue(numpy.allclose(reader.shots()[:, :, 40:60].sum(axis=2).mean(axis=0), reducer.gateMean('pulse')))
+	
+	def testStreamingSpoolHasNoTriggerPosition(self):
+		self.controller.initializeStreaming(100, 100000, CHANNELS, noChunks=4)
+		self.controller.openSpool(self.path)
+		self.controller.closeSpool()
+		self.assertEqual(readHeader(self.path)['triggerPosition'], None)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,215 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: tab; tab-width: 2 -*-
+### BEGIN LICENSE
+# Copyright (C) 2010 <Atreju Tauschinsky> <Atreju.Tauschinsky@gmx.de>
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License version 3, as published 
+# by the Free Software Foundation.
+# 
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranties of 
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR 
+# PURPOSE.  See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+
+''' tests of the SCPI state cache, on a recording stand-in for an instrument and on the Agilent simulator'''
+
+import unittest
+
+from labcontrol.StateCache import StateCache, ALL_SETTINGS
+from labcontrol.AgilentController import AgilentController, COUPLED_SETTINGS
+
+
+class RecordingInstrument:
+	'''keeps every message written; queries are answered with answer'''
+	def __init__(self, answer='1'):
+		self.writes = []
+		self.answer = answer
+		self.fail = False # raise on the next write
+	
+	def write(self, string):
+		if self.fail:
+			self.fail = False
+			raise IOError('write failed')
+		self.writes.append(string)
+	
+	def ask(self, string):
+		self.writes.append(string)
+		return self.answer
+
+
+class StateCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.instrument = RecordingInstrument()
+		self.cache = StateCache(self.instrument, COUPLED_SETTINGS)
+	
+	def testRepeatedSettingIsSuppressed(self):
+		self.cache.write('FREQ 1000')
+		self.cache.write(':freq 1000')
+		self.cache.write('FREQ 2000')
+		self.assertEqual(self.instrument.writes, ['FREQ 1000', 'FREQ 2000'])
+		self.assertEqual((self.cache.sent, self.cache.suppressed), (2, 1))
+	
+	def testCommandsAndQueriesAreAlwaysSent(self):
+		for _ in range(2):
+			self.cache.write('TRIG')
+			self.cache.write('FREQ?')
+		self.assertEqual(self.instrument.writes, ['TRIG', 'FREQ?', 'TRIG', 'FREQ?'])
+	
+	def testCompoundWriteOnlySendsChanges(self):
+		self.cache.write('FREQ 1000;VOLT 2')
+		self.cache.write('FREQ 1000;VOLT 3')
+		self.assertEqual(self.instrument.writes, ['FREQ 1000;VOLT 2', 'VOLT 3'])
+	
+	def testCoupledSettingsAreForgotten(self):
+		self.cache.write('VOLT:HIGH 5')
+		self.cache.write('VOLT:OFFS 1') # may change the high level
+		self.cache.write('VOLT:HIGH 5')
+		self.assertEqual(self.instrument.writes, ['VOLT:HIGH 5', 'VOLT:OFFS 1', 'VOLT:HIGH 5'])
+	
+	def testUncoupledSettingsAreKept(self):
+		self.cache.write('VOLT:HIGH 5')
+		self.cache.write('BURS:NCYC 1')
+		self.cache.write('VOLT:HIGH 5')
+		self.assertEqual(self.instrument.writes, ['VOLT:HIGH 5', 'BURS:NCYC 1'])
+	
+	def testAllSettingsCoupling(self):
+		self.assertEqual(COUPLED_SETTINGS['FUNC'], ALL_SETTINGS)
+		self.cache.write('FREQ 1000')
+		self.cache.write('BURS:NCYC 1')
+		self.cache.write('FUNC SIN')
+		self.cache.write('FREQ 1000')
+		self.cache.write('BURS:NCYC 1')
+		self.assertEqual(self.instrument.writes, ['FREQ 1000', 'BURS:NCYC 1', 'FUNC SIN', 'FREQ 1000', 'BURS:NCYC 1'])
+	
+	def testSelectingArbitraryWaveformKeepsSettings(self):
+		self.cache.write('FREQ 1000')
+		self.cache.write('FUNC:USER ARB1')
+		self.cache.write('FREQ 1000')
+		self.assertEqual(self.instrument.writes, ['FREQ 1000', 'FUNC:USER ARB1'])
+	
+	def testResetAndResyncClearTheCache(self):
+		self.cache.write('FREQ 1000')
+		self.cache.write('*RST')
+		self.cache.write('FREQ 1000')
+		self.cache.resync()
+		self.cache.write('FREQ 1000')
+		self.assertEqual(self.instrument.writes, ['FREQ 1000', '*RST', 'FREQ 1000', 'FREQ 1000'])
+	
+	def testFailedWriteClearsTheCache(self):
+		self.cache.write('FREQ 1000')
+		self.instrument.fail = True
+		self.assertRaises(IOError, self.cache.write, 'VOLT 2')
+		self.cache.write('FREQ 1000')
+		self.cache.write('VOLT 2')
+		self.assertEqual(self.instrument.writes, ['FREQ 1000', 'FREQ 1000', 'VOLT 2'])
+	
+	def testKeyArguments(self):
+		cache = StateCache(self.instrument, keyArgs=1)
+		cache.write('DT 2,1,0')
+		cache.write('DT 3,2,1E-6')
+		cache.write('DT 2,1,0')
+		cache.write('DT 3,2,2E-6')
+		self.assertEqual(self.instrument.writes, ['DT 2,1,0', 'DT 3,2,1E-6', 'DT 3,2,2E-6'])
+
+
+class BatchTest(unittest.TestCase):
+	def setUp(self):
+		self.instrument = RecordingInstrument()
+		self.cache = StateCache(self.instrument, COUPLED_SETTINGS)
+	
+	def testBatchIsOneCompoundMessage(self):
+		with self.cache.batch():
+			self.cache.write('FREQ 1000')
+			self.cache.write(':VOLT 2')
+			self.cache.write('*TRG')
+			self.assertEqual(self.instrument.writes, [])
+		self.assertEqual(self.instrument.writes, ['FREQ 1000;:VOLT 2;*TRG'])
+		self.assertEqual((self.cache.sent, self.cache.messages), (3, 1))
+	
+	def testBatchSuppressesRepeatedSettings(self):
+		self.cache.write('FREQ 1000')
+		with self.cache.batch():
+			self.cache.write('FREQ 1000')
+			self.cache.write('VOLT 2')
+		self.assertEqual(self.instrument.writes, ['FREQ 1000', 'VOLT 2'])
+	
+	def testLongBatchIsSplit(self):
+		self.cache.maxLength = 30
+		with self.cache.batch():
+			for i in range(4):
+				self.cache.write('DATA:VAL%d %d' % (i, i))
+		self.assertEqual(self.instrument.writes, ['DATA:VAL0 0;:DATA:VAL1 1', 'DATA:VAL2 2;:DATA:VAL3 3'])
+		self.assertEqual((self.cache.sent, self.cache.messages), (4, 2))
+	
+	def testOperationCompleteQuery(self):
+		with self.cache.batch(opc=True):
+			self.cache.write('FREQ 1000')
+			self.cache.write('VOLT 2')
+		self.assertEqual(self.instrument.writes, ['FREQ 1000;:VOLT 2;*OPC?'])
+	
+	def testNestedBatchIsSentAtTheEnd(self):
+		with self.cache.batch():
+			self.cache.write('FREQ 1000')
+			with self.cache.batch():
+				self.cache.write('VOLT 2')
+			self.assertEqual(self.instrument.writes, [])
+		self.assertEqual(self.instrument.writes, ['FREQ 1000;:VOLT 2'])
+	
+	def testQueryFlushesTheBatch(self):
+		with self.cache.batch():
+			self.cache.write('FREQ 1000')
+			self.assertEqual(self.cache.ask('FREQ?'), '1')
+			self.cache.write('VOLT 2')
+		self.assertEqual(self.instrument.writes, ['FREQ 1000', 'FREQ?', 'VOLT 2'])
+	
+	def testFailedBatchSendsNothing(self):
+		self.cache.write('FREQ 1000')
+		try:
+			with self.cache.batch():
+				self.cache.write('VOLT 2')
+				raise RuntimeError('abort')
+		except RuntimeError:
+			pass
+		self.assertEqual(self.instrument.writes, ['FREQ 1000'])
+		self.cache.write('FREQ 1000') # the cache was cleared
+		self.assertEqual(self.instrument.writes, ['FREQ 1000', 'FREQ 1000'])
+	
+	def testBinaryBlockKeepsTheOrder(self):
+		with self.cache.batch():
+			self.cache.write('FORM:BORD SWAP')
+			self.cache.writeBlock('DATA:DAC VOLATILE,', '\x01\x00')
+			self.cache.write('FUNC:USER VOLATILE')
+		self.assertEqual(self.instrument.writes, ['FORM:BORD SWAP', 'DATA:DAC VOLATILE, #12\x01\x00', 'FUNC:USER VOLATILE'])
+
+
+class AgilentCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.controller = AgilentController('labalyzer')
+		self.cache = self.controller._AgilentController__agilent
+		self.simulator = self.cache.instrument.instrument
+	
+	def testSimulatorOnlyGetsChanges(self):
+		self.controller.setFrequency(1000)
+		self.controller.setAmplitude(2)
+		self.simulator.lastCommand = None
+		self.controller.setFrequency(1000)
+		self.controller.setAmplitude(2)
+		self.assertEqual(self.simulator.lastCommand, None)
+		self.controller.setSine() # APPL changes everything
+		self.controller.setFrequency(1000)
+		self.assertEqual(self.simulator.lastCommand, 'FREQ 1000')
+	
+	def testResyncSendsEverythingAgain(self):
+		self.controller.setOffset(0.5)
+		self.controller.resync()
+		self.simulator.lastCommand = None
+		self.controller.setOffset(0.5)
+		self.assertEqual(self.simulator.lastCommand, 'VOLT:OFFS 0.5')
+
+
+if __name__ == '__main__':
+	unittest.main()